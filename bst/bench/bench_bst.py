@@ -0,0 +1,386 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+# Part of Zato - Open-Source ESB, SOA, REST, APIs and Cloud Integrations in Python
+# https://zato.io
+
+""" Benchmarks BST transitions, mass transitions, history and current state lookups against Redis and SQL backends.
+
+Usage: python bench/bench_bst.py --backends redis,sql --objects 100,1000 --history 1,50 --concurrency 1,4 --output out.json
+"""
+
+# stdlib
+import argparse
+import os
+import platform
+import sys
+from datetime import datetime
+from json import dumps
+from random import Random
+from shutil import rmtree
+from tempfile import mkdtemp
+from threading import Lock, Thread
+from time import time
+
+# SQLAlchemy
+from sqlalchemy import create_engine
+from sqlalchemy.orm import scoped_session, sessionmaker
+
+# Zato
+from zato.bst import ConfigItem, RedisBackend, SQLBackend, StateMachine
+from zato.bst.sql import Base, Cluster, Group, label, SubGroup
+
+# ################################################################################################################################
+
+CONFIG = """
+[Orders]
+objects=order
+force_stop=canceled
+new=submitted
+submitted=ready
+ready=sent
+sent=rejected
+rejected=updated
+updated=ready
+""".strip()
+
+DEF_TAG = 'Orders.v1'
+
+# Objects go through the roots first and then keep on cycling, which lets histories grow to any length.
+STATES_PREFIX = ['new', 'submitted']
+STATES_CYCLE = ['ready', 'sent', 'rejected', 'updated']
+
+SCENARIOS = ('transition', 'mass_transition', 'get_history', 'get_history_last', 'get_current_state_info')
+
+# How many of the newest transitions get_history_last reads
+HISTORY_LAST = 10
+
+# ################################################################################################################################
+
+def get_state(idx):
+    """ Returns the state an object is in after idx + 1 transitions.
+    """
+    if idx < len(STATES_PREFIX):
+        return STATES_PREFIX[idx]
+    return STATES_CYCLE[(idx - len(STATES_PREFIX)) % len(STATES_CYCLE)]
+
+def percentile(values, pct):
+    """ Returns the pct-th percentile of already sorted values using the nearest-rank method.
+    """
+    if not values:
+        return None
+    idx = int(round(pct / 100.0 * len(values) + 0.5)) - 1
+    return values[min(max(idx, 0), len(values) - 1)]
+
+def csv_ints(value):
+    return [int(elem) for elem in value.split(',') if elem.strip()]
+
+def csv_strs(value):
+    return [elem.strip() for elem in value.split(',') if elem.strip()]
+
+# ################################################################################################################################
+
+class RedisEnv(object):
+    """ Connects to a Redis server if one is given or falls back to fakeredis otherwise.
+    """
+    name = 'redis'
+
+    def __init__(self, args):
+        if args.redis_url:
+            import redis
+            self.conn = redis.Redis.from_url(args.redis_url)
+            self.kind = 'redis-server'
+        else:
+            from fakeredis import FakeRedis
+            self.conn = FakeRedis()
+            self.kind = 'fakeredis'
+
+    def get_backend(self):
+        self.conn.flushdb()
+        return RedisBackend(self.conn)
+
+    def close(self):
+        self.conn.flushdb()
+
+class SQLEnv(object):
+    """ Creates a fresh SQL database for each run, by default an SQLite file in a temporary directory
+    so that all threads share the same data.
+    """
+    name = 'sql'
+
+    def __init__(self, args):
+        self.sql_url = args.sql_url
+        self.tmp_dir = None
+        self.engine = None
+        self.kind = (self.sql_url or 'sqlite').split(':')[0]
+
+    def get_backend(self):
+        self.close()
+
+        if self.sql_url:
+            engine = create_engine(self.sql_url)
+            Base.metadata.drop_all(engine)
+        else:
+            self.tmp_dir = mkdtemp(prefix='zato-bst-bench-')
+            engine = create_engine('sqlite:///{}'.format(os.path.join(self.tmp_dir, 'bst.db')),
+                connect_args={'timeout': 60, 'check_same_thread': False})
+
+        Base.metadata.create_all(engine)
+        self.engine = engine
+
+        session = sessionmaker(bind=engine)()
+
+        cluster = Cluster()
+        session.add(cluster)
+        session.commit()
+
+        group = Group()
+        group.name = label.group.conf.process
+        group.is_internal = True
+        group.cluster_id = cluster.id
+
+        sub_group = SubGroup()
+        sub_group.name = label.sub_group.conf.process_bst
+        sub_group.is_internal = True
+        sub_group.group = group
+        sub_group.cluster_id = cluster.id
+
+        session.add(group)
+        session.add(sub_group)
+        session.commit()
+
+        cluster_id = cluster.id
+        session.close()
+
+        # Each thread gets its own session
+        return SQLBackend(scoped_session(sessionmaker(bind=engine)), cluster_id)
+
+    def close(self):
+        if self.engine:
+            self.engine.dispose()
+            self.engine = None
+        if self.tmp_dir:
+            rmtree(self.tmp_dir, True)
+            self.tmp_dir = None
+
+ENVS = {
+    RedisEnv.name: RedisEnv,
+    SQLEnv.name: SQLEnv,
+}
+
+# ################################################################################################################################
+
+class Run(object):
+    """ A single benchmark run - one scenario against one backend with a given number of objects, history length
+    and concurrency.
+    """
+    def __init__(self, env, scenario, objects, history, concurrency, args):
+        self.env = env
+        self.scenario = scenario
+        self.objects = objects
+        self.history = history
+        self.concurrency = concurrency
+        self.ops = args.ops
+        self.batch_size = args.batch_size
+        self.seed = args.seed
+
+        self.latencies = []
+        self.errors = 0
+        self.lock = Lock()
+
+        config_item = ConfigItem()
+        config_item.parse_config_ini(CONFIG)
+        self.config = {config_item.def_.tag: config_item}
+
+        self.sm = StateMachine(self.config, env.get_backend())
+        self.object_tags = ['order.{}'.format(idx) for idx in range(objects)]
+
+        # How many transitions each object has been through so far
+        self.positions = dict.fromkeys(self.object_tags, 0)
+
+    def preload(self):
+        """ Puts all objects into their initial state and gives each of them a history of requested length.
+        """
+        for idx in range(max(self.history, 1)):
+            state = get_state(idx)
+            for chunk_start in range(0, len(self.object_tags), self.batch_size):
+                chunk = self.object_tags[chunk_start:chunk_start+self.batch_size]
+                for ok, reason, _, _ in self.sm.mass_transition([(object_tag, state, DEF_TAG, None) for object_tag in chunk]):
+                    if not ok:
+                        raise Exception('Could not preload data, e:`{}`'.format(reason))
+
+        for object_tag in self.object_tags:
+            self.positions[object_tag] = max(self.history, 1)
+
+    def _next_state(self, object_tag):
+        state = get_state(self.positions[object_tag])
+        self.positions[object_tag] += 1
+        return state
+
+    def _op_transition(self, object_tags, rand):
+        object_tag = rand.choice(object_tags)
+        self.sm.transition(object_tag, self._next_state(object_tag), DEF_TAG, None)
+
+    def _op_mass_transition(self, object_tags, rand):
+        object_tags = rand.sample(object_tags, min(self.batch_size, len(object_tags)))
+        for ok, reason, _, _ in self.sm.mass_transition(
+                [(object_tag, self._next_state(object_tag), DEF_TAG, None) for object_tag in object_tags]):
+            if not ok:
+                raise Exception(reason)
+
+    def _op_get_history(self, object_tags, rand):
+        self.sm.get_history(rand.choice(object_tags), DEF_TAG)
+
+    def _op_get_history_last(self, object_tags, rand):
+        self.sm.get_history(rand.choice(object_tags), DEF_TAG, HISTORY_LAST, newest_first=True)
+
+    def _op_get_current_state_info(self, object_tags, rand):
+        self.sm.get_current_state_info(rand.choice(object_tags), DEF_TAG)
+
+    def _worker(self, worker_id, object_tags, ops):
+        """ Runs ops operations on a subset of objects no other worker uses so that transitions never conflict.
+        """
+        rand = Random(self.seed + worker_id)
+        func = getattr(self, '_op_{}'.format(self.scenario))
+        latencies = []
+        errors = 0
+
+        for _ in range(ops):
+            start = time()
+            try:
+                func(object_tags, rand)
+            except Exception:
+                errors += 1
+            else:
+                latencies.append(time() - start)
+
+        with self.lock:
+            self.latencies.extend(latencies)
+            self.errors += errors
+
+    def run(self):
+        self.preload()
+
+        workers = []
+        concurrency = min(self.concurrency, self.objects)
+        ops_per_worker, ops_left = divmod(self.ops, concurrency)
+
+        for worker_id in range(concurrency):
+            object_tags = self.object_tags[worker_id::concurrency]
+            ops = ops_per_worker + (1 if worker_id < ops_left else 0)
+            workers.append(Thread(target=self._worker, args=(worker_id, object_tags, ops)))
+
+        start = time()
+
+        for worker in workers:
+            worker.start()
+
+        for worker in workers:
+            worker.join()
+
+        duration = time() - start
+
+        self.latencies.sort()
+        ops_ok = len(self.latencies)
+        items_per_op = self.batch_size if self.scenario == 'mass_transition' else 1
+
+        return {
+            'backend': self.env.name,
+            'backend_kind': self.env.kind,
+            'scenario': self.scenario,
+            'objects': self.objects,
+            'history': self.history,
+            'concurrency': concurrency,
+            'ops': ops_ok,
+            'errors': self.errors,
+            'items_per_op': items_per_op,
+            'duration_sec': round(duration, 6),
+            'ops_per_sec': round(ops_ok / duration, 2) if duration else None,
+            'items_per_sec': round(ops_ok * items_per_op / duration, 2) if duration else None,
+            'latency_p50_ms': round(percentile(self.latencies, 50) * 1000, 4) if ops_ok else None,
+            'latency_p99_ms': round(percentile(self.latencies, 99) * 1000, 4) if ops_ok else None,
+            'latency_max_ms': round(self.latencies[-1] * 1000, 4) if ops_ok else None,
+        }
+
+# ################################################################################################################################
+
+def main(args):
+    envs = []
+    for name in args.backends:
+        if name not in ENVS:
+            raise ValueError('Unknown backend `{}`, expected one of `{}`'.format(name, sorted(ENVS)))
+        envs.append(ENVS[name](args))
+
+    for scenario in args.scenarios:
+        if scenario not in SCENARIOS:
+            raise ValueError('Unknown scenario `{}`, expected one of `{}`'.format(scenario, SCENARIOS))
+
+    results = []
+
+    # Most of the setup cost is in preloading histories so these are the outer loops.
+    for env in envs:
+        try:
+            for objects in args.objects:
+                for history in args.history:
+                    for concurrency in args.concurrency:
+                        for scenario in args.scenarios:
+                            result = Run(env, scenario, objects, history, concurrency, args).run()
+                            results.append(result)
+
+                            if not args.quiet:
+                                sys.stderr.write(
+                                    '{backend:<6} {scenario:<23} objects:{objects:<7} history:{history:<5} '
+                                    'concurrency:{concurrency:<3} ops/s:{ops_per_sec:<10} p50:{latency_p50_ms}ms '
+                                    'p99:{latency_p99_ms}ms errors:{errors}\n'.format(**result))
+        finally:
+            env.close()
+
+    out = {
+        'meta': {
+            'created_utc': datetime.utcnow().isoformat(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'args': {
+                'backends': args.backends,
+                'scenarios': args.scenarios,
+                'objects': args.objects,
+                'history': args.history,
+                'concurrency': args.concurrency,
+                'ops': args.ops,
+                'batch_size': args.batch_size,
+                'seed': args.seed,
+            },
+        },
+        'results': results,
+    }
+
+    out = dumps(out, indent=2, sort_keys=True)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(out)
+    else:
+        print(out)
+
+# ################################################################################################################################
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Benchmarks BST backends and outputs results in JSON')
+
+    parser.add_argument('--backends', type=csv_strs, help='Backends to benchmark', default=sorted(ENVS))
+    parser.add_argument('--scenarios', type=csv_strs, help='What to benchmark', default=list(SCENARIOS))
+    parser.add_argument('--objects', type=csv_ints, help='Numbers of objects to run against', default=[1000])
+    parser.add_argument('--history', type=csv_ints, help='Lengths of history each object has', default=[1, 50])
+    parser.add_argument('--concurrency', type=csv_ints, help='Numbers of threads to run operations in', default=[1, 4])
+    parser.add_argument('--ops', type=int, help='How many operations to run in each benchmark', default=2000)
+    parser.add_argument('--batch_size', type=int, help='How many objects to transition in one mass_transition', default=100)
+    parser.add_argument('--seed', type=int, help='Seed of the random generator', default=1)
+    parser.add_argument('--redis_url', type=str, help='Redis server to connect to, fakeredis is used if not given')
+    parser.add_argument('--sql_url', type=str, help='SQLAlchemy URL of a database to use, it will be dropped and recreated. '
+        'A temporary SQLite file is used if not given.')
+    parser.add_argument('--output', type=str, help='File to write JSON results to, stdout is used if not given')
+    parser.add_argument('--quiet', action='store_true', help='Do not print progress to stderr')
+
+    main(parser.parse_args())
@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+# Part of Zato - Open-Source ESB, SOA, REST, APIs and Cloud Integrations in Python
+# https://zato.io
+
+""" Measures how much memory a Redis server needs to keep current states of objects in a single hash per definition
+and in buckets of small hashes, as RedisBackend does with current_buckets, and outputs results in JSON.
+
+Redis keeps a hash in its compact encoding only as long as it has no more than hash-max-ziplist-entries fields
+and none of its values is longer than hash-max-ziplist-value bytes (hash-max-listpack-* since Redis 7). Current states
+are usually longer than the default of 64 bytes, which is why --hash_max_entries and --hash_max_value can be given
+to change both settings on the server before measuring. With 0 as the number of buckets, enough of them are used
+for each to hold --hash_max_entries objects at most.
+
+Only current states are written, history and indexes of objects are the same in either layout. The database
+that --redis_url points to is flushed before and after each run.
+
+Usage: python bench/bench_memory.py --redis_url redis://localhost:6379/15 --objects 1000000,10000000,50000000 \\
+    --layouts single,1024,0 --hash_max_entries 512 --hash_max_value 512 --output out.json
+"""
+
+# stdlib
+import argparse
+import platform
+import sys
+from datetime import datetime, timedelta
+from json import dumps
+from time import time
+
+# Redis
+import redis
+
+# Zato
+from zato.bst import CONST, RedisBackend
+
+# ################################################################################################################################
+
+DEF_TAG = 'Orders.v1'
+
+# Layout with all current states of a definition in one hash
+LAYOUT_SINGLE = 'single'
+
+# Names of settings of compact encoding of hashes before and since Redis 7
+HASH_MAX_ENTRIES = ('hash-max-ziplist-entries', 'hash-max-listpack-entries')
+HASH_MAX_VALUE = ('hash-max-ziplist-value', 'hash-max-listpack-value')
+
+# ################################################################################################################################
+
+def get_state_info(idx, start=datetime(2016, 1, 1)):
+    """ Returns a serialized transition, as StateMachine creates them, that an object ends up in.
+    """
+    object_tag = 'order.{}'.format(idx)
+
+    return object_tag, dumps({
+        'state_old': 'new',
+        'state_current': 'submitted',
+        'object_tag': object_tag,
+        'def_tag': DEF_TAG,
+        'transition_ts_utc': (start + timedelta(seconds=idx)).isoformat(),
+        'deadline_utc': None,
+        'server_ctx': 'server1',
+        'user_ctx': None,
+        'is_forced': False
+    })
+
+def csv_ints(value):
+    return [int(elem) for elem in value.split(',') if elem.strip()]
+
+def csv_strs(value):
+    return [elem.strip() for elem in value.split(',') if elem.strip()]
+
+# ################################################################################################################################
+
+def set_config(conn, names, value):
+    """ Sets the first of names of a setting that the server knows of.
+    """
+    for name in names:
+        if conn.config_get(name):
+            conn.config_set(name, value)
+            return
+
+def get_config(conn, names):
+    for name in names:
+        value = conn.config_get(name)
+        if value:
+            return int(value[name])
+
+# ################################################################################################################################
+
+class Run(object):
+    """ Fills a Redis database with current states of objects in a given layout and measures how much memory they take.
+    """
+    def __init__(self, conn, layout, objects, args):
+        self.conn = conn
+        self.objects = objects
+        self.codec = args.codec
+        self.batch_size = args.batch_size
+
+        if layout == LAYOUT_SINGLE:
+            self.buckets = 0
+        else:
+            self.buckets = int(layout) or -(-objects // get_config(conn, HASH_MAX_ENTRIES))
+
+        self.layout = layout
+        self.backend = RedisBackend(conn, codec=self.codec, current_buckets=self.buckets)
+
+    def fill(self):
+
+        # Records are written as the backend would store them, without history and indexes that do not depend on the layout
+        pipe = self.conn.pipeline(False)
+
+        for idx in range(self.objects):
+            object_tag, state_info = get_state_info(idx)
+            pipe.hset(self.backend._get_current_key(DEF_TAG, object_tag), object_tag, self.backend._encode(state_info))
+
+            if (idx + 1) % self.batch_size == 0:
+                pipe.execute()
+
+        pipe.execute()
+
+    def run(self):
+        self.conn.flushdb()
+        used_memory_before = self.conn.info('memory')['used_memory']
+
+        start = time()
+        self.fill()
+        elapsed = time() - start
+
+        used_memory = self.conn.info('memory')['used_memory'] - used_memory_before
+        key = self.backend._get_current_key(DEF_TAG, get_state_info(0)[0])
+
+        out = {
+            'layout': self.layout,
+            'buckets': self.buckets,
+            'objects': self.objects,
+            'codec': self.codec,
+            'used_memory_bytes': used_memory,
+            'bytes_per_object': round(used_memory / self.objects, 2),
+            'encoding': self.conn.object('encoding', key),
+            'fill_seconds': round(elapsed, 2),
+        }
+
+        self.conn.flushdb()
+
+        return out
+
+# ################################################################################################################################
+
+def main(args):
+
+    conn = redis.Redis.from_url(args.redis_url)
+
+    if args.hash_max_entries:
+        set_config(conn, HASH_MAX_ENTRIES, args.hash_max_entries)
+
+    if args.hash_max_value:
+        set_config(conn, HASH_MAX_VALUE, args.hash_max_value)
+
+    results = []
+
+    for objects in args.objects:
+        for layout in args.layouts:
+            result = Run(conn, layout, objects, args).run()
+            results.append(result)
+
+            if not args.quiet:
+                sys.stderr.write(
+                    'layout:{layout:<7} buckets:{buckets:<7} objects:{objects:<9} codec:{codec:<8} '
+                    'bytes/object:{bytes_per_object:<8} encoding:{encoding:<10} fill:{fill_seconds}s\n'.format(**result))
+
+    out = {
+        'meta': {
+            'created_utc': datetime.utcnow().isoformat(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'redis_version': conn.info('server')['redis_version'],
+            'hash_max_entries': get_config(conn, HASH_MAX_ENTRIES),
+            'hash_max_value': get_config(conn, HASH_MAX_VALUE),
+            'args': {
+                'objects': args.objects,
+                'layouts': args.layouts,
+                'codec': args.codec,
+                'batch_size': args.batch_size,
+            },
+        },
+        'results': results,
+    }
+
+    out = dumps(out, indent=2, sort_keys=True)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(out)
+    else:
+        print(out)
+
+# ################################################################################################################################
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Measures memory Redis needs for BST current states in each layout')
+
+    parser.add_argument('--redis_url', type=str, help='Redis server to connect to, its database is flushed', required=True)
+    parser.add_argument('--objects', type=csv_ints, help='Numbers of objects to measure',
+        default=[1000000, 10000000, 50000000])
+    parser.add_argument('--layouts', type=csv_strs,
+        help='Layouts to compare - `single` for one hash per definition or numbers of buckets, 0 to work them out',
+        default=[LAYOUT_SINGLE, '1024', '0'])
+    parser.add_argument('--codec', type=str, help='What to encode current states with',
+        choices=(CONST.RECORD_CODEC_JSON, CONST.RECORD_CODEC_MSGPACK), default=CONST.RECORD_CODEC_JSON)
+    parser.add_argument('--batch_size', type=int, help='How many fields to write in one pipeline', default=10000)
+    parser.add_argument('--hash_max_entries', type=int, help='hash-max-ziplist-entries to set on the server before measuring')
+    parser.add_argument('--hash_max_value', type=int, help='hash-max-ziplist-value to set on the server before measuring')
+    parser.add_argument('--output', type=str, help='File to write JSON results to, stdout is used if not given')
+    parser.add_argument('--quiet', action='store_true', help='Do not print progress to stderr')
+
+    main(parser.parse_args())
@@ -7,12 +7,18 @@ from __future__ import absolute_import, division, print_function, unicode_litera
 
 # zato-labs
 try:
-    from zato_bst_core import AddEdgeResult, ConfigItem, CONST, Definition, Node, parse_pretty_print, RedisBackend, \
-         setup_server_config, SQLBackend, StateBackendBase, StateMachine, TransitionError, transition_to, yield_definitions
+    from zato_bst_core import AddEdgeResult, CachingBackend, ConfigItem, CONST, DeadlineScheduler, decode_record, Definition, \
+         encode_record, filter_history, HashRing, HistoryCompactor, iter_json_items, Node, parse_duration, parse_pretty_print, \
+         parse_ts, RedisBackend, setup_server_config, ShardedRedisBackend, SQLBackend, StateBackendBase, StateMachine, \
+         TransitionConflictError, TransitionError, transition_to, yield_definitions
 except ImportError:
-    from zato.bst.core import AddEdgeResult, ConfigItem, CONST, Definition, Node, parse_pretty_print, RedisBackend, \
-         setup_server_config, SQLBackend, StateBackendBase, StateMachine, TransitionError, transition_to, yield_definitions
+    from zato.bst.core import AddEdgeResult, CachingBackend, ConfigItem, CONST, DeadlineScheduler, decode_record, Definition, \
+         encode_record, filter_history, HashRing, HistoryCompactor, iter_json_items, Node, parse_duration, parse_pretty_print, \
+         parse_ts, RedisBackend, setup_server_config, ShardedRedisBackend, SQLBackend, StateBackendBase, StateMachine, \
+         TransitionConflictError, TransitionError, transition_to, yield_definitions
 
 # For flake8
-AddEdgeResult, ConfigItem, CONST, Definition, Node, parse_pretty_print, RedisBackend
-setup_server_config, SQLBackend, StateBackendBase, StateMachine, TransitionError, transition_to, yield_definitions
+AddEdgeResult, CachingBackend, ConfigItem, CONST, DeadlineScheduler, decode_record, Definition, encode_record, filter_history
+HashRing, HistoryCompactor, iter_json_items, Node, parse_duration, parse_pretty_print, parse_ts, RedisBackend, setup_server_config
+ShardedRedisBackend, SQLBackend, StateBackendBase, StateMachine, TransitionConflictError, TransitionError, transition_to
+yield_definitions
@@ -6,11 +6,25 @@ from __future__ import absolute_import, division, print_function, unicode_litera
 # https://zato.io
 
 # stdlib
+from calendar import timegm
+from bisect import bisect
+from collections import namedtuple, OrderedDict
+from contextlib import contextmanager
 from copy import deepcopy
 from cStringIO import StringIO
-from datetime import datetime
+from datetime import datetime, timedelta
+from hashlib import md5
 from logging import getLogger
+from operator import itemgetter
+from random import uniform
+from sqlite3 import sqlite_version_info
+from struct import unpack
+from threading import RLock, Thread
+from time import sleep, time
+from traceback import format_exc
 from uuid import uuid4
+from zlib import crc32
+import gzip
 import os
 
 # Arrow
@@ -22,25 +36,40 @@ from bunch import Bunch
 # ConfigObj
 from configobj import ConfigObj
 
+# msgpack
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
 # pyrapidjson
 from rapidjson import dumps, loads
 
 # PyTZ
 import pytz
 
+# Redis
+from redis import ResponseError, WatchError
+
 # SQLAlchemy
-from sqlalchemy import orm
+from sqlalchemy import and_, bindparam, func, literal, or_, orm, select, text
+from sqlalchemy.exc import IntegrityError
 
 # zato-labs
 try:
-    from zato_bst_sql import Item, label, SubGroup
+    from zato_bst_sql import BSTEdgeCount, BSTEvent, BSTEventCounter, BSTHistory, BSTState, BSTStateCount, get_lookup_key, Item, \
+         label, SubGroup
 except ImportError:
-    from zato.bst.sql import Item, label, SubGroup
+    from zato.bst.sql import BSTEdgeCount, BSTEvent, BSTEventCounter, BSTHistory, BSTState, BSTStateCount, get_lookup_key, Item, \
+         label, SubGroup
 
 # ################################################################################################################################
 
 logger = getLogger(__name__)
 
+# A marker of values not found in caches, which can legitimately hold None
+_MISSING = object()
+
 # ################################################################################################################################
 
 def get_session(engine):
@@ -55,17 +84,39 @@ class CONST:
     DEFAULT_DIAG_DT_FORMAT = '%a %d/%m/%y %H:%M:%S'
     DEFAULT_DIAG_TZ = 'UTC'
     DEFAULT_GRAPH_VERSION = 1
+    SQL_IN_CHUNK_SIZE = 500 # How many values at most to use in a single SQL IN clause
+    SQL_MAX_ATTEMPTS = 3 # How many times at most to run an SQL transaction that conflicts with concurrent ones on unique keys
+    WATCH_MAX_ATTEMPTS = 10 # How many times at most to run a Redis transaction aborted because watched keys changed
+    WATCH_BACKOFF = 0.01 # Up to how many seconds, times the number of attempts so far, to wait before the next attempt
+    TRANSITION_MAX_ATTEMPTS = 5 # How many times at most to validate a transition again if the object changed in the meantime
     PRETTY_PRINT_REPLACE = {
         'Force stop:': 'force_stop=',
         'Objects:': 'objects=',
         'Version:': 'version=',
+        'Max history:': 'max_history=',
+        'Max history age:': 'max_history_age=',
+        'Compact on stop:': 'compact_on_stop=',
+        'Timeout:': 'timeout=',
+        'Timeout target:': 'timeout_target=',
     }
+    DURATION_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800}
+    STATS_MINUTE_FORMAT = '%Y-%m-%dT%H:%M'
+    STATS_TTL = 86400 # For how many seconds counters of transitions in each minute are kept
+    EVENTS_MAX_LEN = 100000 # About how many of the latest events of transitions are kept for each definition
+    TRUE_VALUES = ('1', 'true', 'yes', 'on')
+    RECORD_CODEC_JSON = 'json'
+    RECORD_CODEC_MSGPACK = 'msgpack'
+    RECORD_MSGPACK_PREFIX = b'\x02' # Marks records in msgpack, which is version 2 of the format, JSON ones begin with '{'
 
 # ################################################################################################################################
 
 class TransitionError(Exception):
     pass
 
+class TransitionConflictError(TransitionError):
+    """ Raised if an object was transitioned by someone else after a transition of it was validated but before it was saved.
+    """
+
 # ################################################################################################################################
 
 def validate_from_to(func):
@@ -117,6 +168,250 @@ def parse_pretty_print(value):
 
 # ################################################################################################################################
 
+def chunks(items, size):
+    """ Yields consecutive slices of a list, each with at most size elements.
+    """
+    for idx in xrange(0, len(items), size):
+        yield items[idx:idx+size]
+
+# ################################################################################################################################
+
+def parse_ts(value):
+    """ Returns a datetime object out of an ISO-8601 timestamp such as transition_ts_utc, unless it already is one.
+    """
+    if value is None or isinstance(value, datetime):
+        return value
+    return datetime.strptime(value, '%Y-%m-%dT%H:%M:%S.%f' if '.' in value else '%Y-%m-%dT%H:%M:%S')
+
+def encode_record(state_info, codec=CONST.RECORD_CODEC_JSON):
+    """ Serializes a transition, given as a dictionary, to a record encoded with either JSON or msgpack.
+    """
+    if codec == CONST.RECORD_CODEC_MSGPACK:
+        return CONST.RECORD_MSGPACK_PREFIX + msgpack.packb(state_info, use_bin_type=True)
+    return dumps(state_info)
+
+def decode_record(data):
+    """ Returns a transition, as a dictionary, out of a record in any of the formats encode_record produces.
+    """
+    if data[:1] == CONST.RECORD_MSGPACK_PREFIX:
+        if not msgpack:
+            raise ValueError('Cannot decode a msgpack record, msgpack is not installed')
+        return msgpack.unpackb(data[1:], raw=False)
+    return loads(data)
+
+def is_record_in(data, codec):
+    """ Returns True if a record is encoded with a given codec.
+    """
+    return (data[:1] == CONST.RECORD_MSGPACK_PREFIX) == (codec == CONST.RECORD_CODEC_MSGPACK)
+
+def to_json_record(data):
+    """ Returns a record as JSON, decoding and encoding it again only if it is in another format.
+    """
+    return data if is_record_in(data, CONST.RECORD_CODEC_JSON) else dumps(decode_record(data))
+
+def get_transition_ts(state_info):
+    """ Returns transition_ts_utc of a serialized transition as a datetime object.
+    """
+    return parse_ts(decode_record(state_info)['transition_ts_utc'])
+
+def filter_history(history, limit=None, offset=0, since_ts=None, until_ts=None, newest_first=False):
+    """ Returns a page of a list of serialized transitions ordered from the oldest one, in the same way backends do it
+    in get_history. Transitions from since_ts, inclusive, until until_ts, exclusive, are returned.
+    """
+    since_ts, until_ts = parse_ts(since_ts), parse_ts(until_ts)
+
+    if since_ts or until_ts:
+        history = [elem for elem in history if is_in_range(get_transition_ts(elem), since_ts, until_ts)]
+
+    if newest_first:
+        history = history[::-1]
+
+    offset = offset or 0
+    return history[offset:offset+limit if limit is not None else None]
+
+def get_ts_score(ts):
+    """ Returns a datetime object as a number of seconds since the epoch, e.g. to be used as a score in Redis sorted sets.
+    """
+    return timegm(ts.utctimetuple()) + ts.microsecond / 1000000.0
+
+def get_state_cursor(position, object_tag):
+    """ Returns a cursor pointing to an object in a page of objects in a given state.
+    """
+    return '{}|{}'.format(position, object_tag)
+
+def parse_state_cursor(cursor):
+    """ Returns a position and object_tag out of a cursor from get_state_cursor.
+    """
+    return cursor.split('|', 1)
+
+def get_minute(ts):
+    """ Returns a datetime object truncated to a minute.
+    """
+    return ts.replace(second=0, microsecond=0)
+
+def iter_minutes(since_ts, until_ts):
+    """ Yields each minute from since_ts until until_ts, both inclusive, as datetime objects.
+    """
+    minute = get_minute(since_ts)
+    while minute <= until_ts:
+        yield minute
+        minute += timedelta(minutes=1)
+
+def get_edge_name(state_old, state_new):
+    """ Returns a name of an edge that a transition went along, with an empty string for objects that had no state before.
+    State names never contain newlines so they can be used to separate the two unambiguously.
+    """
+    return '{}\n{}'.format(state_old or '', state_new)
+
+def parse_edge_name(name):
+    """ Returns state_old and state_new out of a name from get_edge_name.
+    """
+    state_old, state_new = name.split('\n', 1)
+    return state_old or None, state_new
+
+def report_progress(old_def_tag, new_def_tag, what, count, pause=0, on_progress=None):
+    """ Reports how many of what has been moved so far while renaming a definition and waits for pause seconds.
+    """
+    logger.info('Renaming `%s` to `%s`, moved `%s` %s', old_def_tag, new_def_tag, count, what)
+
+    if on_progress:
+        on_progress(what, count)
+
+    if pause:
+        sleep(pause)
+
+def get_state_index_entry(state_info):
+    """ Returns a tuple of an object's current state, the time it entered it and the deadline of the state, if any,
+    out of a deserialized transition, in the format SQLBackend._set_state_index expects.
+    """
+    return state_info['state_current'], parse_ts(state_info['transition_ts_utc']), parse_ts(state_info.get('deadline_utc'))
+
+def get_state_version(state_info):
+    """ Returns a version stamp of a deserialized current state or None if there is no state. Versions are numbers
+    of transitions an object has had, counted from 1, or 0 for states stored before they were kept.
+    """
+    return (state_info.get('version') or 0) if state_info else None
+
+def set_state_version(state_info, version):
+    """ Returns a serialized transition stamped with the version that follows a given one of the current state.
+    """
+    info = loads(state_info)
+    info['version'] = (version or 0) + 1
+    return dumps(info)
+
+def set_state_versions(state_infos, versions):
+    """ Same as set_state_version but for a list of (object_tag, state_info) tuples and a dictionary of object tags
+    to versions of their current states. Each further transition of an object is stamped one version above the previous one.
+    """
+    versions = dict(versions)
+    out = []
+
+    for object_tag, state_info in state_infos:
+        out.append((object_tag, set_state_version(state_info, versions[object_tag])))
+        versions[object_tag] = (versions[object_tag] or 0) + 1
+
+    return out
+
+def iter_json_items(data):
+    """ Returns an iterable of items of a JSON array or, if data is not one, of newline-delimited JSON, parsed one line
+    at a time. A JSON array is parsed at once and raises ValueError if it is not valid, whereas lines that are not valid JSON
+    are yielded as ValueError instances so that the rest of them can still be processed.
+    """
+    if data.lstrip().startswith('['):
+        return loads(data)
+
+    return _iter_ndjson_items(data)
+
+def _iter_ndjson_items(data):
+    """ Yields items of newline-delimited JSON, one line at a time, and ValueError instances in place of invalid lines.
+    """
+    start = 0
+    line_no = 0
+
+    while start < len(data):
+        end = data.find('\n', start)
+        end = len(data) if end == -1 else end
+
+        line = data[start:end].strip()
+        start = end + 1
+        line_no += 1
+
+        if line:
+            try:
+                yield loads(line)
+            except ValueError:
+                yield ValueError('Invalid JSON in line {}'.format(line_no))
+
+def get_bulk_result(can_transition, reason, state_old=None, state_new=None):
+    """ Returns a result of a single transition in the format labs.proc.bst.transition returns it in.
+    """
+    return {'can_transition': can_transition, 'reason': reason, 'state_old': state_old, 'state_new': state_new}
+
+def get_event(id, object_tag, state_info):
+    """ Returns an event of a transition, as read by consumers, out of its ID and the transition serialized to JSON.
+    """
+    return {'id': id, 'object_tag': object_tag, 'state_info': loads(state_info)}
+
+def get_stats_deltas(state_infos):
+    """ Returns a dictionary of states to changes in the number of objects in each and a dictionary of (minute, edge) tuples
+    to numbers of transitions along each edge, out of a list of deserialized transitions.
+    """
+    states = {}
+    edges = {}
+
+    for state_info in state_infos:
+        state_old, state_new = state_info.get('state_old'), state_info['state_current']
+
+        if state_old != state_new:
+            if state_old is not None:
+                states[state_old] = states.get(state_old, 0) - 1
+            states[state_new] = states.get(state_new, 0) + 1
+
+        key = get_minute(parse_ts(state_info['transition_ts_utc'])), get_edge_name(state_old, state_new)
+        edges[key] = edges.get(key, 0) + 1
+
+    return dict((state, delta) for state, delta in states.items() if delta), edges
+
+def get_stats_out(states, edges):
+    """ Returns statistics of a definition out of a dictionary of states to numbers of objects in each
+    and a dictionary of (minute, edge) tuples to numbers of transitions along each edge.
+    """
+    transitions = []
+
+    for (minute, edge), count in sorted(edges.items()):
+        state_old, state_new = parse_edge_name(edge)
+        transitions.append({
+            'minute': minute.strftime(CONST.STATS_MINUTE_FORMAT),
+            'state_old': state_old,
+            'state_new': state_new,
+            'count': count,
+        })
+
+    return {'states': states, 'transitions': transitions}
+
+def parse_duration(value):
+    """ Returns a number of seconds out of a duration such as 90s, 15m, 12h, 30d or 2w. Plain numbers are seconds.
+    """
+    value = value.strip().lower()
+    unit = CONST.DURATION_UNITS.get(value[-1:])
+
+    if unit:
+        return int(value[:-1].strip()) * unit
+
+    return int(value)
+
+def glob_escape(value):
+    """ Escapes characters that have special meaning in Redis glob-style patterns.
+    """
+    return ''.join('[{}]'.format(char) if char in '*?[' else char for char in value)
+
+def is_in_range(ts, since_ts, until_ts):
+    """ Returns True if ts is within a half-open range of time, either end of which may be None.
+    """
+    return (since_ts is None or ts >= since_ts) and (until_ts is None or ts < until_ts)
+
+# ################################################################################################################################
+
 def yield_definitions(service):
 
     bst_dir = os.path.join(service.server.base_dir, 'config', 'repo', 'proc', 'bst')
@@ -137,8 +432,21 @@ def setup_server_config(service):
         item.parse_config_dict({name:data})
         config[item.def_.tag] = item
 
-    service.server.user_ctx.zato_state_machine = StateMachine(
-        config, SQLBackend(get_session(service.server.odb.pool.engine), service.server.cluster_id))
+    # Each operation of the backend uses a session of its own so that concurrent requests do not share one
+    backend = SQLBackend(orm.sessionmaker(bind=service.server.odb.pool.engine), service.server.cluster_id)
+
+    # Current states are cached only if enabled in the [bst] section of server.conf, e.g. cache=true, cache_ttl=60 and
+    # cache_max_size=10000, in which case writes are announced to other server processes through the server's Redis.
+    bst_config = (getattr(service.server, 'fs_server_config', None) or {}).get('bst') or {}
+
+    if unicode(bst_config.get('cache', '')).strip().lower() in CONST.TRUE_VALUES:
+        options = dict((name, int(bst_config[key])) for name, key in (('ttl', 'cache_ttl'), ('max_size', 'cache_max_size'))
+            if key in bst_config)
+
+        backend = CachingBackend(backend, conn=service.server.kvdb.conn, **options)
+        backend.start_listener()
+
+    service.server.user_ctx.zato_state_machine = StateMachine(config, backend)
 
 # ################################################################################################################################
 
@@ -236,7 +544,7 @@ class Definition(object):
     def roots(self):
         """ All nodes that have no parents.
         """
-        if not self._roots:
+        if self._roots is None:
             self._roots = sorted(set(self.nodes) - self._non_root)
         return self._roots
 
@@ -244,6 +552,7 @@ class Definition(object):
         """ Adds a new node by name and opaque data it contains.
         """
         self.nodes[name] = Node(name, data)
+        self._roots = None
 
     @validate_from_to
     def add_edge(self, from_, to):
@@ -254,6 +563,7 @@ class Definition(object):
 
         # So that we know 'to' is not one of roots seeing as at least one node leads to it
         self._non_root.add(to)
+        self._roots = None
 
         # Result OK
         return True
@@ -264,6 +574,58 @@ class Definition(object):
         """
         return self.nodes[from_].has_edge(to)
 
+    def compile(self, force_stop=()):
+        """ Returns an immutable CompiledDefinition out of the current nodes and edges, along with states that
+        objects can be always stopped in, which need not be nodes in the graph.
+        """
+        names = sorted(self.nodes)
+        names.extend(sorted(set(force_stop) - set(names)))
+        ids = dict((name, idx) for idx, name in enumerate(names))
+
+        edges = []
+        sources = [[] for name in names]
+
+        for idx, name in enumerate(names):
+            mask = 0
+            if name in self.nodes:
+                for to in self.nodes[name].edges:
+                    mask |= 1 << ids[to]
+                    sources[ids[to]].append(name)
+            edges.append(mask)
+
+        nodes_mask = sum(1 << ids[name] for name in self.nodes)
+        roots_mask = sum(1 << ids[name] for name in self.roots)
+        force_stop_mask = sum(1 << ids[name] for name in set(force_stop))
+
+        return CompiledDefinition(self.tag, tuple(names), ids, tuple(edges), tuple(tuple(elem) for elem in sources),
+            tuple(self.roots), nodes_mask, roots_mask, force_stop_mask)
+
+# ################################################################################################################################
+
+class CompiledDefinition(namedtuple('CompiledDefinitionBase',
+        'tag names ids edges sources root_names nodes_mask roots_mask force_stop_mask')):
+    """ An immutable form of a Definition, built by Definition.compile. States are mapped to consecutive integers and
+    edges leading out of each state, as well as sets of roots, nodes and force-stop states, are kept as bitmasks.
+    """
+    __slots__ = ()
+
+    def get_id(self, name):
+        """ Returns an integer ID of a state or None if there is no such state.
+        """
+        return self.ids.get(name)
+
+    def has_edge(self, from_id, to_id):
+        return bool(self.edges[from_id] >> to_id & 1)
+
+    def is_node(self, id):
+        return bool(self.nodes_mask >> id & 1)
+
+    def is_root(self, id):
+        return bool(self.roots_mask >> id & 1)
+
+    def is_force_stop(self, id):
+        return bool(self.force_stop_mask >> id & 1)
+
 # ################################################################################################################################
 
 class ConfigItem(object):
@@ -275,6 +637,10 @@ class ConfigItem(object):
         self.force_stop = []
         self.def_config = {}
         self.orig_config = {}
+        self.compiled = None
+        self.retention = Bunch(max_history=None, max_history_age=None, compact_on_stop=False)
+        self.timeouts = {} # State -> for how many seconds objects may stay in it
+        self.timeout_target = None # State that objects are moved to once they stay in a state for too long
 
     def _add_nodes_edges(self, config, add_nodes=True):
         for from_, to in config[self.def_.name].items():
@@ -295,6 +661,62 @@ class ConfigItem(object):
             item = [item]
         getattr(self, attr).extend(item)
 
+    def _set_retention(self, config):
+        """ Reads optional settings of how much history of each object is to be kept.
+        """
+        config = config[self.def_.name]
+
+        max_history = config.pop('max_history', None)
+        max_history_age = config.pop('max_history_age', None)
+        compact_on_stop = config.pop('compact_on_stop', None)
+
+        self.retention.max_history = int(max_history) if max_history else None
+        self.retention.max_history_age = parse_duration(max_history_age) if max_history_age else None
+        self.retention.compact_on_stop = (compact_on_stop or '').strip().lower() in CONST.TRUE_VALUES
+
+    def _set_timeouts(self, config):
+        """ Reads optional timeouts of states, each given as a state followed by a duration, e.g. Submitted 2h,
+        along with the state that objects are moved to once they time out.
+        """
+        config = config[self.def_.name]
+
+        timeouts = config.pop('timeout', [])
+        if not isinstance(timeouts, list):
+            timeouts = [timeouts]
+
+        for item in timeouts:
+            state, _, duration = item.strip().rpartition(' ')
+            if not state.strip():
+                raise ValueError('Timeout `{}` of `{}` is not a state followed by a duration'.format(item, self.def_.name))
+            self.timeouts[state.strip()] = parse_duration(duration)
+
+        self.timeout_target = config.pop('timeout_target', None)
+
+        if self.timeouts and not self.timeout_target:
+            raise ValueError('Timeouts of `{}` require a timeout target'.format(self.def_.name))
+
+    def _validate_timeouts(self):
+        """ Makes sure that timeouts refer to states that exist.
+        """
+        for state in sorted(self.timeouts):
+            if state not in self.def_.nodes:
+                raise ValueError('Timeout of `{}` refers to an unknown state `{}`'.format(self.def_.name, state))
+
+        if self.timeout_target and self.timeout_target not in self.def_.nodes and self.timeout_target not in self.force_stop:
+            raise ValueError('Timeout target of `{}` is an unknown state `{}`'.format(self.def_.name, self.timeout_target))
+
+    def get_deadline(self, state, transition_ts):
+        """ Returns the time an object entering a given state at transition_ts will time out, or None if it never will.
+        """
+        timeout = self.timeouts.get(state)
+        if timeout:
+            return transition_ts + timedelta(seconds=timeout)
+
+    def has_retention(self):
+        """ Returns True if history of objects in this definition is not to be kept forever.
+        """
+        return bool(self.retention.max_history is not None or self.retention.max_history_age or self.retention.compact_on_stop)
+
     def parse_config_dict(self, orig_config):
 
         # So that the original, possibly still kept in a service's self.user_config, is not modified
@@ -316,13 +738,27 @@ class ConfigItem(object):
         self._extend_list(self.def_config, 'objects')
         self._extend_list(self.def_config, 'force_stop')
 
+        # Retention settings are optional as well, and so are timeouts
+        self._set_retention(self.def_config)
+        self._set_timeouts(self.def_config)
+
         # Collect nodes and edges
         self._add_nodes_edges(self.def_config)
         self._add_nodes_edges(self.def_config, False)
 
+        self._validate_timeouts()
+
         # Set correct tag
         self.def_.tag = Definition.get_tag(self.def_.name, self.def_.version)
 
+        # Run-time form of the definition
+        self.compile()
+
+    def compile(self):
+        """ Compiles the definition, which needs to be done each time it changes.
+        """
+        self.compiled = self.def_.compile(self.force_stop)
+
     def parse_config_ini(self, data):
 
         # Parse string as a list of lines and turn it into config
@@ -333,8 +769,17 @@ class ConfigItem(object):
 class StateBackendBase(object):
     """ An abstract object defining the API for state backend implementations to follow.
     """
-    def rename_def(self, old_def_name, old_def_version, new_def_name, new_def_version):
-        """ Renames a definition in place, possibly including its version.
+    # Whether transition_atomic can be used
+    supports_atomic_transition = False
+
+    def rename_def(self, old_def_name, old_def_version, new_def_name, new_def_version, batch_size=1000, pause=0,
+            on_progress=None):
+        """ Renames a definition in place, possibly including its version, moving all its objects in batches of batch_size,
+        pausing for pause seconds after each. If given, on_progress is called after each batch with the name of what is
+        being moved and how many of it have been moved so far. Raises ValueError if the new definition already has objects.
+        History is moved as it is, i.e. its transitions keep the def_tag they were made in. Returns the number of objects moved.
+        Other definitions can be transitioned as usual but objects of the one renamed must not be until it is done,
+        i.e. servers must stop transitioning them first. Backends raise ValueError if they find they still are.
         """
         raise NotImplementedError('Must be implemented in subclasses')
 
@@ -343,8 +788,10 @@ class StateBackendBase(object):
         """
         raise NotImplementedError('Must be implemented in subclasses')
 
-    def get_history(self, object_tag, def_tag):
-        """ Returns history of transitions for a given object.
+    def get_history(self, object_tag, def_tag, limit=None, offset=0, since_ts=None, until_ts=None, newest_first=False):
+        """ Returns history of transitions for a given object, ordered from the oldest transition unless newest_first is True.
+        At most limit transitions are returned after skipping offset ones and, if given, only those from since_ts, inclusive,
+        until until_ts, exclusive.
         """
         raise NotImplementedError('Must be implemented in subclasses')
 
@@ -353,6 +800,140 @@ class StateBackendBase(object):
         """
         raise NotImplementedError('Must be implemented in subclasses')
 
+    def set_current_state_info_if(self, object_tag, def_tag, state_info, version):
+        """ Sets new state of an object only if its current state still has the version stamp, as returned by
+        get_state_version, that the caller read it with, None meaning the object had no state at all. The new state
+        is stamped with the next version. Returns True if the state was set or False if the object was transitioned
+        in the meantime or, with backends that need to, the state could not be set in a few attempts because of contention.
+        """
+        raise NotImplementedError('Must be implemented in subclasses')
+
+    def get_current_state_info_many(self, object_tags, def_tag):
+        """ Returns a dictionary of object tags to information on their current states, skipping objects that have none.
+        Subclasses should override it with a version that needs a single call to the underlying storage.
+        """
+        out = {}
+        for object_tag in object_tags:
+            state_info = self.get_current_state_info(object_tag, def_tag)
+            if state_info:
+                out[object_tag] = state_info
+
+        return out
+
+    def set_current_state_info_many(self, def_tag, state_infos):
+        """ Sets new states of objects out of a list of (object_tag, state_info) tuples, in the order they are given in.
+        Subclasses should override it with a version that needs a single call to the underlying storage.
+        """
+        for object_tag, state_info in state_infos:
+            self.set_current_state_info(object_tag, def_tag, state_info)
+
+    def set_current_state_info_many_if(self, def_tag, state_infos, versions):
+        """ Same as set_current_state_info_many but each object's transitions are set only if its current state
+        still has the version stamp given for it in a dictionary of object tags to versions, as set_current_state_info_if
+        checks it. Each transition is stamped with the version following the previous one. Returns a set of tags
+        of objects whose transitions were not set, e.g. because they were transitioned in the meantime.
+        """
+        raise NotImplementedError('Must be implemented in subclasses')
+
+    def transition_atomic(self, object_tag, def_tag, state_info, any_state, allow_none, state_sources, version=None):
+        """ Validates a transition against the current state of an object and sets the new one, both in one atomic operation.
+        state_info is a serialized transition without 'state_old' and 'version', added by the backend. Transitions are allowed
+        if any_state is True, if the object has no state yet and allow_none is True or if its current state is
+        one of state_sources. If version is given, the current state must also have that version stamp.
+        Returns a tuple of whether the transition was allowed and the state it was validated against.
+        """
+        raise NotImplementedError('Must be implemented in subclasses')
+
+    def get_objects_in_state(self, def_tag, state, limit=100, cursor=None):
+        """ Returns a page of at most limit objects currently in a given state, ordered by the time they entered it.
+        Returns a list of (object_tag, state_info) tuples and an opaque cursor to read the next page with,
+        or None if there are no more pages.
+        """
+        raise NotImplementedError('Must be implemented in subclasses')
+
+    def index_current_states(self, def_tag=None, batch_size=1000, pause=0):
+        """ Adds current states of objects, of all definitions unless def_tag is given, to the index that
+        get_objects_in_state reads from, e.g. for objects transitioned before the index was introduced.
+        Returns the number of objects indexed.
+        """
+        raise NotImplementedError('Must be implemented in subclasses')
+
+    def get_expired(self, def_tag, until_ts, limit=100):
+        """ Returns a list of at most limit (object_tag, state_info dict) tuples of objects whose current states have deadlines,
+        as set in their 'deadline_utc' keys, earlier than or equal to until_ts, ordered by the deadlines.
+        """
+        raise NotImplementedError('Must be implemented in subclasses')
+
+    def get_state_stats(self, def_tag, since_ts):
+        """ Returns a dictionary with numbers of objects in each state of a definition, under 'states', and a list of
+        numbers of transitions along each edge in each minute from since_ts on, under 'transitions'.
+        Both are counters updated along with states of objects rather than computed on demand.
+        """
+        raise NotImplementedError('Must be implemented in subclasses')
+
+    def rebuild_state_counts(self, def_tag):
+        """ Counts objects in each state of a definition anew, e.g. for objects transitioned before counters were introduced.
+        """
+        raise NotImplementedError('Must be implemented in subclasses')
+
+    def prune_state_stats(self):
+        """ Deletes counters of transitions older than the backend keeps them for, unless they expire by themselves.
+        """
+        raise NotImplementedError('Must be implemented in subclasses')
+
+    def get_events(self, def_tag, cursor=None, limit=100):
+        """ Returns a list of at most limit events of transitions in a definition, published after the one cursor points to
+        or from the oldest one kept if cursor is None, along with a cursor to read the next batch with. Each event is
+        a dictionary with 'id', 'object_tag' and 'state_info' keys. Events are published only by backends created with
+        publish_events set.
+        """
+        raise NotImplementedError('Must be implemented in subclasses')
+
+    def read_event_group(self, def_tag, group, consumer, limit=100, pending=False):
+        """ Returns a list of at most limit events, in the format get_events uses, that have not been delivered yet to any
+        consumer of a group, creating the group if needed. Each event is delivered once per group and stays pending until
+        acknowledged with ack_events. With pending set, events delivered to the consumer but not acknowledged are returned
+        instead, e.g. after it restarts.
+        """
+        raise NotImplementedError('Must be implemented in subclasses')
+
+    def ack_events(self, def_tag, group, ids):
+        """ Acknowledges events read by a consumer group so that they are no longer pending. Returns the number acknowledged.
+        """
+        raise NotImplementedError('Must be implemented in subclasses')
+
+    def prune_events(self):
+        """ Deletes events of transitions beyond the number the backend keeps, unless they are capped as they are published.
+        """
+        raise NotImplementedError('Must be implemented in subclasses')
+
+    def iter_history_objects(self, def_tag, batch_size=100):
+        """ Yields lists of at most batch_size tags of objects that have history in a given definition.
+        """
+        raise NotImplementedError('Must be implemented in subclasses')
+
+    def iter_current_states(self, def_tag, batch_size=100):
+        """ Yields lists of at most batch_size (object_tag, state_info dict) tuples of all objects that have current states
+        in a given definition, including objects whose history is still kept in the legacy format.
+        """
+        raise NotImplementedError('Must be implemented in subclasses')
+
+    def restore_objects(self, def_tag, objects):
+        """ Writes current states and history of objects as they are, out of (object_tag, state_info, history) tuples,
+        state_info being a serialized current state or None and history a list of serialized transitions appended
+        to what an object already has. Indexes of states and deadlines are updated but counters of states and transitions
+        are not and no events are published, rebuild_state_counts is to be called once all objects are restored.
+        """
+        raise NotImplementedError('Must be implemented in subclasses')
+
+    def trim_history(self, object_tag, def_tag, max_history=None, min_ts=None, on_trim=None):
+        """ Removes the oldest transitions of an object - those beyond max_history newest ones and those made before min_ts,
+        though the newest transition is always kept. If given, on_trim is called with object_tag, def_tag and a list of
+        transitions about to be removed, before they are. Returns the number of transitions removed.
+        History still kept in the legacy format is not trimmed.
+        """
+        raise NotImplementedError('Must be implemented in subclasses')
+
     def set_ctx(self, object_type, object_id, def_tag, transition_id, ctx=None):
         """ Attaches arbitrary context data to a transition.
         """
@@ -361,142 +942,3116 @@ class StateBackendBase(object):
 # ################################################################################################################################
 
 class RedisBackend(StateBackendBase):
-
+    """ Keeps current states of objects in one hash per definition and each object's history of transitions
+    in a list of its own so that each new transition is a single append rather than a rewrite of the whole history.
+    With publish_events, transitions are also added to a stream per definition, capped at about events_max_len entries,
+    in the same transactions that they are committed in.
+
+    With current_buckets, current states are spread over that many small hashes per definition instead, which Redis keeps
+    in its compact encoding as long as they stay within hash-max-ziplist-entries and hash-max-ziplist-value. While objects
+    are being moved from one layout to another, previous_buckets is the number of buckets of the layout they are moved from,
+    0 meaning a single hash - objects are read from it if they are not in the current layout yet and each write moves them.
+    """
     PATTERN_STATE_CURRENT = 'zato:bst:state:current:{}'
-    PATTERN_STATE_HISTORY = 'zato:bst:state:history:{}'
+    PATTERN_STATE_CURRENT_BUCKET = 'zato:bst:state:current-bucket:{}:{}' # def_tag:bucket, a part of current states
+    PATTERN_STATE_HISTORY = 'zato:bst:state:history:{}' # Legacy, JSON lists of transitions kept in hash fields
+    PATTERN_STATE_HISTORY_LIST = 'zato:bst:state:history-list:{}:{}' # def_tag:object_tag
+    PATTERN_STATE_INDEX = 'zato:bst:state:index:{}:{}' # def_tag:state, object tags scored by the time they entered the state
+    PATTERN_STATS_STATES = 'zato:bst:stats:states:{}' # def_tag, numbers of objects in each state
+    PATTERN_STATS_EDGES = 'zato:bst:stats:edges:{}:{}' # def_tag:minute, numbers of transitions along each edge
+    PATTERN_DEADLINE = 'zato:bst:deadline:{}' # def_tag, object tags scored by the time their current states time out
+    PATTERN_EVENTS = 'zato:bst:events:{}' # def_tag, stream of transitions published for consumers
+
+    # KEYS[1] - hash of current states, KEYS[2] - object's history list, KEYS[3] - index of objects in the new state,
+    # KEYS[4] - numbers of objects in each state, KEYS[5] - numbers of transitions along each edge in the current minute,
+    # KEYS[6] - index of deadlines, KEYS[7] - stream of events, KEYS[8] - hash of current states in the previous layout,
+    # the same as KEYS[1] if current states are not being moved from one layout to another,
+    # ARGV[1] - object_tag, ARGV[2] - serialized transition without state_old, ARGV[3] - '1' if any current state is allowed,
+    # ARGV[4] - '1' if objects without a state are allowed, ARGV[5] - score in the index of the new state,
+    # ARGV[6] - prefix of keys of state indexes, ARGV[7] - for how many seconds to keep KEYS[5],
+    # ARGV[8] - score in the index of deadlines or an empty string if the new state has no timeout,
+    # ARGV[9] - version the current state must have or an empty string if it is not checked,
+    # ARGV[10] - about how many events to keep in KEYS[7] or an empty string if events are not published,
+    # ARGV[11:] - states the object may be transitioned from.
+    # The index of the current state is only known once it has been read so its key is not in KEYS.
+    # Current states may be in msgpack if they were stored by backends using it but new ones are always in JSON,
+    # stamped with the version that follows that of the current state.
+    LUA_TRANSITION = """
+        local current = redis.call('HGET', KEYS[1], ARGV[1])
+        local state_current = false
+        local version = 0
+
+        if not current and KEYS[8] ~= KEYS[1] then
+            current = redis.call('HGET', KEYS[8], ARGV[1])
+        end
+
+        if current then
+            if string.byte(current, 1) == 2 then
+                current = cmsgpack.unpack(string.sub(current, 2))
+            else
+                current = cjson.decode(current)
+            end
+            state_current = current['state_current']
+            version = tonumber(current['version']) or 0
+        end
+
+        if ARGV[9] ~= '' and (not current or string.format('%d', version) ~= ARGV[9]) then
+            return {0, state_current}
+        end
+
+        if ARGV[3] ~= '1' then
+            if not state_current then
+                if ARGV[4] ~= '1' then
+                    return {0, false}
+                end
+            else
+                local is_allowed = false
+                for idx = 11, #ARGV do
+                    if ARGV[idx] == state_current then
+                        is_allowed = true
+                        break
+                    end
+                end
+                if not is_allowed then
+                    return {0, state_current}
+                end
+            end
+        end
+
+        local state_old = 'null'
+        if state_current then
+            state_old = cjson.encode(state_current)
+        end
+
+        local state_info = '{"state_old":' .. state_old .. ',"version":' .. string.format('%d', version + 1) .. ',' ..
+            string.sub(ARGV[2], 2)
+
+        redis.call('HSET', KEYS[1], ARGV[1], state_info)
+        redis.call('RPUSH', KEYS[2], state_info)
+
+        if KEYS[8] ~= KEYS[1] then
+            redis.call('HDEL', KEYS[8], ARGV[1])
+        end
+
+        local state_new = string.sub(KEYS[3], string.len(ARGV[6]) + 1)
+
+        if state_current ~= state_new then
+            if state_current then
+                redis.call('ZREM', ARGV[6] .. state_current, ARGV[1])
+                redis.call('HINCRBY', KEYS[4], state_current, -1)
+            end
+            redis.call('HINCRBY', KEYS[4], state_new, 1)
+        end
+        redis.call('ZADD', KEYS[3], ARGV[5], ARGV[1])
+
+        redis.call('HINCRBY', KEYS[5], (state_current or '') .. '\\n' .. state_new, 1)
+        redis.call('EXPIRE', KEYS[5], ARGV[7])
+
+        if ARGV[8] ~= '' then
+            redis.call('ZADD', KEYS[6], ARGV[8], ARGV[1])
+        else
+            redis.call('ZREM', KEYS[6], ARGV[1])
+        end
+
+        -- Stream IDs are not deterministic so no writes may follow
+        if ARGV[10] ~= '' then
+            redis.call('XADD', KEYS[7], 'MAXLEN', '~', ARGV[10], '*', 'object_tag', ARGV[1], 'state_info', state_info)
+        end
+
+        return {1, state_current}
+    """
 
 # ################################################################################################################################
 
-    def __init__(self, conn):
+    def __init__(self, conn, use_scripts=False, stats_ttl=CONST.STATS_TTL, codec=CONST.RECORD_CODEC_JSON,
+            convert_legacy_history=False, publish_events=False, events_max_len=CONST.EVENTS_MAX_LEN, current_buckets=0,
+            previous_buckets=None):
+
+        if codec not in (CONST.RECORD_CODEC_JSON, CONST.RECORD_CODEC_MSGPACK):
+            raise ValueError('Unknown codec `{}`'.format(codec))
+
+        if codec == CONST.RECORD_CODEC_MSGPACK:
+            if not msgpack:
+                raise ValueError('Codec `{}` needs msgpack to be installed'.format(codec))
+
+            # The script adds state_old to JSON records as they are
+            if use_scripts:
+                raise ValueError('Codec `{}` cannot be used with scripts'.format(codec))
+
+        if current_buckets < 0 or (previous_buckets is not None and previous_buckets < 0):
+            raise ValueError('Numbers of buckets must not be negative')
+
+        if current_buckets == previous_buckets:
+            raise ValueError('Previous layout must be different from the current one')
+
         self.conn = conn
+        self.stats_ttl = stats_ttl
+        self.codec = codec
+        self.convert_legacy_history = convert_legacy_history
+        self.publish_events = publish_events
+        self.events_max_len = events_max_len
+        self.current_buckets = current_buckets
+        self.previous_buckets = previous_buckets
+        self.supports_atomic_transition = use_scripts
+        self._lua_transition = conn.register_script(self.LUA_TRANSITION) if use_scripts else None
 
 # ################################################################################################################################
 
-    def get_current_state_info(self, object_tag, def_tag):
-        data = self.conn.hget(self.PATTERN_STATE_CURRENT.format(def_tag), object_tag)
-        if data:
-            return loads(data)
+    def _encode(self, state_info, info=None):
+        """ Returns a record to store out of a transition in JSON, which is stored as it is unless another codec is configured.
+        info is the transition already deserialized, if it is at hand.
+        """
+        if self.codec == CONST.RECORD_CODEC_JSON:
+            return state_info
+        return encode_record(info if info is not None else loads(state_info), self.codec)
+
+    def _convert(self, value):
+        """ Returns a stored record in the configured codec, converting it only if it is in another one.
+        """
+        return value if is_record_in(value, self.codec) else encode_record(decode_record(value), self.codec)
 
 # ################################################################################################################################
 
-    def get_history(self, object_tag, def_tag):
-        history = self.conn.hget(self.PATTERN_STATE_HISTORY.format(def_tag), object_tag)
-        return loads(history) if history else []
+    def _get_current_key(self, def_tag, object_tag=None, buckets=None):
+        """ Returns the key of the hash an object's current state is kept in, in the current layout unless the number
+        of buckets of another one is given.
+        """
+        buckets = self.current_buckets if buckets is None else buckets
+        if not buckets:
+            return self.PATTERN_STATE_CURRENT.format(def_tag)
+        return self.PATTERN_STATE_CURRENT_BUCKET.format(def_tag, (crc32(object_tag.encode('utf8')) & 0xffffffff) % buckets)
+
+    def _get_previous_key(self, def_tag, object_tag):
+        """ Returns the key of the hash an object's current state was kept in before it was moved to the current layout,
+        or None if current states are not being moved.
+        """
+        if self.previous_buckets is not None:
+            return self._get_current_key(def_tag, object_tag, self.previous_buckets)
 
-# ################################################################################################################################
+    def _get_layout_keys(self, def_tag, buckets):
+        if not buckets:
+            return [self.PATTERN_STATE_CURRENT.format(def_tag)]
+        return [self.PATTERN_STATE_CURRENT_BUCKET.format(def_tag, bucket) for bucket in range(buckets)]
 
-    def set_current_state_info(self, object_tag, def_tag, state_info):
+    def _get_current_keys(self, def_tag):
+        """ Returns keys of all hashes current states of a definition may be kept in, including the previous layout's.
+        """
+        keys = self._get_layout_keys(def_tag, self.current_buckets)
+        if self.previous_buckets is not None:
+            keys.extend(self._get_layout_keys(def_tag, self.previous_buckets))
+        return keys
 
-        # Set the new state object is in ..
-        self.conn.hset(self.PATTERN_STATE_CURRENT.format(def_tag), object_tag, state_info)
+    def get_current_def_tags(self, def_tag=None, batch_size=1000):
+        """ Returns tags of all definitions that have current states, in either layout, or only def_tag if it is given.
+        """
+        if def_tag:
+            return [def_tag]
 
-        # .. and append it to the object's history of transitions.
-        history = self.get_history(object_tag, def_tag)
-        history.append(state_info)
-        history = dumps(history)
+        def_tags = set()
 
-        self.conn.hset(self.PATTERN_STATE_HISTORY.format(def_tag), object_tag, history)
+        for pattern in (self.PATTERN_STATE_CURRENT, self.PATTERN_STATE_CURRENT_BUCKET):
+            prefix = pattern.split('{}')[0]
+            for key in self.conn.scan_iter(match='{}*'.format(glob_escape(prefix)), count=batch_size):
+                tag = key[len(prefix):]
+                def_tags.add(tag.rsplit(':', 1)[0] if pattern == self.PATTERN_STATE_CURRENT_BUCKET else tag)
 
-# ################################################################################################################################
+        return sorted(def_tags)
 
-class SQLBackend(StateBackendBase):
+    def _iter_current_keys(self, def_tag=None, batch_size=1000):
+        """ Yields keys of all hashes current states of all definitions, or of def_tag only, may be kept in.
+        """
+        for _def_tag in self.get_current_def_tags(def_tag, batch_size):
+            for key in self._get_current_keys(_def_tag):
+                yield key
 
-    def __init__(self, session, cluster_id):
-        self.session = session
-        self.cluster_id = cluster_id
+    def _get_current_values(self, def_tag, object_tags):
+        """ Returns stored current states of objects, or None for those that have none, in the same order as object_tags.
+        Hashes of both layouts are read in one transaction while current states are being moved from one to another.
+        """
+        if not object_tags:
+            return []
 
-# ################################################################################################################################
+        if not self.current_buckets and self.previous_buckets is None:
+            return self.conn.hmget(self._get_current_key(def_tag), object_tags)
 
-    def _get_info(self, object_tag, def_tag, name_pattern, needs_item=False, label=label):
-        item = self.session.query(Item).\
-            filter(Item.name==name_pattern % (def_tag, object_tag)).\
-            filter(Item.cluster_id==self.cluster_id).\
-            order_by(Item.name).\
-            first()
+        layouts = [self.current_buckets]
+        if self.previous_buckets is not None:
+            layouts.append(self.previous_buckets)
 
-        if item:
-            if needs_item:
-                return item
-            else:
-                return loads(item.value) if item.value else None
+        pipe = self.conn.pipeline(len(layouts) > 1)
+        groups = []
 
-# ################################################################################################################################
+        for buckets in layouts:
+            by_key = OrderedDict()
+            for idx, object_tag in enumerate(object_tags):
+                by_key.setdefault(self._get_current_key(def_tag, object_tag, buckets), []).append(idx)
 
-    def _create_item(self, sub_group_name, name_pattern, def_tag, object_tag):
+            for key, idxs in by_key.items():
+                pipe.hmget(key, [object_tags[idx] for idx in idxs])
+                groups.append(idxs)
 
-        sub_group_id, group_id = self.session.query(SubGroup.id, SubGroup.group_id).\
-            filter(SubGroup.name==sub_group_name).\
-            filter(SubGroup.cluster_id==self.cluster_id).\
-            one()
+        out = [None] * len(object_tags)
 
-        item = Item()
-        item.name = name_pattern % (def_tag, object_tag)
-        item.is_internal = False
-        item.cluster_id = self.cluster_id
-        item.group_id = group_id
-        item.sub_group_id = sub_group_id
+        # The current layout comes first so its values take precedence
+        for idxs, values in zip(groups, pipe.execute()):
+            for idx, value in zip(idxs, values):
+                if out[idx] is None:
+                    out[idx] = value
 
-        return item
+        return out
 
-# ################################################################################################################################
+    def _iter_current(self, def_tag, batch_size=1000):
+        """ Yields object tags and stored current states of all objects of a definition, in either layout.
+        """
+        for key in self._get_current_keys(def_tag):
+            for object_tag, value in self.conn.hscan_iter(key, count=batch_size):
+                yield object_tag, value
 
-    def get_current_state_info(self, object_tag, def_tag, needs_item=False):
-        return self._get_info(object_tag, def_tag, label.item.process_bst_inst_current, needs_item)
+    def _del_previous(self, pipe, def_tag, object_tags):
+        """ Removes objects from hashes of the previous layout, if current states are being moved from it, once they have
+        been written to the current one.
+        """
+        if self.previous_buckets is not None:
+            by_key = {}
+            for object_tag in object_tags:
+                by_key.setdefault(self._get_previous_key(def_tag, object_tag), []).append(object_tag)
 
-# ################################################################################################################################
+            for key, _object_tags in sorted(by_key.items()):
+                pipe.hdel(key, *_object_tags)
 
-    def get_history(self, object_tag, def_tag):
-        return self._get_info(object_tag, def_tag, label.item.process_bst_inst_history, False) or []
+    def _get_history_key(self, object_tag, def_tag):
+        return self.PATTERN_STATE_HISTORY_LIST.format(def_tag, object_tag)
 
-# ################################################################################################################################
+    def _get_index_key(self, def_tag, state):
+        return self.PATTERN_STATE_INDEX.format(def_tag, state)
 
-    def set_current_state_info(self, object_tag, def_tag, state_info, label=label):
-        current = self.get_current_state_info(
-            object_tag, def_tag, True) or self._create_item(
-                label.sub_group.conf.process_bst, label.item.process_bst_inst_current, def_tag, object_tag)
-        current.value = state_info
+    def _get_deadline_key(self, def_tag):
+        return self.PATTERN_DEADLINE.format(def_tag)
 
-        history = self._get_info(
-            object_tag, def_tag, label.item.process_bst_inst_history, True) or self._create_item(
-                label.sub_group.conf.process_bst, label.item.process_bst_inst_history, def_tag, object_tag)
+    def _get_stats_edges_key(self, def_tag, minute):
+        return self.PATTERN_STATS_EDGES.format(def_tag, minute.strftime(CONST.STATS_MINUTE_FORMAT))
 
-        history_value = loads(history.value) if history.value else []
-        history_value.append(state_info)
-        history.value = dumps(history_value)
+    def _get_events_key(self, def_tag):
+        return self.PATTERN_EVENTS.format(def_tag)
 
-        self.session.add(current)
-        self.session.add(history)
+    def _update_stats(self, pipe, def_tag, state_infos):
+        """ Updates numbers of objects in each state and of transitions along each edge, out of deserialized transitions.
+        """
+        states, edges = get_stats_deltas(state_infos)
 
-        self.session.commit()
+        for state, delta in states.items():
+            pipe.hincrby(self.PATTERN_STATS_STATES.format(def_tag), state, delta)
 
-# ################################################################################################################################
+        for (minute, edge), delta in edges.items():
+            pipe.hincrby(self._get_stats_edges_key(def_tag, minute), edge, delta)
 
-class StateMachine(object):
-    def __init__(self, config=None, backend=None, run_set_up=True):
-        self.config = config
-        self.backend = backend
-        self.object_type_to_def = {}
+        for minute in set(minute for minute, _ in edges):
+            pipe.expire(self._get_stats_edges_key(def_tag, minute), self.stats_ttl)
 
-        # Prepares database and run-time structures
-        if run_set_up:
-            self.set_up()
+    def _index_state(self, pipe, def_tag, object_tag, state_infos):
+        """ Moves an object, in the index of states, to the state it ends up in after a series of its transitions
+        and sets or clears its deadline depending on whether that state has a timeout.
+        """
+        last = state_infos[-1]
 
-    def set_up(self):
-        # Map object types to definitions they are contained in.
-        for def_tag, config_item in self.config.items():
-            for object_type in config_item.objects:
-                defs = self.object_type_to_def.setdefault(object_type, [])
-                defs.append(def_tag)
+        states_old = set(info.get('state_old') for info in state_infos)
+        states_old.update(info['state_current'] for info in state_infos[:-1])
+        states_old.discard(None)
+        states_old.discard(last['state_current'])
 
-    @staticmethod
-    def get_object_tag(object_type, object_id):
-        return '{}.{}'.format(object_type, object_id)
+        for state in states_old:
+            pipe.zrem(self._get_index_key(def_tag, state), object_tag)
 
-    def get_def_tag(self, object_type, object_id=None, state_new=None, def_name=None, def_version=None):
-        def_tag = self.object_type_to_def[object_type]
+        pipe.zadd(self._get_index_key(def_tag, last['state_current']),
+            **{object_tag: get_ts_score(parse_ts(last['transition_ts_utc']))})
 
-        if len(def_tag) > 1:
-            msg = 'Ambiguous input. Object `{}` maps to more than one definition `{}` '\
+        if last.get('deadline_utc'):
+            pipe.zadd(self._get_deadline_key(def_tag), **{object_tag: get_ts_score(parse_ts(last['deadline_utc']))})
+        else:
+            pipe.zrem(self._get_deadline_key(def_tag), object_tag)
+
+# ################################################################################################################################
+
+    def get_current_state_info(self, object_tag, def_tag):
+        data = self._get_current_values(def_tag, [object_tag])[0]
+        if data:
+            return decode_record(data)
+
+# ################################################################################################################################
+
+    @staticmethod
+    def _get_history_indexes(limit, offset, newest_first):
+        """ Returns LRANGE indexes of a page of history, negative ones if it is counted from the newest transition.
+        """
+        if newest_first:
+            return (-(offset + limit) if limit is not None else 0), -(offset + 1)
+        return offset, (offset + limit - 1 if limit is not None else -1)
+
+    def _find_history_index(self, key, list_len, ts, start=0):
+        """ Returns the index of the oldest transition made at ts or later among those from start up to list_len
+        in a history list, or list_len if there is none. Lists are ordered by time so it is a binary search,
+        reading one transition per step.
+        """
+        end = list_len
+
+        while start < end:
+            middle = (start + end) // 2
+            if get_transition_ts(self.conn.lindex(key, middle)) < ts:
+                start = middle + 1
+            else:
+                end = middle
+
+        return start
+
+    def _get_history_range(self, key, list_len, limit, offset, since_ts, until_ts, newest_first):
+        """ Returns a page of history from a range of time. Both ends of the range are found with binary searches
+        so only the page itself is read in full, no matter how long the list is.
+        """
+        start = self._find_history_index(key, list_len, since_ts) if since_ts else 0
+        end = self._find_history_index(key, list_len, until_ts, start) if until_ts else list_len
+
+        # Indexes of the first and last transition of the page, counted from the oldest one
+        if newest_first:
+            last = end - offset - 1
+            first = max(last - limit + 1, start) if limit is not None else start
+        else:
+            first = start + offset
+            last = min(first + limit, end) - 1 if limit is not None else end - 1
+
+        if last < first:
+            return []
+
+        out = self.conn.lrange(key, first, last)
+        return out[::-1] if newest_first else out
+
+    def get_history(self, object_tag, def_tag, limit=None, offset=0, since_ts=None, until_ts=None, newest_first=False):
+        if limit is not None and limit < 1:
+            return []
+
+        offset = offset or 0
+        since_ts, until_ts = parse_ts(since_ts), parse_ts(until_ts)
+        key = self._get_history_key(object_tag, def_tag)
+
+        # Objects that were transitioned before history was kept in lists may still have
+        # their older entries in the legacy hash so it is read in the same round trip as the list itself.
+        pipe = self.conn.pipeline(False)
+        pipe.hget(self.PATTERN_STATE_HISTORY.format(def_tag), object_tag)
+
+        if since_ts or until_ts:
+            pipe.llen(key)
+            legacy, list_len = pipe.execute()
+
+            if not legacy:
+                return self._get_history_range(key, list_len, limit, offset, since_ts, until_ts, newest_first)
+
+        else:
+            pipe.lrange(key, *self._get_history_indexes(limit, offset, newest_first))
+            legacy, history = pipe.execute()
+
+            if not legacy:
+                return history[::-1] if newest_first else history
+
+        # Legacy entries are either moved to the list, once, and read from there ..
+        if self.convert_legacy_history:
+            self._move_legacy_history(object_tag, def_tag)
+            return self.get_history(object_tag, def_tag, limit, offset, since_ts, until_ts, newest_first)
+
+        # .. or, as they precede all of the list, both need to be paged through together.
+        return filter_history(loads(legacy) + self.conn.lrange(key, 0, -1), limit, offset, since_ts, until_ts, newest_first)
+
+    def _move_legacy_history(self, object_tag, def_tag):
+        """ Moves an object's transitions from the legacy hash, where they are kept as a JSON list of JSON strings,
+        to the beginning of its history list. Returns the number of transitions moved.
+        """
+        legacy_key = self.PATTERN_STATE_HISTORY.format(def_tag)
+        key = self._get_history_key(object_tag, def_tag)
+
+        with self.conn.pipeline() as pipe:
+            while True:
+                try:
+                    pipe.watch(legacy_key)
+                    legacy = pipe.hget(legacy_key, object_tag)
+
+                    if not legacy:
+                        return 0
+
+                    history = [self._encode(value) for value in loads(legacy)]
+
+                    pipe.multi()
+                    if history:
+                        pipe.lpush(key, *reversed(history))
+                    pipe.hdel(legacy_key, object_tag)
+                    pipe.execute()
+
+                    return len(history)
+
+                except WatchError:
+                    continue
+
+# ################################################################################################################################
+
+    def iter_history_objects(self, def_tag, batch_size=100):
+        prefix = self._get_history_key('', def_tag)
+        batch = []
+
+        for key in self.conn.scan_iter(match='{}*'.format(glob_escape(prefix)), count=batch_size):
+            batch.append(key[len(prefix):])
+
+            if len(batch) == batch_size:
+                yield batch
+                batch = []
+
+        if batch:
+            yield batch
+
+    def iter_current_states(self, def_tag, batch_size=100):
+        batch = []
+
+        for object_tag, value in self._iter_current(def_tag, batch_size):
+            batch.append((object_tag, decode_record(value)))
+
+            if len(batch) == batch_size:
+                yield batch
+                batch = []
+
+        if batch:
+            yield batch
+
+    def restore_objects(self, def_tag, objects):
+        pipe = self.conn.pipeline()
+        current = []
+
+        for object_tag, state_info, history in objects:
+            if history:
+                pipe.rpush(self._get_history_key(object_tag, def_tag), *[self._encode(value) for value in history])
+
+            if state_info:
+                info = loads(state_info)
+                pipe.hset(self._get_current_key(def_tag, object_tag), object_tag, self._encode(state_info, info))
+                self._index_state(pipe, def_tag, object_tag, [info])
+                current.append(object_tag)
+
+        self._del_previous(pipe, def_tag, current)
+        pipe.execute()
+
+    def trim_history(self, object_tag, def_tag, max_history=None, min_ts=None, on_trim=None):
+        min_ts = parse_ts(min_ts)
+        key = self._get_history_key(object_tag, def_tag)
+        list_len = self.conn.llen(key)
+
+        # How many of the oldest transitions to remove
+        count = max(list_len - max(max_history, 1), 0) if max_history is not None else 0
+
+        # The newest transition is always kept
+        if min_ts and count < list_len - 1:
+            count = self._find_history_index(key, list_len - 1, min_ts, count)
+
+        if not count:
+            return 0
+
+        if on_trim:
+            on_trim(object_tag, def_tag, self.conn.lrange(key, 0, count - 1))
+
+        # New transitions are only ever appended so the oldest ones can be removed without a transaction
+        self.conn.ltrim(key, count, -1)
+
+        return count
+
+# ################################################################################################################################
+
+    def _set_current(self, pipe, object_tag, def_tag, state_info):
+        """ Adds to a pipeline everything needed to set new state of an object.
+        """
+        info = loads(state_info)
+        value = self._encode(state_info, info)
+
+        pipe.hset(self._get_current_key(def_tag, object_tag), object_tag, value)
+        self._del_previous(pipe, def_tag, [object_tag])
+        pipe.rpush(self._get_history_key(object_tag, def_tag), value)
+        self._index_state(pipe, def_tag, object_tag, [info])
+        self._update_stats(pipe, def_tag, [info])
+
+        if self.publish_events:
+            self._add_event(pipe, object_tag, def_tag, state_info)
+
+    def _add_event(self, pipe, object_tag, def_tag, state_info):
+        """ Adds to a pipeline publishing of a transition, always in JSON, to the stream of events of its definition.
+        """
+        pipe.execute_command('XADD', self._get_events_key(def_tag), 'MAXLEN', '~', self.events_max_len, '*',
+            'object_tag', object_tag, 'state_info', state_info)
+
+    def set_current_state_info(self, object_tag, def_tag, state_info):
+
+        # Set the new state object is in and append it to the object's history of transitions, atomically.
+        pipe = self.conn.pipeline()
+        self._set_current(pipe, object_tag, def_tag, state_info)
+        pipe.execute()
+
+    def set_current_state_info_if(self, object_tag, def_tag, state_info, version):
+
+        # Scripts check the version and set the state in one round trip
+        if self.supports_atomic_transition:
+            info = loads(state_info)
+            state_old = info.pop('state_old', None)
+            is_allowed, _ = self.transition_atomic(
+                object_tag, def_tag, dumps(info), False, version is None, (state_old,) if state_old else (), version)
+            return is_allowed
+
+        key = self._get_current_key(def_tag, object_tag)
+        previous_key = self._get_previous_key(def_tag, object_tag)
+        history_key = self._get_history_key(object_tag, def_tag)
+
+        with self.conn.pipeline() as pipe:
+            for attempt in range(1, CONST.WATCH_MAX_ATTEMPTS + 1):
+                try:
+                    # Each transition appends to the object's history list, which is watched rather than the hash
+                    # of current states, so that transactions are not aborted by transitions of other objects.
+                    pipe.watch(history_key)
+                    current = pipe.hget(key, object_tag) or (pipe.hget(previous_key, object_tag) if previous_key else None)
+
+                    if get_state_version(decode_record(current) if current else None) != version:
+                        return False
+
+                    pipe.multi()
+                    self._set_current(pipe, object_tag, def_tag, set_state_version(state_info, version))
+                    pipe.execute()
+
+                    return True
+
+                # The list changed, e.g. the history was trimmed or the object transitioned, in which case
+                # the version is checked again after a while.
+                except WatchError:
+                    sleep(uniform(0, CONST.WATCH_BACKOFF * attempt))
+
+        logger.warn('Could not set state of `%s` in `%s` in %s attempts', object_tag, def_tag, CONST.WATCH_MAX_ATTEMPTS)
+        return False
+
+# ################################################################################################################################
+
+    def get_current_state_info_many(self, object_tags, def_tag):
+        object_tags = list(object_tags)
+        if not object_tags:
+            return {}
+
+        data = self._get_current_values(def_tag, object_tags)
+        return dict((object_tag, decode_record(value)) for object_tag, value in zip(object_tags, data) if value)
+
+# ################################################################################################################################
+
+    def set_current_state_info_many(self, def_tag, state_infos):
+
+        state_infos = list(state_infos)
+        if not state_infos:
+            return
+
+        pipe = self.conn.pipeline()
+        self._set_many(pipe, def_tag, state_infos)
+        pipe.execute()
+
+    def _set_many(self, pipe, def_tag, state_infos):
+        """ Adds to a pipeline everything needed to set new states of objects out of a non-empty list
+        of (object_tag, state_info) tuples.
+        """
+        # An object may be transitioned more than once in a batch, in which case its last state becomes the current one
+        # and each of the states is appended to its history, in the order given.
+        current = {}
+        history = OrderedDict()
+
+        for object_tag, state_info in state_infos:
+            info = loads(state_info)
+            value = current[object_tag] = self._encode(state_info, info)
+            history.setdefault(object_tag, []).append((value, info))
+
+        by_key = {}
+        for object_tag, value in current.items():
+            by_key.setdefault(self._get_current_key(def_tag, object_tag), {})[object_tag] = value
+
+        for key, values in sorted(by_key.items()):
+            pipe.hmset(key, values)
+
+        self._del_previous(pipe, def_tag, current)
+
+        infos = []
+
+        for object_tag, object_history in history.items():
+            values, object_infos = zip(*object_history)
+            pipe.rpush(self._get_history_key(object_tag, def_tag), *values)
+
+            object_infos = list(object_infos)
+            self._index_state(pipe, def_tag, object_tag, object_infos)
+            infos.extend(object_infos)
+
+        self._update_stats(pipe, def_tag, infos)
+
+        if self.publish_events:
+            for object_tag, state_info in state_infos:
+                self._add_event(pipe, object_tag, def_tag, state_info)
+
+    def set_current_state_info_many_if(self, def_tag, state_infos, versions):
+
+        state_infos = list(state_infos)
+        if not state_infos:
+            return set()
+
+        object_tags = sorted(set(object_tag for object_tag, _ in state_infos))
+        history_keys = [self._get_history_key(object_tag, def_tag) for object_tag in object_tags]
+
+        with self.conn.pipeline() as pipe:
+            for attempt in range(1, CONST.WATCH_MAX_ATTEMPTS + 1):
+                try:
+                    # History lists are watched, as in set_current_state_info_if, and current states are read once they are.
+                    # This is also what servers with scripts do because a script run for each transition could not tell
+                    # that a previous transition of the same object was rejected.
+                    pipe.watch(*history_keys)
+                    current = self._get_current_values(def_tag, object_tags)
+
+                    conflicts = set(object_tag for object_tag, value in zip(object_tags, current)
+                        if get_state_version(decode_record(value) if value else None) != versions[object_tag])
+
+                    to_write = [(object_tag, state_info) for object_tag, state_info in state_infos if object_tag not in conflicts]
+
+                    if to_write:
+                        pipe.multi()
+                        self._set_many(pipe, def_tag, set_state_versions(to_write, versions))
+                        pipe.execute()
+
+                    return conflicts
+
+                except WatchError:
+                    sleep(uniform(0, CONST.WATCH_BACKOFF * attempt))
+
+        logger.warn('Could not set states of `%s` objects in `%s` in %s attempts', len(object_tags), def_tag,
+            CONST.WATCH_MAX_ATTEMPTS)
+
+        return set(object_tags)
+
+# ################################################################################################################################
+
+    def transition_atomic(self, object_tag, def_tag, state_info, any_state, allow_none, state_sources, version=None):
+        info = loads(state_info)
+
+        # The script stamps the new state with its version itself
+        if 'version' in info:
+            del info['version']
+            state_info = dumps(info)
+
+        transition_ts = parse_ts(info['transition_ts_utc'])
+        deadline = repr(get_ts_score(parse_ts(info['deadline_utc']))) if info.get('deadline_utc') else ''
+
+        key = self._get_current_key(def_tag, object_tag)
+
+        is_allowed, state_current = self._lua_transition(
+            [key, self._get_history_key(object_tag, def_tag),
+                self._get_index_key(def_tag, info['state_current']), self.PATTERN_STATS_STATES.format(def_tag),
+                self._get_stats_edges_key(def_tag, transition_ts), self._get_deadline_key(def_tag),
+                self._get_events_key(def_tag), self._get_previous_key(def_tag, object_tag) or key],
+            [object_tag, state_info, '1' if any_state else '0', '1' if allow_none else '0', repr(get_ts_score(transition_ts)),
+                self._get_index_key(def_tag, ''), self.stats_ttl, deadline, '' if version is None else '{}'.format(version),
+                self.events_max_len if self.publish_events else ''] + list(state_sources))
+
+        return bool(is_allowed), state_current
+
+# ################################################################################################################################
+
+    def get_objects_in_state(self, def_tag, state, limit=100, cursor=None):
+        key = self._get_index_key(def_tag, state)
+
+        if cursor:
+            min_score, last_object_tag = parse_state_cursor(cursor)
+            min_score = float(min_score)
+        else:
+            min_score, last_object_tag = '-inf', None
+
+        out = []
+        offset = 0
+
+        while len(out) < limit:
+
+            page = self.conn.zrangebyscore(key, min_score, '+inf', start=offset, num=limit, withscores=True)
+
+            if not page:
+                break
+
+            offset += len(page)
+            is_last_page = len(page) < limit
+
+            # Objects with the same score as the one the cursor points to are ordered by their tags
+            if last_object_tag is not None:
+                page = [(object_tag, score) for object_tag, score in page
+                    if score != min_score or object_tag > last_object_tag]
+
+            if page:
+                for (object_tag, score), state_info in zip(page, self._get_current_values(def_tag, [elem[0] for elem in page])):
+                    state_info = decode_record(state_info) if state_info else None
+
+                    # Objects may still be found in indexes of states they left if they were transitioned concurrently
+                    # by more than one process, but their current states are authoritative.
+                    if state_info and state_info['state_current'] == state:
+                        out.append((object_tag, state_info))
+                        last = score, object_tag
+
+                        if len(out) == limit:
+                            break
+
+            if is_last_page:
+                break
+
+        return out, (get_state_cursor(repr(last[0]), last[1]) if out and len(out) == limit else None)
+
+    def index_current_states(self, def_tag=None, batch_size=1000, pause=0):
+        total = 0
+
+        for _def_tag in self.get_current_def_tags(def_tag, batch_size):
+            pipe = self.conn.pipeline(False)
+
+            for object_tag, state_info in self._iter_current(_def_tag, batch_size):
+                state_info = decode_record(state_info)
+                pipe.zadd(self._get_index_key(_def_tag, state_info['state_current']),
+                    **{object_tag: get_ts_score(parse_ts(state_info['transition_ts_utc']))})
+
+                if state_info.get('deadline_utc'):
+                    pipe.zadd(self._get_deadline_key(_def_tag),
+                        **{object_tag: get_ts_score(parse_ts(state_info['deadline_utc']))})
+
+                total += 1
+
+                if total % batch_size == 0:
+                    pipe.execute()
+                    if pause:
+                        sleep(pause)
+
+            pipe.execute()
+
+        return total
+
+# ################################################################################################################################
+
+    def get_expired(self, def_tag, until_ts, limit=100):
+        key = self._get_deadline_key(def_tag)
+
+        object_tags = self.conn.zrangebyscore(key, '-inf', get_ts_score(parse_ts(until_ts)), start=0, num=limit)
+        if not object_tags:
+            return []
+
+        out = []
+        stale = []
+
+        for object_tag, state_info in zip(object_tags, self._get_current_values(def_tag, object_tags)):
+            state_info = decode_record(state_info) if state_info else None
+
+            if state_info and state_info.get('deadline_utc'):
+                out.append((object_tag, state_info))
+            else:
+                stale.append(object_tag)
+
+        # Objects whose current states have no timeouts any more, e.g. because their data was deleted, never expire
+        if stale:
+            self.conn.zrem(key, *stale)
+
+        return out
+
+# ################################################################################################################################
+
+    def get_state_stats(self, def_tag, since_ts):
+        now = datetime.utcnow()
+        since_ts = max(parse_ts(since_ts), now - timedelta(seconds=self.stats_ttl))
+        minutes = list(iter_minutes(since_ts, now))
+
+        pipe = self.conn.pipeline(False)
+        pipe.hgetall(self.PATTERN_STATS_STATES.format(def_tag))
+
+        for minute in minutes:
+            pipe.hgetall(self._get_stats_edges_key(def_tag, minute))
+
+        result = pipe.execute()
+
+        states = dict((state, int(count)) for state, count in result[0].items())
+        edges = {}
+
+        for minute, minute_edges in zip(minutes, result[1:]):
+            for edge, count in minute_edges.items():
+                edges[(minute, edge)] = int(count)
+
+        return get_stats_out(states, edges)
+
+    def rebuild_state_counts(self, def_tag):
+        states = {}
+
+        for _, state_info in self._iter_current(def_tag):
+            state = decode_record(state_info)['state_current']
+            states[state] = states.get(state, 0) + 1
+
+        key = self.PATTERN_STATS_STATES.format(def_tag)
+
+        pipe = self.conn.pipeline()
+        pipe.delete(key)
+        if states:
+            pipe.hmset(key, states)
+        pipe.execute()
+
+        return states
+
+    def prune_state_stats(self):
+        # Counters of transitions expire by themselves
+        return 0
+
+# ################################################################################################################################
+
+    def _get_events(self, entries):
+        """ Returns events out of stream entries, each a list of its ID and of names and values of its fields. Entries that
+        were pending in a consumer group when they were trimmed from the stream have no fields and are skipped.
+        """
+        out = []
+
+        for id, fields in entries or []:
+            if fields:
+                fields = dict(zip(fields[::2], fields[1::2]))
+                out.append(get_event(id, fields['object_tag'], fields['state_info']))
+
+        return out
+
+    def get_events(self, def_tag, cursor=None, limit=100):
+
+        # Stream IDs are made of a time in milliseconds and a sequence number, reading starts from the ID right after cursor
+        if cursor:
+            ms, seq = cursor.split('-')
+            start = '{}-{}'.format(ms, int(seq) + 1)
+        else:
+            start = '-'
+
+        events = self._get_events(self.conn.execute_command('XRANGE', self._get_events_key(def_tag), start, '+', 'COUNT', limit))
+        return events, events[-1]['id'] if events else cursor
+
+    def read_event_group(self, def_tag, group, consumer, limit=100, pending=False):
+        key = self._get_events_key(def_tag)
+        args = ('XREADGROUP', 'GROUP', group, consumer, 'COUNT', limit, 'STREAMS', key, '0' if pending else '>')
+
+        try:
+            response = self.conn.execute_command(*args)
+        except ResponseError as e:
+            if not e.args[0].startswith('NOGROUP'):
+                raise
+
+            # New groups start from the oldest event kept, unless another consumer has just created the group
+            try:
+                self.conn.execute_command('XGROUP', 'CREATE', key, group, '0', 'MKSTREAM')
+            except ResponseError as e:
+                if not e.args[0].startswith('BUSYGROUP'):
+                    raise
+
+            response = self.conn.execute_command(*args)
+
+        # A list of (key, entries) for each stream read or None if there were no entries
+        return self._get_events(response[0][1] if response else None)
+
+    def ack_events(self, def_tag, group, ids):
+        ids = list(ids)
+        return self.conn.execute_command('XACK', self._get_events_key(def_tag), group, *ids) if ids else 0
+
+    def prune_events(self):
+        # Streams are capped as events are added
+        return 0
+
+# ################################################################################################################################
+
+    def _rename_keys(self, old_prefix, new_prefix, batch_size, report, exclusive=True):
+        """ Renames all keys starting with old_prefix so that they start with new_prefix instead, in pipelined batches.
+        Keys are scanned for until none is found, so that those created in the meantime are renamed too.
+        If exclusive is True, ValueError is raised instead of replacing keys that exist already.
+        """
+        count = 0
+
+        while True:
+            batch = []
+            pass_count = 0
+
+            for key in self.conn.scan_iter(match='{}*'.format(glob_escape(old_prefix)), count=batch_size):
+                batch.append(key)
+
+                if len(batch) == batch_size:
+                    self._rename_batch(batch, old_prefix, new_prefix, exclusive)
+                    pass_count += len(batch)
+                    report(count + pass_count)
+                    batch = []
+
+            if batch:
+                self._rename_batch(batch, old_prefix, new_prefix, exclusive)
+                pass_count += len(batch)
+                report(count + pass_count)
+
+            if not pass_count:
+                return count
+
+            count += pass_count
+
+    def _rename_batch(self, keys, old_prefix, new_prefix, exclusive):
+        pipe = self.conn.pipeline()
+        for key in keys:
+            (pipe.renamenx if exclusive else pipe.rename)(key, new_prefix + key[len(old_prefix):])
+
+        # Keys of the new definition exist already only if its objects were transitioned while the old one was being renamed
+        for key, is_renamed in zip(keys, pipe.execute()):
+            if not is_renamed:
+                raise ValueError('Could not rename `{}`, `{}` exists already'.format(key, new_prefix + key[len(old_prefix):]))
+
+    def _rename_current_page(self, pipe, old_key, cursor, new_def_tag, batch_size):
+        """ Moves a page of current states, read from old_key with HSCAN at cursor, to keys of new_def_tag. The hash is watched
+        so that states are moved only if no object was transitioned in the meantime. Returns the next cursor
+        and the number of objects moved.
+        """
+        for attempt in range(1, CONST.WATCH_MAX_ATTEMPTS + 1):
+            try:
+                pipe.watch(old_key)
+                next_cursor, page = pipe.hscan(old_key, cursor, count=batch_size)
+
+                if not page:
+                    pipe.reset()
+                    return next_cursor, 0
+
+                values = {}
+                for object_tag, state_info in page.items():
+                    state_info = decode_record(state_info)
+                    state_info['def_tag'] = new_def_tag
+                    new_key = self._get_current_key(new_def_tag, object_tag)
+                    values.setdefault(new_key, {})[object_tag] = encode_record(state_info, self.codec)
+
+                pipe.multi()
+                for new_key, new_values in sorted(values.items()):
+                    pipe.hmset(new_key, new_values)
+                pipe.hdel(old_key, *page.keys())
+                pipe.execute()
+
+                return next_cursor, len(page)
+
+            except WatchError:
+                sleep(uniform(0, CONST.WATCH_BACKOFF * attempt))
+
+        raise ValueError('Could not move current states from `{}` in {} attempts, objects are still being transitioned'.format(
+            old_key, CONST.WATCH_MAX_ATTEMPTS))
+
+    def _is_transitioned(self, def_tag):
+        """ Returns True if any object of a definition was transitioned in the current or previous minute.
+        """
+        now = datetime.utcnow()
+
+        pipe = self.conn.pipeline(False)
+        for minute in (now, now - timedelta(minutes=1)):
+            pipe.exists(self._get_stats_edges_key(def_tag, minute))
+
+        return any(pipe.execute())
+
+    def has_objects(self, def_tag, batch_size=1000):
+        """ Returns True if any objects have current states or history in a given definition.
+        """
+        pipe = self.conn.pipeline(False)
+        for key in self._get_current_keys(def_tag):
+            pipe.exists(key)
+
+        return any(pipe.execute()) or next(iter(self.conn.scan_iter(
+            match='{}*'.format(glob_escape(self._get_history_key('', def_tag))), count=batch_size)), None) is not None
+
+    def rename_def(self, old_def_name, old_def_version, new_def_name, new_def_version, batch_size=1000, pause=0,
+            on_progress=None):
+        old_def_tag = Definition.get_tag(old_def_name, old_def_version)
+        new_def_tag = Definition.get_tag(new_def_name, new_def_version)
+
+        def get_report(what):
+            return lambda count: report_progress(old_def_tag, new_def_tag, what, count, pause, on_progress)
+
+        new_history_prefix = self._get_history_key('', new_def_tag)
+
+        if self.has_objects(new_def_tag, batch_size):
+            raise ValueError('Definition `{}` already has objects'.format(new_def_tag))
+
+        if self._is_transitioned(old_def_tag):
+            raise ValueError('Definition `{}` is still being transitioned'.format(old_def_tag))
+
+        # Current states are moved field by field since each has its def_tag in it,
+        # from either layout to the current one ..
+        report = get_report('current states')
+        total = 0
+
+        for old_key in self._get_current_keys(old_def_tag):
+            cursor = 0
+
+            with self.conn.pipeline() as pipe:
+                while True:
+                    cursor, count = self._rename_current_page(pipe, old_key, cursor, new_def_tag, batch_size)
+
+                    if count:
+                        total += count
+                        report(total)
+
+                    # Scans are repeated until nothing is left, in case they missed fields moved from under their cursors
+                    if not cursor and not self.conn.hlen(old_key):
+                        break
+
+        # .. whereas everything else is renamed as it is - history lists and indexes of states, one key per object or state ..
+        self._rename_keys(self._get_history_key('', old_def_tag), new_history_prefix, batch_size, get_report('history lists'))
+        self._rename_keys(self._get_index_key(old_def_tag, ''), self._get_index_key(new_def_tag, ''), batch_size,
+            get_report('state indexes'))
+        self._rename_keys(self.PATTERN_STATS_EDGES.format(old_def_tag, ''), self.PATTERN_STATS_EDGES.format(new_def_tag, ''),
+            batch_size, get_report('transition counters'), False)
+
+        # .. and keys of which there is one per definition.
+        for pattern in (self.PATTERN_STATE_HISTORY, self.PATTERN_STATS_STATES, self.PATTERN_DEADLINE, self.PATTERN_EVENTS):
+            if self.conn.exists(pattern.format(old_def_tag)):
+                self.conn.rename(pattern.format(old_def_tag), pattern.format(new_def_tag))
+
+        return total
+
+# ################################################################################################################################
+
+    def _iter_def_keys(self, pattern, def_tag, batch_size):
+        """ Yields (def_tag, key) tuples of keys of a pattern with a single placeholder for def_tag, either of all definitions
+        or, if def_tag is given, of that one only.
+        """
+        if def_tag:
+            yield def_tag, pattern.format(def_tag)
+            return
+
+        prefix = pattern.format('')
+        for key in self.conn.scan_iter(match='{}*'.format(glob_escape(prefix)), count=batch_size):
+            yield key[len(prefix):], key
+
+    def _convert_list(self, key):
+        """ Rewrites records of a history list in the configured codec. Returns the number of records rewritten.
+        """
+        with self.conn.pipeline() as pipe:
+            while True:
+                try:
+                    pipe.watch(key)
+                    values = pipe.lrange(key, 0, -1)
+                    converted = [self._convert(value) for value in values]
+                    count = sum(1 for value, new_value in zip(values, converted) if value is not new_value)
+
+                    if count:
+                        pipe.multi()
+                        pipe.delete(key)
+                        pipe.rpush(key, *converted)
+                        pipe.execute()
+
+                    return count
+
+                except WatchError:
+                    continue
+
+    def _convert_hash_page(self, key, object_tags):
+        """ Rewrites records of current states of objects in the configured codec. Returns the number of records rewritten.
+        """
+        with self.conn.pipeline() as pipe:
+            while True:
+                try:
+                    pipe.watch(key)
+                    values = dict((object_tag, self._convert(value)) for object_tag, value
+                        in zip(object_tags, pipe.hmget(key, object_tags)) if value and not is_record_in(value, self.codec))
+
+                    if values:
+                        pipe.multi()
+                        pipe.hmset(key, values)
+                        pipe.execute()
+
+                    return len(values)
+
+                except WatchError:
+                    continue
+
+    def convert_records(self, def_tag=None, batch_size=1000, pause=0):
+        """ Rewrites data of all definitions, unless def_tag is given, in the format new records are stored in, i.e.
+        moves history from legacy hashes to lists and encodes current states and transitions in lists in the configured codec.
+        Pauses for pause seconds after each batch_size objects. Returns the number of records rewritten.
+        """
+        total = 0
+        objects = 0
+
+        # Legacy hashes, one field per object ..
+        for _def_tag, key in self._iter_def_keys(self.PATTERN_STATE_HISTORY, def_tag, batch_size):
+            for object_tag, _ in self.conn.hscan_iter(key, count=batch_size):
+                total += self._move_legacy_history(object_tag, _def_tag)
+                objects += 1
+
+                if pause and objects % batch_size == 0:
+                    sleep(pause)
+
+        # .. history lists, one key per object ..
+        prefix = self._get_history_key('', def_tag) if def_tag else self.PATTERN_STATE_HISTORY_LIST.split('{}')[0]
+
+        for key in self.conn.scan_iter(match='{}*'.format(glob_escape(prefix)), count=batch_size):
+            total += self._convert_list(key)
+            objects += 1
+
+            if pause and objects % batch_size == 0:
+                sleep(pause)
+
+        # .. and current states, in one or more hashes per definition, rewritten a page at a time.
+        for key in self._iter_current_keys(def_tag, batch_size):
+            object_tags = []
+
+            for object_tag, _ in self.conn.hscan_iter(key, count=batch_size):
+                object_tags.append(object_tag)
+
+                if len(object_tags) == batch_size:
+                    total += self._convert_hash_page(key, object_tags)
+                    object_tags = []
+
+                    if pause:
+                        sleep(pause)
+
+            if object_tags:
+                total += self._convert_hash_page(key, object_tags)
+
+        logger.info('Converted `%s` BST records to `%s`', total, self.codec)
+
+        return total
+
+    def convert_layout(self, def_tag=None, batch_size=1000, pause=0):
+        """ Moves current states of objects of all definitions, unless def_tag is given, from the previous layout
+        to the current one, batch_size objects in each transaction, while they may still be read and transitioned.
+        States that were already written to the current layout are kept as they are. Pauses for pause seconds after each batch.
+        Returns the number of objects moved.
+        """
+        if self.previous_buckets is None:
+            raise ValueError('No previous layout to move current states from')
+
+        total = 0
+
+        for _def_tag in self.get_current_def_tags(def_tag, batch_size):
+            for key in self._get_layout_keys(_def_tag, self.previous_buckets):
+                cursor = 0
+
+                while True:
+                    cursor, page = self.conn.hscan(key, cursor, count=batch_size)
+
+                    if page:
+                        pipe = self.conn.pipeline()
+                        for object_tag, value in sorted(page.items()):
+                            pipe.hsetnx(self._get_current_key(_def_tag, object_tag), object_tag, value)
+                        pipe.hdel(key, *page.keys())
+                        pipe.execute()
+
+                        total += len(page)
+
+                        if pause:
+                            sleep(pause)
+
+                    if not cursor:
+                        break
+
+            logger.info('Moved current states of `%s` to `%s` bucket(s), total:`%s`', _def_tag, self.current_buckets, total)
+
+        return total
+
+# ################################################################################################################################
+
+class HashRing(object):
+    """ A ring of nodes for consistent hashing, each node placed on it at a number of points. A key belongs to the node whose
+    point follows the key's own hash so adding or removing a node moves only the keys that belong to it, spread evenly
+    over the other nodes.
+    """
+    REPLICAS = 160 # How many points each node has on the ring
+
+    def __init__(self, nodes, replicas=REPLICAS):
+        points = []
+
+        for idx, node in enumerate(nodes):
+            for replica in range(replicas):
+                points.append((self.get_hash('{}-{}'.format(node, replica)), idx))
+
+        points.sort()
+
+        self._hashes = [point[0] for point in points]
+        self._nodes = [point[1] for point in points]
+
+    @staticmethod
+    def get_hash(key):
+        """ Returns a 64-bit integer hash of a key, the same in all processes, unlike the built-in hash.
+        """
+        return unpack(b'>Q', md5(key.encode('utf8')).digest()[:8])[0]
+
+    def get_node(self, key):
+        """ Returns the index, in the list of nodes, of the node a key belongs to.
+        """
+        return self._nodes[bisect(self._hashes, self.get_hash(key)) % len(self._nodes)]
+
+# ################################################################################################################################
+
+class ShardedRedisBackend(StateBackendBase):
+    """ Spreads objects over many Redis connections, each object kept by the RedisBackend of the shard that its object_tag
+    belongs to through consistent hashing, so that no definition is a single hot key. Operations on more than one object
+    are split by shard, each shard's part pipelined as in RedisBackend, and what is read from all shards is merged.
+    Shards are named after their positions unless names are given, e.g. so that they can be reordered. Events have IDs
+    prefixed with positions of their shards and cursors are lists of positions in each shard's stream. Events of each object
+    are in the order of its transitions but those of objects in different shards only in the order of times of their IDs.
+    kwargs are passed to each RedisBackend.
+    """
+    def __init__(self, conns, names=None, replicas=HashRing.REPLICAS, **kwargs):
+        if not conns:
+            raise ValueError('At least one connection is required')
+
+        names = names or ['shard-{}'.format(idx) for idx in range(len(conns))]
+
+        if len(names) != len(conns) or len(set(names)) != len(names):
+            raise ValueError('Each connection needs a unique name')
+
+        self.shards = [RedisBackend(conn, **kwargs) for conn in conns]
+        self.ring = HashRing(names, replicas)
+        self.supports_atomic_transition = self.shards[0].supports_atomic_transition
+
+        # Which shard consumer groups start reading from, rotated so that each is read from first in turn
+        self._next_group_shard = 0
+
+    def get_shard(self, object_tag):
+        """ Returns the backend of the shard a given object is kept in.
+        """
+        return self.shards[self.ring.get_node(object_tag)]
+
+    def _split(self, items, get_object_tag=None):
+        """ Returns a dictionary of backends of shards to lists of items, in the order they are given in, that belong to them.
+        """
+        out = OrderedDict()
+        for item in items:
+            out.setdefault(self.get_shard(get_object_tag(item) if get_object_tag else item), []).append(item)
+
+        return out
+
+# ################################################################################################################################
+
+    def get_current_state_info(self, object_tag, def_tag):
+        return self.get_shard(object_tag).get_current_state_info(object_tag, def_tag)
+
+    def get_history(self, object_tag, def_tag, limit=None, offset=0, since_ts=None, until_ts=None, newest_first=False):
+        return self.get_shard(object_tag).get_history(object_tag, def_tag, limit, offset, since_ts, until_ts, newest_first)
+
+    def set_current_state_info(self, object_tag, def_tag, state_info):
+        self.get_shard(object_tag).set_current_state_info(object_tag, def_tag, state_info)
+
+    def set_current_state_info_if(self, object_tag, def_tag, state_info, version):
+        return self.get_shard(object_tag).set_current_state_info_if(object_tag, def_tag, state_info, version)
+
+    def transition_atomic(self, object_tag, def_tag, state_info, any_state, allow_none, state_sources, version=None):
+        return self.get_shard(object_tag).transition_atomic(
+            object_tag, def_tag, state_info, any_state, allow_none, state_sources, version)
+
+    def trim_history(self, object_tag, def_tag, max_history=None, min_ts=None, on_trim=None):
+        return self.get_shard(object_tag).trim_history(object_tag, def_tag, max_history, min_ts, on_trim)
+
+# ################################################################################################################################
+
+    def get_current_state_info_many(self, object_tags, def_tag):
+        out = {}
+        for shard, shard_object_tags in self._split(object_tags).items():
+            out.update(shard.get_current_state_info_many(shard_object_tags, def_tag))
+
+        return out
+
+    def set_current_state_info_many(self, def_tag, state_infos):
+
+        # All transitions of an object go to the same shard so they keep their order
+        for shard, shard_state_infos in self._split(state_infos, itemgetter(0)).items():
+            shard.set_current_state_info_many(def_tag, shard_state_infos)
+
+    def set_current_state_info_many_if(self, def_tag, state_infos, versions):
+        conflicts = set()
+        for shard, shard_state_infos in self._split(state_infos, itemgetter(0)).items():
+            conflicts.update(shard.set_current_state_info_many_if(def_tag, shard_state_infos, versions))
+
+        return conflicts
+
+# ################################################################################################################################
+
+    def get_objects_in_state(self, def_tag, state, limit=100, cursor=None):
+
+        # Cursors point to positions in the order of times objects entered their states, which is the same in all shards,
+        # so each shard is asked for a page after the cursor and the pages are merged.
+        objects = []
+
+        for shard in self.shards:
+            for object_tag, state_info in shard.get_objects_in_state(def_tag, state, limit, cursor)[0]:
+                objects.append((get_ts_score(parse_ts(state_info['transition_ts_utc'])), object_tag, state_info))
+
+        objects = sorted(objects, key=itemgetter(0, 1))[:limit]
+
+        return [(object_tag, state_info) for _, object_tag, state_info in objects], (
+            get_state_cursor(repr(objects[-1][0]), objects[-1][1]) if objects and len(objects) == limit else None)
+
+    def get_expired(self, def_tag, until_ts, limit=100):
+        expired = []
+
+        for shard in self.shards:
+            expired.extend(shard.get_expired(def_tag, until_ts, limit))
+
+        return sorted(expired, key=lambda elem: (parse_ts(elem[1]['deadline_utc']), elem[0]))[:limit]
+
+    def index_current_states(self, def_tag=None, batch_size=1000, pause=0):
+        return sum(shard.index_current_states(def_tag, batch_size, pause) for shard in self.shards)
+
+# ################################################################################################################################
+
+    def get_state_stats(self, def_tag, since_ts):
+        states = {}
+        edges = {}
+
+        for shard in self.shards:
+            stats = shard.get_state_stats(def_tag, since_ts)
+
+            for state, count in stats['states'].items():
+                states[state] = states.get(state, 0) + count
+
+            for elem in stats['transitions']:
+                minute = datetime.strptime(elem['minute'], CONST.STATS_MINUTE_FORMAT)
+                key = minute, get_edge_name(elem['state_old'], elem['state_new'])
+                edges[key] = edges.get(key, 0) + elem['count']
+
+        return get_stats_out(states, edges)
+
+    def rebuild_state_counts(self, def_tag):
+        states = {}
+
+        for shard in self.shards:
+            for state, count in shard.rebuild_state_counts(def_tag).items():
+                states[state] = states.get(state, 0) + count
+
+        return states
+
+    def prune_state_stats(self):
+        return sum(shard.prune_state_stats() for shard in self.shards)
+
+# ################################################################################################################################
+
+    def iter_history_objects(self, def_tag, batch_size=100):
+        return self._iter_batches('iter_history_objects', def_tag, batch_size)
+
+    def iter_current_states(self, def_tag, batch_size=100):
+        return self._iter_batches('iter_current_states', def_tag, batch_size)
+
+    def _iter_batches(self, name, def_tag, batch_size):
+        """ Yields batches that a method of each shard yields, joined so that only the last one may be smaller than batch_size.
+        """
+        batch = []
+
+        for shard in self.shards:
+            for shard_batch in getattr(shard, name)(def_tag, batch_size):
+                batch.extend(shard_batch)
+
+                if len(batch) >= batch_size:
+                    yield batch[:batch_size]
+                    batch = batch[batch_size:]
+
+        if batch:
+            yield batch
+
+    def restore_objects(self, def_tag, objects):
+        for shard, shard_objects in self._split(objects, itemgetter(0)).items():
+            shard.restore_objects(def_tag, shard_objects)
+
+    def rename_def(self, old_def_name, old_def_version, new_def_name, new_def_version, batch_size=1000, pause=0,
+            on_progress=None):
+
+        # All shards are checked before any is renamed so that none is left renamed if another one cannot be
+        new_def_tag = Definition.get_tag(new_def_name, new_def_version)
+
+        for shard in self.shards:
+            if shard.has_objects(new_def_tag, batch_size):
+                raise ValueError('Definition `{}` already has objects'.format(new_def_tag))
+
+        return sum(shard.rename_def(old_def_name, old_def_version, new_def_name, new_def_version, batch_size, pause, on_progress)
+            for shard in self.shards)
+
+    def convert_records(self, def_tag=None, batch_size=1000, pause=0):
+        return sum(shard.convert_records(def_tag, batch_size, pause) for shard in self.shards)
+
+    def convert_layout(self, def_tag=None, batch_size=1000, pause=0):
+        return sum(shard.convert_layout(def_tag, batch_size, pause) for shard in self.shards)
+
+# ################################################################################################################################
+
+    def _get_event(self, idx, event):
+        event['id'] = '{}/{}'.format(idx, event['id'])
+        return event
+
+    def get_events(self, def_tag, cursor=None, limit=100):
+        cursors = cursor.split(',') if cursor else [''] * len(self.shards)
+
+        if len(cursors) != len(self.shards):
+            raise ValueError('Invalid cursor `{}`'.format(cursor))
+
+        # Stream IDs begin with times in milliseconds so events of all shards are merged in the order of their IDs
+        events = []
+
+        for idx, (shard, shard_cursor) in enumerate(zip(self.shards, cursors)):
+            for event in shard.get_events(def_tag, shard_cursor or None, limit)[0]:
+                events.append((tuple(int(elem) for elem in event['id'].split('-')), idx, event))
+
+        events = sorted(events, key=itemgetter(0, 1))[:limit]
+
+        for _, idx, event in events:
+            cursors[idx] = event['id']
+
+        return [self._get_event(idx, event) for _, idx, event in events], ','.join(cursors) if events else cursor
+
+    def read_event_group(self, def_tag, group, consumer, limit=100, pending=False):
+        start = self._next_group_shard
+        self._next_group_shard = (start + 1) % len(self.shards)
+
+        out = []
+
+        for idx in range(start, start + len(self.shards)):
+            idx = idx % len(self.shards)
+            out.extend(self._get_event(idx, event) for event in self.shards[idx].read_event_group(
+                def_tag, group, consumer, limit - len(out), pending))
+
+            if len(out) == limit:
+                break
+
+        return out
+
+    def ack_events(self, def_tag, group, ids):
+        by_shard = {}
+        for id in ids:
+            idx, id = id.split('/', 1)
+            by_shard.setdefault(int(idx), []).append(id)
+
+        return sum(self.shards[idx].ack_events(def_tag, group, shard_ids) for idx, shard_ids in by_shard.items())
+
+    def prune_events(self):
+        return sum(shard.prune_events() for shard in self.shards)
+
+# ################################################################################################################################
+
+class SQLBackend(StateBackendBase):
+    """ Keeps current states of objects in data_item rows and their history of transitions in data_bst_history,
+    one row per transition. Histories stored by previous versions as JSON lists in data_item are still read
+    unless read_legacy_history is False, e.g. once migrate.py has moved them over to data_bst_history, and with
+    convert_legacy_history they are moved over as soon as they are read. Likewise, rows are looked up by name
+    if not found by their lookup keys unless legacy_lookup is False, which can be set once migrate.py has filled in
+    lookup keys of all rows. With publish_events, transitions are also added to the data_bst_event outbox,
+    of which prune_events keeps about events_max_len newest rows per definition.
+    """
+    def __init__(self, session, cluster_id, read_legacy_history=True, legacy_lookup=True, label=label, stats_ttl=CONST.STATS_TTL,
+            convert_legacy_history=False, publish_events=False, events_max_len=CONST.EVENTS_MAX_LEN):
+
+        # Either a session shared by all callers or a factory, such as sessionmaker or scoped_session,
+        # to open a new session with for each operation, using connections from the engine's pool.
+        if isinstance(session, orm.Session):
+            self.session = session
+            self.session_factory = None
+        else:
+            self.session = None
+
+            # A scoped_session would hand out the session that the current thread may already be using elsewhere,
+            # so new sessions are opened with the sessionmaker underneath it instead.
+            if isinstance(session, orm.scoped_session):
+                session = session.session_factory
+
+            self.session_factory = session
+
+        self.cluster_id = cluster_id
+        self.read_legacy_history = read_legacy_history
+        self.convert_legacy_history = convert_legacy_history
+        self.legacy_lookup = legacy_lookup
+        self.stats_ttl = stats_ttl
+        self.publish_events = publish_events
+        self.events_max_len = events_max_len
+
+        # Sub-group name -> (sub_group_id, group_id), these never change so they are looked up once only
+        self._group_ids = {}
+
+        with self._get_session() as session:
+            self.engine = session.get_bind()
+            self._get_group_ids(session, label.sub_group.conf.process_bst)
+
+            # A dialect-specific INSERT .. ON CONFLICT/ON DUPLICATE KEY or None if the database has no such statement
+            self._upsert_current = self._get_upsert_current(session)
+
+            # Same as above but for counters in data_bst_state_count and data_bst_edge_count
+            self._upsert_counter = dict((table.name, self._get_upsert_counter(session, table)) for table in (
+                BSTStateCount.__table__, BSTEdgeCount.__table__))
+
+# ################################################################################################################################
+
+    @contextmanager
+    def _get_session(self):
+        """ Yields a session to work with - either the shared one or a new one that is closed, i.e. its connection
+        is returned to the pool, once the caller is done with it. Anything not committed is rolled back on error.
+        Only sessions opened here are closed, the shared one is left to its owner.
+        """
+        session = self.session or self.session_factory()
+
+        try:
+            yield session
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            if session is not self.session:
+                session.close()
+
+    def _run_in_transaction(self, func, *args):
+        """ Calls func with a session and the arguments given, then commits the session. Two transactions that add
+        the same history or state index rows of an object at once, e.g. because both numbered its next history row
+        before either committed, make one of them fail on a unique key, in which case it is rolled back and run again
+        to see what the other one committed, up to SQL_MAX_ATTEMPTS times in all.
+        """
+        for attempt in range(1, CONST.SQL_MAX_ATTEMPTS + 1):
+            with self._get_session() as session:
+                try:
+                    out = func(session, *args)
+                    session.commit()
+                    return out
+                except IntegrityError:
+                    session.rollback()
+                    if attempt == CONST.SQL_MAX_ATTEMPTS:
+                        raise
+                    logger.info('Running transaction again after a conflict, attempt:`%s`, func:`%s`', attempt, func.__name__)
+
+# ################################################################################################################################
+
+    def get_pool_stats(self):
+        """ Returns statistics of the engine's connection pool, as far as the pool's class provides them.
+        """
+        pool = self.engine.pool
+        out = {'status': pool.status()}
+
+        for name, attr in (('size', 'size'), ('checked_in', 'checkedin'), ('checked_out', 'checkedout'),
+                ('overflow', 'overflow')):
+            value = getattr(pool, attr, None)
+            if callable(value):
+                out[name] = value()
+
+        return out
+
+# ################################################################################################################################
+
+    def _get_items(self, session, names, for_update=False):
+        """ Returns a dictionary of names to data_item rows, looked up through their lookup keys, one IN query per chunk.
+        Unless legacy_lookup is False, rows without a lookup key yet are then looked up by their names.
+        With for_update, rows are locked until the session ends.
+        """
+        out = {}
+        names = list(names)
+
+        query = session.query(Item).with_for_update() if for_update else session.query(Item)
+
+        for chunk in chunks(names, CONST.SQL_IN_CHUNK_SIZE):
+            keys = dict((get_lookup_key(name), name) for name in chunk)
+
+            # Comparing names guards against hash collisions
+            for item in query.\
+                    filter(Item.lookup_key.in_(keys)).\
+                    filter(Item.cluster_id==self.cluster_id):
+                if keys.get(item.lookup_key) == item.name:
+                    out[item.name] = item
+
+        if self.legacy_lookup:
+            missing = [name for name in names if name not in out]
+
+            for chunk in chunks(missing, CONST.SQL_IN_CHUNK_SIZE):
+                for item in query.\
+                        filter(Item.name.in_(chunk)).\
+                        filter(Item.cluster_id==self.cluster_id):
+                    out[item.name] = item
+
+        return out
+
+# ################################################################################################################################
+
+    def _get_info(self, session, object_tag, def_tag, name_pattern, needs_item=False, for_update=False, label=label):
+        name = name_pattern % (def_tag, object_tag)
+        item = self._get_items(session, [name], for_update).get(name)
+
+        if item:
+            if needs_item:
+                return item
+            else:
+                return loads(item.value) if item.value else None
+
+# ################################################################################################################################
+
+    def _get_group_ids(self, session, sub_group_name):
+
+        if sub_group_name not in self._group_ids:
+            self._group_ids[sub_group_name] = session.query(SubGroup.id, SubGroup.group_id).\
+                filter(SubGroup.name==sub_group_name).\
+                filter(SubGroup.cluster_id==self.cluster_id).\
+                one()
+
+        return self._group_ids[sub_group_name]
+
+# ################################################################################################################################
+
+    def _get_upsert_current(self, session):
+        """ Returns a statement to insert or update a current state in data_item in one go, depending on what the database
+        supports, or None if it needs to be done through ORM.
+        """
+        dialect = session.get_bind().dialect
+
+        insert = 'INSERT INTO {} (name, value, lookup_key, is_internal, is_active, group_id, sub_group_id, cluster_id) ' \
+            'VALUES (:name, :value, :lookup_key, :is_internal, :is_active, :group_id, :sub_group_id, :cluster_id)'.format(
+                Item.__tablename__)
+
+        # Lookup keys are updated too in case rows were created by a previous version and have none yet
+        if dialect.name == 'postgresql' and dialect.server_version_info >= (9, 5):
+            insert = insert.replace('(name, ', '(id, name, ', 1).replace('(:name, ', "(nextval('data_item_seq'), :name, ", 1)
+            return text(insert + ' ON CONFLICT (name) DO UPDATE SET value = EXCLUDED.value, lookup_key = EXCLUDED.lookup_key')
+
+        elif dialect.name == 'mysql':
+            return text(insert + ' ON DUPLICATE KEY UPDATE value = VALUES(value), lookup_key = VALUES(lookup_key)')
+
+        elif dialect.name == 'sqlite' and sqlite_version_info >= (3, 24, 0):
+            return text(insert + ' ON CONFLICT (name) DO UPDATE SET value = excluded.value, lookup_key = excluded.lookup_key')
+
+# ################################################################################################################################
+
+    def _get_upsert_counter(self, session, table):
+        """ Returns a statement to add to a counter in a given table, creating it if it does not exist yet, depending on
+        what the database supports, or None if it needs to be done through an UPDATE followed by an INSERT.
+        """
+        dialect = session.get_bind().dialect
+
+        columns = [column.name for column in table.c if column.name not in ('id', 'value')]
+        insert = 'INSERT INTO {} ({}, value) VALUES ({}, :value)'.format(
+            table.name, ', '.join(columns), ', '.join(':' + column for column in columns))
+
+        if dialect.name == 'postgresql' and dialect.server_version_info >= (9, 5):
+            insert = insert.replace(' (', ' (id, ', 1).replace('VALUES (', "VALUES (nextval('{}_seq'), ".format(table.name), 1)
+            upsert = ' ON CONFLICT ({}) DO UPDATE SET value = {}.value + EXCLUDED.value'.format(', '.join(columns), table.name)
+
+        elif dialect.name == 'mysql':
+            upsert = ' ON DUPLICATE KEY UPDATE value = value + VALUES(value)'
+
+        elif dialect.name == 'sqlite' and sqlite_version_info >= (3, 24, 0):
+            upsert = ' ON CONFLICT ({}) DO UPDATE SET value = value + excluded.value'.format(', '.join(columns))
+
+        else:
+            return None
+
+        # Types are needed so that parameters, datetime objects in particular, are bound the same way ORM binds them
+        return text(insert + upsert).bindparams(*[bindparam(column.name, type_=column.type) for column in table.c
+            if column.name != 'id'])
+
+# ################################################################################################################################
+
+    def _add_to_counters(self, session, table, params):
+        """ Adds values to counters in a given table, creating those that do not exist yet.
+        """
+        upsert = self._upsert_counter[table.name]
+
+        if upsert is not None:
+            session.execute(upsert, params)
+            return
+
+        for item in params:
+            update = table.update()
+
+            for name, value in item.items():
+                if name != 'value':
+                    update = update.where(table.c[name]==value)
+
+            if not session.execute(update.values(value=table.c.value + item['value'])).rowcount:
+                session.execute(table.insert(), item)
+
+# ################################################################################################################################
+
+    def _update_stats(self, session, def_tag, state_infos):
+        """ Updates numbers of objects in each state and of transitions along each edge, out of deserialized transitions.
+        Counters are always updated in the same order so that concurrent transactions do not deadlock on them.
+        """
+        states, edges = get_stats_deltas(state_infos)
+
+        if states:
+            self._add_to_counters(session, BSTStateCount.__table__, [{
+                'cluster_id': self.cluster_id,
+                'def_tag': def_tag,
+                'state': state,
+                'value': delta,
+            } for state, delta in sorted(states.items())])
+
+        params = []
+
+        for (minute, edge), delta in sorted(edges.items()):
+            state_old, state_new = parse_edge_name(edge)
+            params.append({
+                'cluster_id': self.cluster_id,
+                'def_tag': def_tag,
+                'minute': minute,
+                'state_old': state_old or '',
+                'state_new': state_new,
+                'value': delta,
+            })
+
+        self._add_to_counters(session, BSTEdgeCount.__table__, params)
+
+# ################################################################################################################################
+
+    def _get_upsert_current_params(self, session, object_tag, def_tag, state_info, label=label):
+        sub_group_id, group_id = self._get_group_ids(session, label.sub_group.conf.process_bst)
+
+        name = label.item.process_bst_inst_current % (def_tag, object_tag)
+
+        return {
+            'name': name,
+            'value': state_info,
+            'lookup_key': get_lookup_key(name),
+            'is_internal': False,
+            'is_active': True,
+            'group_id': group_id,
+            'sub_group_id': sub_group_id,
+            'cluster_id': self.cluster_id,
+        }
+
+# ################################################################################################################################
+
+    def _create_item(self, session, sub_group_name, name_pattern, def_tag, object_tag):
+
+        sub_group_id, group_id = self._get_group_ids(session, sub_group_name)
+
+        item = Item()
+        item.name = name_pattern % (def_tag, object_tag)
+        item.lookup_key = get_lookup_key(item.name)
+        item.is_internal = False
+        item.cluster_id = self.cluster_id
+        item.group_id = group_id
+        item.sub_group_id = sub_group_id
+
+        return item
+
+# ################################################################################################################################
+
+    def _get_history_insert(self, object_tag, def_tag, state_info):
+        """ Returns an INSERT of a new history row numbered one above the object's latest one,
+        computed by the database in the same statement.
+        """
+        table = BSTHistory.__table__
+
+        query = select([
+            literal(self.cluster_id),
+            literal(def_tag),
+            literal(object_tag),
+            func.coalesce(func.max(table.c.seq), 0) + 1,
+            literal(get_transition_ts(state_info)),
+            literal(state_info)]).\
+            where(table.c.cluster_id==self.cluster_id).\
+            where(table.c.def_tag==def_tag).\
+            where(table.c.object_tag==object_tag)
+
+        return table.insert().from_select(
+            ['cluster_id', 'def_tag', 'object_tag', 'seq', 'transition_ts_utc', 'value'], query)
+
+# ################################################################################################################################
+
+    def get_current_state_info(self, object_tag, def_tag, needs_item=False):
+        with self._get_session() as session:
+            return self._get_info(session, object_tag, def_tag, label.item.process_bst_inst_current, needs_item)
+
+# ################################################################################################################################
+
+    def _get_history_query(self, session, columns, object_tag, def_tag):
+        return session.query(*columns).\
+            filter(BSTHistory.cluster_id==self.cluster_id).\
+            filter(BSTHistory.def_tag==def_tag).\
+            filter(BSTHistory.object_tag==object_tag)
+
+    def get_history(self, object_tag, def_tag, limit=None, offset=0, since_ts=None, until_ts=None, newest_first=False):
+        offset = offset or 0
+        since_ts, until_ts = parse_ts(since_ts), parse_ts(until_ts)
+
+        with self._get_session() as session:
+
+            if self.read_legacy_history:
+                legacy_item = self._get_info(session, object_tag, def_tag, label.item.process_bst_inst_history, True)
+                legacy = loads(legacy_item.value) if legacy_item and legacy_item.value else None
+
+                if legacy_item and self.convert_legacy_history:
+                    self._move_legacy_history(session, object_tag, def_tag, legacy_item, legacy or [])
+                    legacy = None
+            else:
+                legacy = None
+
+            query = self._get_history_query(session, [BSTHistory.value], object_tag, def_tag)
+
+            if since_ts:
+                query = query.filter(BSTHistory.transition_ts_utc >= since_ts)
+
+            if until_ts:
+                query = query.filter(BSTHistory.transition_ts_utc < until_ts)
+
+            # Legacy entries precede all rows so both need to be paged through together
+            if legacy:
+                history = legacy + [item.value for item in query.order_by(BSTHistory.seq)]
+                return filter_history(history, limit, offset, since_ts, until_ts, newest_first)
+
+            # Otherwise, the database does all of it using the index on seq
+            query = query.order_by(BSTHistory.seq.desc() if newest_first else BSTHistory.seq)
+
+            if offset:
+                query = query.offset(offset)
+
+            if limit is not None:
+                query = query.limit(limit)
+
+            return [item.value for item in query]
+
+# ################################################################################################################################
+
+    def _move_legacy_history(self, session, object_tag, def_tag, item, history):
+        """ Moves an object's transitions from a data_item row, where they are kept as a JSON list of JSON strings,
+        to data_bst_history, before any rows the object already has there, and commits the session.
+        """
+        query = self._get_history_query(session, [BSTHistory], object_tag, def_tag)
+
+        # Someone else may move them at the same time, in which case they end up where they should be anyway
+        try:
+            # Going through negative numbers means unique constraints hold throughout
+            query.update({BSTHistory.seq: -(BSTHistory.seq + len(history))}, synchronize_session=False)
+            query.update({BSTHistory.seq: -BSTHistory.seq}, synchronize_session=False)
+
+            if history:
+                session.execute(BSTHistory.__table__.insert(), [{
+                    'cluster_id': self.cluster_id,
+                    'def_tag': def_tag,
+                    'object_tag': object_tag,
+                    'seq': seq,
+                    'transition_ts_utc': get_transition_ts(value),
+                    'value': value,
+                } for seq, value in enumerate(history, 1)])
+
+            session.delete(item)
+            session.commit()
+
+        except IntegrityError:
+            session.rollback()
+
+    def iter_history_objects(self, def_tag, batch_size=100):
+        last = None
+
+        while True:
+            with self._get_session() as session:
+                query = session.query(BSTHistory.object_tag).distinct().\
+                    filter(BSTHistory.cluster_id==self.cluster_id).\
+                    filter(BSTHistory.def_tag==def_tag)
+
+                if last is not None:
+                    query = query.filter(BSTHistory.object_tag > last)
+
+                batch = [item.object_tag for item in query.order_by(BSTHistory.object_tag).limit(batch_size)]
+
+            if not batch:
+                return
+
+            yield batch
+            last = batch[-1]
+
+    def iter_current_states(self, def_tag, batch_size=100, label=label):
+        name_prefix = label.item.process_bst_inst_current % (def_tag, '')
+        last_id = 0
+
+        while True:
+            with self._get_session() as session:
+                items = session.query(Item.id, Item.value).\
+                    filter(Item.id > last_id).\
+                    filter(Item.cluster_id==self.cluster_id).\
+                    filter(Item.name.startswith(name_prefix)).\
+                    order_by(Item.id).\
+                    limit(batch_size).\
+                    all()
+
+            if not items:
+                return
+
+            batch = []
+
+            for item in items:
+                if item.value:
+                    state_info = loads(item.value)
+
+                    # Prefixes of names may match more than one definition
+                    if state_info['def_tag'] == def_tag:
+                        batch.append((state_info['object_tag'], state_info))
+
+            if batch:
+                yield batch
+
+            last_id = items[-1].id
+
+    def trim_history(self, object_tag, def_tag, max_history=None, min_ts=None, on_trim=None):
+        min_ts = parse_ts(min_ts)
+
+        with self._get_session() as session:
+            query = self._get_history_query(session, [BSTHistory.seq], object_tag, def_tag)
+
+            # The highest seq of transitions to remove
+            max_seq = None
+
+            if max_history is not None:
+                max_seq = query.order_by(BSTHistory.seq.desc()).offset(max(max_history, 1)).limit(1).scalar()
+
+            if min_ts:
+                newest_seq = query.order_by(BSTHistory.seq.desc()).limit(1).scalar()
+                if newest_seq is not None:
+                    seq = query.\
+                        filter(BSTHistory.transition_ts_utc < min_ts).\
+                        filter(BSTHistory.seq < newest_seq).\
+                        order_by(BSTHistory.seq.desc()).limit(1).scalar()
+                    max_seq = max(max_seq, seq)
+
+            if max_seq is None:
+                return 0
+
+            if on_trim:
+                values = self._get_history_query(session, [BSTHistory.value], object_tag, def_tag).\
+                    filter(BSTHistory.seq <= max_seq).\
+                    order_by(BSTHistory.seq)
+                on_trim(object_tag, def_tag, [item.value for item in values])
+
+            count = self._get_history_query(session, [BSTHistory], object_tag, def_tag).\
+                filter(BSTHistory.seq <= max_seq).\
+                delete(synchronize_session=False)
+
+            session.commit()
+
+            return count
+
+# ################################################################################################################################
+
+    def _set_current(self, session, object_tag, def_tag, state_info, current=None, needs_index=True, label=label):
+        """ Sets new state of an object without committing the session. current is the object's data_item row,
+        if it has been read already, and needs_index is False if data_bst_state has been updated already.
+        """
+        # The current state is written first so that its row stays locked while the next history row is numbered,
+        # which leaves only concurrent transactions adding the same new object to fail on unique keys.
+        if current is None and self._upsert_current is not None:
+            session.execute(self._upsert_current, self._get_upsert_current_params(session, object_tag, def_tag, state_info))
+
+        else:
+            current = current or self._get_info(
+                session, object_tag, def_tag, label.item.process_bst_inst_current, True, True) or self._create_item(
+                    session, label.sub_group.conf.process_bst, label.item.process_bst_inst_current, def_tag, object_tag)
+            current.value = state_info
+
+            session.add(current)
+            session.flush()
+
+        session.execute(self._get_history_insert(object_tag, def_tag, state_info))
+
+        info = loads(state_info)
+
+        if needs_index:
+            self._set_state_index(session, def_tag, {object_tag: get_state_index_entry(info)})
+
+        self._update_stats(session, def_tag, [info])
+
+        if self.publish_events:
+            self._add_events(session, def_tag, [(object_tag, state_info)])
+
+    def _add_events(self, session, def_tag, state_infos):
+        """ Adds transitions, given as (object_tag, state_info) tuples, to the outbox without committing the session.
+        """
+        session.execute(BSTEvent.__table__.insert(), [{'cluster_id':self.cluster_id, 'def_tag':def_tag, 'object_tag':object_tag,
+            'value':state_info} for object_tag, state_info in state_infos])
+
+    def set_current_state_info(self, object_tag, def_tag, state_info):
+        self._run_in_transaction(self._set_current, object_tag, def_tag, state_info)
+
+    def set_current_state_info_if(self, object_tag, def_tag, state_info, version, label=label):
+        with self._get_session() as session:
+
+            # The row stays locked until commit so no one can transition the object after its version is checked
+            current = self._get_info(session, object_tag, def_tag, label.item.process_bst_inst_current, True, True)
+
+            if get_state_version(loads(current.value) if current and current.value else None) != version:
+                session.rollback()
+                return False
+
+            state_info = set_state_version(state_info, version)
+
+            try:
+                # There is no row to lock yet for new objects but only one process may add them to data_bst_state
+                if version is None:
+                    state, ts, deadline = get_state_index_entry(loads(state_info))
+                    session.execute(BSTState.__table__.insert(), {'cluster_id':self.cluster_id, 'def_tag':def_tag,
+                        'object_tag':object_tag, 'state':state, 'transition_ts_utc':ts, 'deadline_utc':deadline})
+
+                self._set_current(session, object_tag, def_tag, state_info, current, version is not None)
+                session.commit()
+
+            except IntegrityError:
+                session.rollback()
+                return False
+
+            return True
+
+# ################################################################################################################################
+
+    def _get_current_items(self, session, object_tags, def_tag, for_update=False, label=label):
+        """ Returns a dictionary of object tags to data_item rows of their current states, locked if for_update is set.
+        """
+        names = dict((label.item.process_bst_inst_current % (def_tag, object_tag), object_tag) for object_tag in object_tags)
+        return dict((names[name], item) for name, item in self._get_items(session, names, for_update).items())
+
+# ################################################################################################################################
+
+    def get_current_state_info_many(self, object_tags, def_tag):
+        with self._get_session() as session:
+            items = self._get_current_items(session, object_tags, def_tag)
+            return dict((object_tag, loads(item.value)) for object_tag, item in items.items() if item.value)
+
+# ################################################################################################################################
+
+    def set_current_state_info_many(self, def_tag, state_infos):
+
+        state_infos = list(state_infos)
+        if state_infos:
+            self._run_in_transaction(self._set_many, def_tag, state_infos)
+
+    def set_current_state_info_many_if(self, def_tag, state_infos, versions):
+
+        state_infos = list(state_infos)
+        if not state_infos:
+            return set()
+
+        return self._run_in_transaction(self._set_many_if, def_tag, state_infos, versions)
+
+    def _set_many_if(self, session, def_tag, state_infos, versions):
+        """ Sets states of objects whose current states have the versions expected, without committing the session.
+        Returns tags of objects that do not.
+        """
+        object_tags = set(object_tag for object_tag, _ in state_infos)
+
+        # Rows stay locked until commit so no one can transition objects after their versions are checked
+        items = self._get_current_items(session, object_tags, def_tag, True)
+
+        conflicts = set(object_tag for object_tag in object_tags if get_state_version(
+            loads(items[object_tag].value) if object_tag in items and items[object_tag].value else None) != versions[object_tag])
+
+        to_write = [(object_tag, state_info) for object_tag, state_info in state_infos if object_tag not in conflicts]
+
+        if to_write:
+
+            # There are no rows to lock yet for new objects but only one transaction may add them to data_bst_state,
+            # the other one is run again and finds them.
+            states = dict((object_tag, get_state_index_entry(loads(state_info))) for object_tag, state_info in to_write
+                if versions[object_tag] is None)
+            self._insert_state_index(session, def_tag, states, states)
+
+            self._set_many(session, def_tag, set_state_versions(to_write, versions), items)
+
+        return conflicts
+
+    def _set_many(self, session, def_tag, state_infos, items=None):
+        """ Sets states of objects out of a list of (object_tag, state_info) tuples without committing the session.
+        items are data_item rows of objects' current states if they have been read, and locked, already.
+        """
+        # Current states are written first so that their rows stay locked while history rows are numbered, as in _set_current
+        self._write_current(session, def_tag, state_infos, items)
+
+        infos = self._add_history(session, def_tag, state_infos)
+
+        self._set_state_index(session, def_tag, dict(
+            (object_tag, get_state_index_entry(info)) for (object_tag, _), info in zip(state_infos, infos)))
+        self._update_stats(session, def_tag, infos)
+
+        if self.publish_events:
+            self._add_events(session, def_tag, state_infos)
+
+    def _write_current(self, session, def_tag, state_infos, items=None, label=label):
+        """ Writes current states of objects out of a list of (object_tag, state_info) tuples, the last one of each object
+        being its current state, without committing the session. items are as in _set_many.
+        """
+        object_tags = set(object_tag for object_tag, _ in state_infos)
+
+        # With native upserts there is no need to read rows beforehand
+        if self._upsert_current is not None:
+            current = OrderedDict()
+
+            for object_tag, state_info in state_infos:
+                current[object_tag] = self._get_upsert_current_params(session, object_tag, def_tag, state_info)
+
+            session.execute(self._upsert_current, current.values())
+
+        else:
+            if items is None:
+                items = self._get_current_items(session, object_tags, def_tag, True)
+
+            for object_tag, state_info in state_infos:
+                item = items.get(object_tag)
+                if not item:
+                    item = items[object_tag] = self._create_item(session,
+                        label.sub_group.conf.process_bst, label.item.process_bst_inst_current, def_tag, object_tag)
+                item.value = state_info
+
+            session.add_all(items[object_tag] for object_tag in object_tags)
+            session.flush()
+
+    def _add_history(self, session, def_tag, state_infos):
+        """ Appends transitions to history of objects out of a non-empty list of (object_tag, state_info) tuples,
+        without committing the session. Returns the transitions deserialized.
+        """
+        object_tags = set(object_tag for object_tag, _ in state_infos)
+
+        # Numbers of the latest history rows of each object
+        last_seq = {}
+        table = BSTHistory.__table__
+
+        for chunk in chunks(list(object_tags), CONST.SQL_IN_CHUNK_SIZE):
+            query = select([table.c.object_tag, func.max(table.c.seq)]).\
+                where(table.c.cluster_id==self.cluster_id).\
+                where(table.c.def_tag==def_tag).\
+                where(table.c.object_tag.in_(chunk)).\
+                group_by(table.c.object_tag)
+
+            last_seq.update(session.execute(query).fetchall())
+
+        history = []
+        infos = []
+
+        for object_tag, state_info in state_infos:
+
+            seq = last_seq[object_tag] = last_seq.get(object_tag, 0) + 1
+            transition_ts = get_transition_ts(state_info)
+            infos.append(loads(state_info))
+
+            history.append({
+                'cluster_id': self.cluster_id,
+                'def_tag': def_tag,
+                'object_tag': object_tag,
+                'seq': seq,
+                'transition_ts_utc': transition_ts,
+                'value': state_info,
+            })
+
+        session.execute(table.insert(), history)
+
+        return infos
+
+    def restore_objects(self, def_tag, objects):
+
+        objects = list(objects)
+        if objects:
+            self._run_in_transaction(self._restore_objects, def_tag, objects)
+
+    def _restore_objects(self, session, def_tag, objects):
+        """ Writes objects, as restore_objects does, without committing the session.
+        """
+        current = [(object_tag, state_info) for object_tag, state_info, _ in objects if state_info]
+
+        if current:
+            self._write_current(session, def_tag, current)
+            self._set_state_index(session, def_tag, dict(
+                (object_tag, get_state_index_entry(loads(state_info))) for object_tag, state_info in current))
+
+        history = [(object_tag, value) for object_tag, _, object_history in objects for value in object_history]
+
+        if history:
+            self._add_history(session, def_tag, history)
+
+# ################################################################################################################################
+
+    def _set_state_index(self, session, def_tag, states, only_newer=False):
+        """ Updates data_bst_state out of a dictionary of object tags to tuples of their current states, the times
+        they entered them and their deadlines, as returned by get_state_index_entry. With only_newer, states of objects
+        that have been transitioned later than that are kept.
+        """
+        table = BSTState.__table__
+
+        update = table.update().\
+            where(table.c.cluster_id==self.cluster_id).\
+            where(table.c.def_tag==def_tag).\
+            where(table.c.object_tag==bindparam('_object_tag'))
+
+        if only_newer:
+            update = update.where(table.c.transition_ts_utc <= bindparam('_ts'))
+
+        update = update.values(state=bindparam('_state'), transition_ts_utc=bindparam('_ts'), deadline_utc=bindparam('_deadline'))
+
+        # A single object is most likely to exist already so there is no need to check it first
+        if len(states) == 1 and not only_newer:
+            (object_tag, (state, ts, deadline)), = states.items()
+            if session.execute(update, {'_object_tag':object_tag, '_state':state, '_ts':ts, '_deadline':deadline}).rowcount:
+                return
+            existing = set()
+
+        else:
+            existing = set()
+            for chunk in chunks(list(states), CONST.SQL_IN_CHUNK_SIZE):
+                query = select([table.c.object_tag]).\
+                    where(table.c.cluster_id==self.cluster_id).\
+                    where(table.c.def_tag==def_tag).\
+                    where(table.c.object_tag.in_(chunk))
+                existing.update(row.object_tag for row in session.execute(query))
+
+            if existing:
+                session.execute(update, [{'_object_tag':object_tag, '_state':states[object_tag][0], '_ts':states[object_tag][1],
+                    '_deadline':states[object_tag][2]} for object_tag in existing])
+
+        self._insert_state_index(session, def_tag, states, [object_tag for object_tag in states if object_tag not in existing])
+
+    def _insert_state_index(self, session, def_tag, states, object_tags):
+        """ Adds data_bst_state rows of given objects out of states, in the format _set_state_index uses.
+        """
+        if object_tags:
+            session.execute(BSTState.__table__.insert(), [{
+                'cluster_id': self.cluster_id,
+                'def_tag': def_tag,
+                'object_tag': object_tag,
+                'state': states[object_tag][0],
+                'transition_ts_utc': states[object_tag][1],
+                'deadline_utc': states[object_tag][2],
+                } for object_tag in object_tags])
+
+    def get_objects_in_state(self, def_tag, state, limit=100, cursor=None):
+        with self._get_session() as session:
+
+            query = session.query(BSTState.object_tag, BSTState.transition_ts_utc).\
+                filter(BSTState.cluster_id==self.cluster_id).\
+                filter(BSTState.def_tag==def_tag).\
+                filter(BSTState.state==state)
+
+            if cursor:
+                last_ts, last_object_tag = parse_state_cursor(cursor)
+                last_ts = parse_ts(last_ts)
+
+                query = query.filter(or_(
+                    BSTState.transition_ts_utc > last_ts,
+                    and_(BSTState.transition_ts_utc==last_ts, BSTState.object_tag > last_object_tag)))
+
+            rows = query.order_by(BSTState.transition_ts_utc, BSTState.object_tag).limit(limit).all()
+            items = self._get_current_items(session, [row.object_tag for row in rows], def_tag)
+
+            out = [(row.object_tag, loads(items[row.object_tag].value)) for row in rows if row.object_tag in items]
+
+            if rows and len(rows) == limit:
+                return out, get_state_cursor(rows[-1].transition_ts_utc.isoformat(), rows[-1].object_tag)
+
+            return out, None
+
+    def index_current_states(self, def_tag=None, batch_size=1000, pause=0):
+        name_prefix = label.item.process_bst_inst_current % (def_tag, '') if def_tag else \
+            label.item.process_bst_inst_current.split('%s')[0]
+
+        last_id = 0
+        total = 0
+
+        while True:
+            with self._get_session() as session:
+
+                items = session.query(Item.id, Item.value).\
+                    filter(Item.id > last_id).\
+                    filter(Item.cluster_id==self.cluster_id).\
+                    filter(Item.name.startswith(name_prefix)).\
+                    order_by(Item.id).\
+                    limit(batch_size).\
+                    all()
+
+                if not items:
+                    return total
+
+                states = {}
+
+                for item in items:
+                    if item.value:
+                        state_info = loads(item.value)
+
+                        # Prefixes of names may match more than one definition
+                        if def_tag and state_info['def_tag'] != def_tag:
+                            continue
+
+                        states.setdefault(state_info['def_tag'], {})[state_info['object_tag']] = get_state_index_entry(state_info)
+
+                for _def_tag, _states in states.items():
+                    self._set_state_index(session, _def_tag, _states, True)
+                    total += len(_states)
+
+                session.commit()
+
+            last_id = items[-1].id
+
+            if pause:
+                sleep(pause)
+
+# ################################################################################################################################
+
+    def get_expired(self, def_tag, until_ts, limit=100):
+        with self._get_session() as session:
+
+            query = session.query(BSTState.object_tag).\
+                filter(BSTState.cluster_id==self.cluster_id).\
+                filter(BSTState.def_tag==def_tag).\
+                filter(BSTState.deadline_utc <= parse_ts(until_ts)).\
+                order_by(BSTState.deadline_utc, BSTState.object_tag).\
+                limit(limit)
+
+            object_tags = [row.object_tag for row in query]
+
+            items = self._get_current_items(session, object_tags, def_tag)
+
+            return [(object_tag, loads(items[object_tag].value)) for object_tag in object_tags if object_tag in items]
+
+# ################################################################################################################################
+
+    def get_state_stats(self, def_tag, since_ts):
+        with self._get_session() as session:
+
+            states = session.query(BSTStateCount.state, BSTStateCount.value).\
+                filter(BSTStateCount.cluster_id==self.cluster_id).\
+                filter(BSTStateCount.def_tag==def_tag).\
+                all()
+
+            rows = session.query(BSTEdgeCount.minute, BSTEdgeCount.state_old, BSTEdgeCount.state_new, BSTEdgeCount.value).\
+                filter(BSTEdgeCount.cluster_id==self.cluster_id).\
+                filter(BSTEdgeCount.def_tag==def_tag).\
+                filter(BSTEdgeCount.minute >= get_minute(parse_ts(since_ts))).\
+                all()
+
+            edges = dict(((row.minute, get_edge_name(row.state_old, row.state_new)), row.value) for row in rows)
+
+            return get_stats_out(dict((row.state, row.value) for row in states), edges)
+
+    def rebuild_state_counts(self, def_tag):
+        with self._get_session() as session:
+
+            query = session.query(BSTState.state, func.count(BSTState.id)).\
+                filter(BSTState.cluster_id==self.cluster_id).\
+                filter(BSTState.def_tag==def_tag).\
+                group_by(BSTState.state)
+
+            states = dict(query.all())
+
+            session.query(BSTStateCount).\
+                filter(BSTStateCount.cluster_id==self.cluster_id).\
+                filter(BSTStateCount.def_tag==def_tag).\
+                delete(synchronize_session=False)
+
+            if states:
+                session.execute(BSTStateCount.__table__.insert(), [{
+                    'cluster_id': self.cluster_id,
+                    'def_tag': def_tag,
+                    'state': state,
+                    'value': value,
+                } for state, value in states.items()])
+
+            session.commit()
+
+            return states
+
+    def prune_state_stats(self):
+        with self._get_session() as session:
+
+            count = session.query(BSTEdgeCount).\
+                filter(BSTEdgeCount.cluster_id==self.cluster_id).\
+                filter(BSTEdgeCount.minute < get_minute(datetime.utcnow() - timedelta(seconds=self.stats_ttl))).\
+                delete(synchronize_session=False)
+
+            session.commit()
+
+            return count
+
+# ################################################################################################################################
+
+    def _number_events(self, session, def_tag, limit):
+        """ Gives consecutive seq values to at most limit events of a definition that have none yet, in the order of their ids,
+        and returns how many there were. Only committed rows are seen so a transaction that commits late has its events
+        numbered after those of transactions that committed before it, rather than before a cursor that already read past them.
+        """
+        table = BSTEventCounter.__table__
+
+        update = table.update().\
+            where(table.c.cluster_id==self.cluster_id).\
+            where(table.c.def_tag==def_tag)
+
+        # Updating the counter locks its row, if there is one already, until commit, so other consumers wait for their turn
+        # and see the events numbered here once they get it. Two consumers adding the row at once make one of them fail
+        # on a unique key, in which case it is run again by _run_in_transaction.
+        if not session.execute(update.values(value=table.c.value)).rowcount:
+            session.execute(table.insert(), {'cluster_id':self.cluster_id, 'def_tag':def_tag, 'value':0})
+
+        last_seq = session.query(BSTEventCounter.value).\
+            filter(BSTEventCounter.cluster_id==self.cluster_id).\
+            filter(BSTEventCounter.def_tag==def_tag).\
+            scalar()
+
+        query = session.query(BSTEvent.id).\
+            filter(BSTEvent.cluster_id==self.cluster_id).\
+            filter(BSTEvent.def_tag==def_tag).\
+            filter(BSTEvent.seq.is_(None)).\
+            order_by(BSTEvent.id).\
+            limit(limit)
+
+        ids = [row.id for row in query]
+
+        if ids:
+            events = BSTEvent.__table__
+            session.execute(events.update().where(events.c.id==bindparam('_id')).values(seq=bindparam('_seq')),
+                [{'_id':id, '_seq':last_seq + idx} for idx, id in enumerate(ids, 1)])
+            session.execute(update.values(value=last_seq + len(ids)))
+
+        return len(ids)
+
+    def get_events(self, def_tag, cursor=None, limit=100):
+
+        # Events are read in the order they were numbered in, which is the order their transactions committed in,
+        # numbering first the ones committed since the last time, if any.
+        self._run_in_transaction(self._number_events, def_tag, limit)
+
+        with self._get_session() as session:
+            query = session.query(BSTEvent.seq, BSTEvent.object_tag, BSTEvent.value).\
+                filter(BSTEvent.cluster_id==self.cluster_id).\
+                filter(BSTEvent.def_tag==def_tag).\
+                filter(BSTEvent.seq > int(cursor or 0)).\
+                order_by(BSTEvent.seq).\
+                limit(limit)
+
+            events = [get_event(unicode(row.seq), row.object_tag, row.value) for row in query]
+
+        return events, events[-1]['id'] if events else cursor
+
+    def prune_events(self):
+        count = 0
+
+        with self._get_session() as session:
+            query = session.query(BSTEvent.def_tag).\
+                filter(BSTEvent.cluster_id==self.cluster_id).\
+                distinct()
+
+            for def_tag in [row.def_tag for row in query]:
+
+                # The newest of rows to delete, if there are more than are to be kept
+                last = session.query(BSTEvent.id).\
+                    filter(BSTEvent.cluster_id==self.cluster_id).\
+                    filter(BSTEvent.def_tag==def_tag).\
+                    order_by(BSTEvent.id.desc()).\
+                    offset(self.events_max_len).\
+                    first()
+
+                if last:
+                    count += session.query(BSTEvent).\
+                        filter(BSTEvent.cluster_id==self.cluster_id).\
+                        filter(BSTEvent.def_tag==def_tag).\
+                        filter(BSTEvent.id <= last.id).\
+                        delete(synchronize_session=False)
+
+            session.commit()
+
+        return count
+
+# ################################################################################################################################
+
+    def rename_def(self, old_def_name, old_def_version, new_def_name, new_def_version, batch_size=1000, pause=0,
+            on_progress=None, label=label):
+        old_def_tag = Definition.get_tag(old_def_name, old_def_version)
+        new_def_tag = Definition.get_tag(new_def_name, new_def_version)
+
+        with self._get_session() as session:
+            if session.query(Item.id).\
+                    filter(Item.cluster_id==self.cluster_id).\
+                    filter(Item.name.startswith(label.item.process_bst_inst_current % (new_def_tag, ''))).\
+                    first():
+                raise ValueError('Definition `{}` already has objects'.format(new_def_tag))
+
+        table = Item.__table__
+        update = table.update().\
+            where(table.c.id==bindparam('_id')).\
+            values(name=bindparam('_name'), lookup_key=bindparam('_lookup_key'), value=bindparam('_value'))
+
+        total = 0
+
+        # Names of rows in data_item have def_tags in them, and so do values of current states ..
+        for what, name_pattern in (('current states', label.item.process_bst_inst_current),
+                ('legacy histories', label.item.process_bst_inst_history)):
+
+            old_prefix = name_pattern % (old_def_tag, '')
+            is_current = name_pattern == label.item.process_bst_inst_current
+            last_id = 0
+            count = 0
+
+            while True:
+                with self._get_session() as session:
+
+                    items = session.query(Item.id, Item.name, Item.value).\
+                        filter(Item.id > last_id).\
+                        filter(Item.cluster_id==self.cluster_id).\
+                        filter(Item.name.startswith(old_prefix)).\
+                        order_by(Item.id).\
+                        limit(batch_size).\
+                        all()
+
+                    if not items:
+                        break
+
+                    params = []
+
+                    for item in items:
+                        value = item.value
+
+                        # Prefixes of names may match more than one definition, e.g. Orders.v1 and Orders.v1.v1,
+                        # so only rows whose values are of the old one are renamed and their def_tags rewritten.
+                        # Legacy histories with no transitions in them cannot tell whose they are and are left as they were.
+                        if is_current:
+                            if value:
+                                state_info = loads(value)
+
+                                if state_info['def_tag'] != old_def_tag:
+                                    continue
+
+                                state_info['def_tag'] = new_def_tag
+                                value = dumps(state_info)
+                        else:
+                            history = [loads(elem) for elem in loads(value)] if value else None
+
+                            if not history or history[0]['def_tag'] != old_def_tag:
+                                continue
+
+                            for state_info in history:
+                                state_info['def_tag'] = new_def_tag
+
+                            value = dumps([dumps(state_info) for state_info in history])
+
+                        name = name_pattern % (new_def_tag, item.name[len(old_prefix):])
+                        params.append({'_id':item.id, '_name':name, '_lookup_key':get_lookup_key(name), '_value':value})
+
+                    if params:
+                        session.execute(update, params)
+                        session.commit()
+
+                last_id = items[-1].id
+                count += len(params)
+                report_progress(old_def_tag, new_def_tag, what, count, pause, on_progress)
+
+            if is_current:
+                total = count
+
+        # .. whereas other tables have def_tags in columns of their own, which are updated for batches of objects at a time.
+        for what, model in (('state indexes', BSTState), ('histories', BSTHistory), ('events', BSTEvent)):
+            count = 0
+
+            while True:
+                with self._get_session() as session:
+
+                    query = session.query(model.object_tag).\
+                        filter(model.cluster_id==self.cluster_id).\
+                        filter(model.def_tag==old_def_tag).\
+                        distinct().\
+                        limit(batch_size)
+
+                    object_tags = [row.object_tag for row in query]
+
+                    if not object_tags:
+                        break
+
+                    session.query(model).\
+                        filter(model.cluster_id==self.cluster_id).\
+                        filter(model.def_tag==old_def_tag).\
+                        filter(model.object_tag.in_(object_tags)).\
+                        update({model.def_tag: new_def_tag}, synchronize_session=False)
+
+                    session.commit()
+
+                count += len(object_tags)
+                report_progress(old_def_tag, new_def_tag, what, count, pause, on_progress)
+
+        # Counters are few, one per state or per edge and minute, so they are all updated at once
+        with self._get_session() as session:
+            for model in (BSTStateCount, BSTEdgeCount, BSTEventCounter):
+                session.query(model).\
+                    filter(model.cluster_id==self.cluster_id).\
+                    filter(model.def_tag==old_def_tag).\
+                    update({model.def_tag: new_def_tag}, synchronize_session=False)
+
+            session.commit()
+
+        return total
+
+# ################################################################################################################################
+
+class CachingBackend(StateBackendBase):
+    """ Wraps another backend with an in-process LRU cache of current states of objects, each entry valid for ttl seconds
+    at most. Entries are invalidated on local writes and, if a Redis connection is given, each write is announced on
+    a pub/sub channel that other processes listen on, through start_listener, to invalidate their own entries.
+    """
+    CHANNEL = 'zato:bst:state:invalidate'
+
+    def __init__(self, backend, max_size=10000, ttl=60, conn=None, channel=CHANNEL):
+        self.backend = backend
+        self.max_size = max_size
+        self.ttl = ttl
+        self.conn = conn
+        self.channel = channel
+        self.supports_atomic_transition = backend.supports_atomic_transition
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        # (def_tag, object_tag) -> (expires_at, state_info), least recently used first
+        self._cache = OrderedDict()
+        self._lock = RLock()
+
+        # Bumped on each invalidation so that values read from backend before a concurrent write are not cached
+        self._version = 0
+
+        self._listener = None
+
+    def __getattr__(self, name):
+        # Anything specific to the underlying backend, such as SQLBackend.get_pool_stats
+        if name == 'backend':
+            raise AttributeError(name)
+        return getattr(self.backend, name)
+
+# ################################################################################################################################
+
+    def _get(self, key, now):
+        """ Returns a cached state or _MISSING if there is no valid one.
+        """
+        with self._lock:
+            entry = self._cache.pop(key, None)
+
+            if entry and entry[0] > now:
+                self._cache[key] = entry # Makes it the most recently used one
+                self.hits += 1
+                return entry[1]
+
+            self.misses += 1
+            return _MISSING
+
+    def _set(self, key, state_info, now, version):
+        with self._lock:
+
+            # Something was invalidated while the value was being read so it may be stale already
+            if version != self._version:
+                return
+
+            self._cache.pop(key, None)
+            self._cache[key] = (now + self.ttl, state_info)
+
+            while len(self._cache) > self.max_size:
+                self._cache.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, def_tag, object_tags):
+        """ Removes cached states of objects of a definition, or of all its objects if object_tags is None.
+        """
+        with self._lock:
+            self._version += 1
+
+            if object_tags is None:
+                object_tags = [object_tag for key_def_tag, object_tag in self._cache if key_def_tag == def_tag]
+
+            for object_tag in object_tags:
+                self._cache.pop((def_tag, object_tag), None)
+
+    def clear(self):
+        with self._lock:
+            self._version += 1
+            self._cache.clear()
+
+    def _on_write(self, def_tag, object_tags):
+        self.invalidate(def_tag, object_tags)
+
+        if self.conn:
+            self.conn.publish(self.channel, dumps({
+                'def_tag': def_tag, 'object_tags': list(object_tags) if object_tags is not None else None}))
+
+# ################################################################################################################################
+
+    def on_message(self, message):
+        """ Invalidates entries announced by another process on the pub/sub channel.
+        """
+        if message['type'] == 'message':
+            data = loads(message['data'])
+            self.invalidate(data['def_tag'], data['object_tags'])
+
+    def _listen(self):
+        while True:
+            try:
+                pubsub = self.conn.pubsub()
+                pubsub.subscribe(self.channel)
+
+                for message in pubsub.listen():
+
+                    # Anything other processes wrote while there was no subscription may be stale now
+                    if message['type'] == 'subscribe':
+                        self.clear()
+                    else:
+                        self.on_message(message)
+
+            except Exception:
+                logger.warn('Invalidation listener error, e:`%s`', format_exc())
+                sleep(1)
+
+    def start_listener(self):
+        """ Starts listening for invalidations from other processes in a background thread, or greenlet under gevent.
+        """
+        if not self._listener:
+            self._listener = Thread(target=self._listen, name='zato-bst-cache-invalidation')
+            self._listener.daemon = True
+            self._listener.start()
+
+# ################################################################################################################################
+
+    def get_stats(self):
+        """ Returns counters of cache hits and misses along with the current size of the cache.
+        """
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_ratio': float(self.hits) / total if total else 0.0,
+                'size': len(self._cache),
+                'max_size': self.max_size,
+            }
+
+# ################################################################################################################################
+
+    def get_current_state_info(self, object_tag, def_tag):
+        now = time()
+        key = (def_tag, object_tag)
+        state_info = self._get(key, now)
+
+        if state_info is _MISSING:
+            version = self._version
+            state_info = self.backend.get_current_state_info(object_tag, def_tag)
+            self._set(key, state_info, now, version)
+
+        # Callers are free to modify what they receive
+        return dict(state_info) if state_info else state_info
+
+    def get_current_state_info_many(self, object_tags, def_tag):
+        now = time()
+        out = {}
+        missing = []
+
+        for object_tag in object_tags:
+            state_info = self._get((def_tag, object_tag), now)
+            if state_info is _MISSING:
+                missing.append(object_tag)
+            elif state_info:
+                out[object_tag] = dict(state_info)
+
+        if missing:
+            version = self._version
+            data = self.backend.get_current_state_info_many(missing, def_tag)
+
+            for object_tag in missing:
+                state_info = data.get(object_tag)
+                self._set((def_tag, object_tag), state_info, now, version)
+                if state_info:
+                    out[object_tag] = dict(state_info)
+
+        return out
+
+# ################################################################################################################################
+
+    def set_current_state_info(self, object_tag, def_tag, state_info):
+        try:
+            self.backend.set_current_state_info(object_tag, def_tag, state_info)
+        finally:
+            self._on_write(def_tag, [object_tag])
+
+    def set_current_state_info_if(self, object_tag, def_tag, state_info, version):
+        try:
+            return self.backend.set_current_state_info_if(object_tag, def_tag, state_info, version)
+        finally:
+            self._on_write(def_tag, [object_tag])
+
+    def set_current_state_info_many(self, def_tag, state_infos):
+        state_infos = list(state_infos)
+        try:
+            self.backend.set_current_state_info_many(def_tag, state_infos)
+        finally:
+            self._on_write(def_tag, set(object_tag for object_tag, _ in state_infos))
+
+    def set_current_state_info_many_if(self, def_tag, state_infos, versions):
+        state_infos = list(state_infos)
+        try:
+            return self.backend.set_current_state_info_many_if(def_tag, state_infos, versions)
+        finally:
+            self._on_write(def_tag, set(object_tag for object_tag, _ in state_infos))
+
+    def transition_atomic(self, object_tag, def_tag, state_info, any_state, allow_none, state_sources, version=None):
+        try:
+            return self.backend.transition_atomic(object_tag, def_tag, state_info, any_state, allow_none, state_sources, version)
+        finally:
+            self._on_write(def_tag, [object_tag])
+
+# ################################################################################################################################
+
+    def rename_def(self, old_def_name, old_def_version, new_def_name, new_def_version, batch_size=1000, pause=0,
+            on_progress=None):
+        try:
+            return self.backend.rename_def(
+                old_def_name, old_def_version, new_def_name, new_def_version, batch_size, pause, on_progress)
+        finally:
+
+            # Objects are gone from the old definition and may have been cached as having no state in the new one
+            for def_tag in (Definition.get_tag(old_def_name, old_def_version), Definition.get_tag(new_def_name, new_def_version)):
+                self._on_write(def_tag, None)
+
+    def get_history(self, object_tag, def_tag, limit=None, offset=0, since_ts=None, until_ts=None, newest_first=False):
+        return self.backend.get_history(object_tag, def_tag, limit, offset, since_ts, until_ts, newest_first)
+
+    def get_objects_in_state(self, def_tag, state, limit=100, cursor=None):
+        return self.backend.get_objects_in_state(def_tag, state, limit, cursor)
+
+    def index_current_states(self, def_tag=None, batch_size=1000, pause=0):
+        return self.backend.index_current_states(def_tag, batch_size, pause)
+
+    def get_expired(self, def_tag, until_ts, limit=100):
+        return self.backend.get_expired(def_tag, until_ts, limit)
+
+    def get_state_stats(self, def_tag, since_ts):
+        return self.backend.get_state_stats(def_tag, since_ts)
+
+    def rebuild_state_counts(self, def_tag):
+        return self.backend.rebuild_state_counts(def_tag)
+
+    def prune_state_stats(self):
+        return self.backend.prune_state_stats()
+
+    def get_events(self, def_tag, cursor=None, limit=100):
+        return self.backend.get_events(def_tag, cursor, limit)
+
+    def read_event_group(self, def_tag, group, consumer, limit=100, pending=False):
+        return self.backend.read_event_group(def_tag, group, consumer, limit, pending)
+
+    def ack_events(self, def_tag, group, ids):
+        return self.backend.ack_events(def_tag, group, ids)
+
+    def prune_events(self):
+        return self.backend.prune_events()
+
+    def iter_history_objects(self, def_tag, batch_size=100):
+        return self.backend.iter_history_objects(def_tag, batch_size)
+
+    def iter_current_states(self, def_tag, batch_size=100):
+        return self.backend.iter_current_states(def_tag, batch_size)
+
+    def restore_objects(self, def_tag, objects):
+        objects = list(objects)
+        try:
+            return self.backend.restore_objects(def_tag, objects)
+        finally:
+            self._on_write(def_tag, set(object_tag for object_tag, _, _ in objects))
+
+    def trim_history(self, object_tag, def_tag, max_history=None, min_ts=None, on_trim=None):
+        return self.backend.trim_history(object_tag, def_tag, max_history, min_ts, on_trim)
+
+    def set_ctx(self, object_type, object_id, def_tag, transition_id, ctx=None):
+        return self.backend.set_ctx(object_type, object_id, def_tag, transition_id, ctx)
+
+# ################################################################################################################################
+
+class HistoryCompactor(object):
+    """ Trims history of objects according to retention settings of their definitions, optionally archiving
+    everything that is trimmed to gzip-compressed NDJSON files in archive_dir, one file per definition and run.
+    Objects are processed in batches of batch_size, pausing for pause seconds after each, so that compaction can run
+    in background alongside transitions.
+    """
+    def __init__(self, config, backend, archive_dir=None, batch_size=100, pause=0.1, interval=3600):
+        self.config = config
+        self.backend = backend
+        self.archive_dir = archive_dir
+        self.batch_size = batch_size
+        self.pause = pause
+        self.interval = interval
+        self._runner = None
+
+    def get_archive_path(self, def_tag, now):
+        return os.path.join(self.archive_dir, 'bst-history.{}.{}.ndjson.gz'.format(def_tag, now.strftime('%Y%m%dT%H%M%S%f')))
+
+    def compact_def(self, config_item, now=None):
+        """ Compacts history of all objects of a single definition. Returns a Bunch with the number of objects
+        that were looked into and the number of transitions removed.
+        """
+        now = now or datetime.utcnow()
+        def_tag = config_item.def_.tag
+        retention = config_item.retention
+        stats = Bunch(objects=0, trimmed=0, archive=None)
+
+        if not config_item.has_retention():
+            return stats
+
+        min_ts = now - timedelta(seconds=retention.max_history_age) if retention.max_history_age else None
+        archive = []
+
+        def on_trim(object_tag, def_tag, history):
+
+            # Everything must be safely stored before backends remove it
+            if not archive:
+                stats.archive = self.get_archive_path(def_tag, now)
+                archive.append(gzip.open(stats.archive, 'ab'))
+
+            for value in history:
+                value = to_json_record(value)
+                archive[0].write(value.encode('utf-8') if isinstance(value, unicode) else value)
+                archive[0].write(b'\n')
+
+            archive[0].flush()
+
+        try:
+            for object_tags in self.backend.iter_history_objects(def_tag, self.batch_size):
+
+                stopped = set()
+                if retention.compact_on_stop:
+                    for object_tag, state_info in self.backend.get_current_state_info_many(object_tags, def_tag).items():
+                        if state_info['state_current'] in config_item.force_stop:
+                            stopped.add(object_tag)
+
+                for object_tag in object_tags:
+
+                    # Objects that were stopped keep their last transition only
+                    max_history = 1 if object_tag in stopped else retention.max_history
+
+                    if max_history is not None or min_ts:
+                        stats.trimmed += self.backend.trim_history(
+                            object_tag, def_tag, max_history, min_ts, on_trim if self.archive_dir else None)
+
+                stats.objects += len(object_tags)
+
+                if self.pause:
+                    sleep(self.pause)
+
+        finally:
+            if archive:
+                archive[0].close()
+
+        return stats
+
+    def run(self):
+        """ Compacts history of all definitions that have retention settings, returning a dictionary of their tags
+        to what compact_def returned for each.
+        """
+        out = {}
+        now = datetime.utcnow()
+
+        for def_tag, config_item in sorted(self.config.items()):
+            if config_item.has_retention():
+                out[def_tag] = self.compact_def(config_item, now)
+                logger.info('Compacted history of `%s`, objects:`%s`, trimmed:`%s`, archive:`%s`',
+                    def_tag, out[def_tag].objects, out[def_tag].trimmed, out[def_tag].archive)
+
+        # Counters of transitions are kept for a limited time only, just like history is
+        pruned = self.backend.prune_state_stats()
+        if pruned:
+            logger.info('Pruned `%s` counters of transitions', pruned)
+
+        # Events published for consumers are capped as well
+        pruned = self.backend.prune_events()
+        if pruned:
+            logger.info('Pruned `%s` events of transitions', pruned)
+
+        return out
+
+    def _run_forever(self):
+        while True:
+            try:
+                self.run()
+            except Exception:
+                logger.warn('History compaction error, e:`%s`', format_exc())
+            sleep(self.interval)
+
+    def start(self):
+        """ Starts compacting history every interval seconds in a background thread, or greenlet under gevent.
+        """
+        if not self._runner:
+            self._runner = Thread(target=self._run_forever, name='zato-bst-history-compactor')
+            self._runner.daemon = True
+            self._runner.start()
+
+# ################################################################################################################################
+
+class DeadlineScheduler(object):
+    """ Moves objects that stay in states with timeouts for too long to timeout targets of their definitions. Deadlines
+    are kept in an index ordered by time, by backends, so each run costs as much as there are objects that timed out.
+    """
+    def __init__(self, sm, batch_size=100, interval=1, server_ctx=None):
+        self.sm = sm
+        self.batch_size = batch_size
+        self.interval = interval
+        self.server_ctx = server_ctx
+        self._runner = None
+
+    def time_out_def(self, def_tag, now=None):
+        """ Moves all objects of a definition that timed out by now, in batches. Returns a Bunch with the number
+        of objects found to have timed out and that of objects moved.
+        """
+        now = now or datetime.utcnow()
+        out = Bunch(expired=0, moved=0)
+
+        while True:
+            result = self.sm.time_out(def_tag, now, self.batch_size, self.server_ctx)
+            out.expired += result.expired
+            out.moved += result.moved
+
+            # Objects that could not be moved are still in the index so they would be found again
+            if result.expired < self.batch_size or not result.moved:
+                return out
+
+    def run(self, now=None):
+        """ Moves objects of all definitions with timeouts, returning a dictionary of their tags to what time_out_def
+        returned for each.
+        """
+        out = {}
+        now = now or datetime.utcnow()
+
+        for def_tag, config_item in sorted(self.sm.config.items()):
+            if config_item.timeouts:
+                out[def_tag] = self.time_out_def(def_tag, now)
+                if out[def_tag].expired:
+                    logger.info('Timed out objects of `%s`, expired:`%s`, moved:`%s`',
+                        def_tag, out[def_tag].expired, out[def_tag].moved)
+
+        return out
+
+    def _run_forever(self):
+        while True:
+            try:
+                self.run()
+            except Exception:
+                logger.warn('Deadline scheduler error, e:`%s`', format_exc())
+            sleep(self.interval)
+
+    def start(self):
+        """ Starts moving objects that timed out every interval seconds in a background thread, or greenlet under gevent.
+        """
+        if not self._runner:
+            self._runner = Thread(target=self._run_forever, name='zato-bst-deadline-scheduler')
+            self._runner.daemon = True
+            self._runner.start()
+
+# ################################################################################################################################
+
+class StateMachine(object):
+    def __init__(self, config=None, backend=None, run_set_up=True):
+        self.config = config
+        self.backend = backend
+        self.object_type_to_def = {}
+
+        # Prepares database and run-time structures
+        if run_set_up:
+            self.set_up()
+
+    def set_up(self):
+        # Map object types to definitions they are contained in.
+        for def_tag, config_item in self.config.items():
+
+            # Definitions may have been built by hand rather than parsed
+            if not config_item.compiled:
+                config_item.compile()
+
+            for object_type in config_item.objects:
+                defs = self.object_type_to_def.setdefault(object_type, [])
+                defs.append(def_tag)
+
+    @staticmethod
+    def get_object_tag(object_type, object_id):
+        return '{}.{}'.format(object_type, object_id)
+
+    def get_def_tag(self, object_type, object_id=None, state_new=None, def_name=None, def_version=None):
+        def_tag = self.object_type_to_def[object_type]
+
+        if len(def_tag) > 1:
+            msg = 'Ambiguous input. Object `{}` maps to more than one definition `{}` '\
                 '(id:`{}`, state_new:`{}`, def_name:`{}`, def_version:`{}`)'.format(
                 object_type, ', '.join(def_tag), object_id, state_new, def_name, def_version)
             logger.warn(msg)
@@ -507,13 +4062,20 @@ class StateMachine(object):
 
 # ################################################################################################################################
 
-    def get_transition_info(self, state_current, state_new, object_tag, def_tag, server_ctx, user_ctx, is_forced):
+    def get_transition_info(self, state_current, state_new, object_tag, def_tag, server_ctx, user_ctx, is_forced, version=None):
+        """ Returns a new state of an object, stamped with the version that follows a given one of the current state.
+        """
+        now = datetime.utcnow()
+        deadline = self.config[def_tag].get_deadline(state_new, now)
+
         return {
+            'version': (version or 0) + 1,
             'state_old': state_current,
             'state_current': state_new,
             'object_tag': object_tag,
             'def_tag': def_tag,
-            'transition_ts_utc': datetime.utcnow().isoformat(),
+            'transition_ts_utc': now.isoformat(),
+            'deadline_utc': deadline.isoformat() if deadline else None,
             'server_ctx': server_ctx,
             'user_ctx': user_ctx,
             'is_forced': is_forced or False
@@ -522,34 +4084,53 @@ class StateMachine(object):
 # ################################################################################################################################
 
     def can_transition(self, object_tag, state_new, def_tag, force=False):
+        return self.check_transition(object_tag, state_new, def_tag, force)[:4]
 
+    def check_transition(self, object_tag, state_new, def_tag, force=False):
+        """ Same as can_transition but also returns the version stamp of the current state the transition was validated
+        against, so that it can be performed later on by transition_if without reading the state again.
+        """
         # Obtain graph object's config
         config = self.config[def_tag]
 
         # Find the current state of this object in backend
         state_current_info = self.backend.get_current_state_info(object_tag, config.def_.tag)
+
+        return self._can_transition(
+            config, object_tag, state_new, def_tag, force, state_current_info) + (get_state_version(state_current_info),)
+
+    def _can_transition(self, config, object_tag, state_new, def_tag, force, state_current_info):
+        """ Validates a transition against an already known current state of an object, without accessing backend.
+        """
         state_current = state_current_info['state_current'] if state_current_info else None
 
-        # Could be a a forced transition so if state_new exists at all in the definition, this is all good.
-        if force and state_new in config.def_.nodes:
-            return True, '', state_current, state_new
+        compiled = config.compiled
+        state_new_id = compiled.get_id(state_new)
 
-        # Perhaps it's a forced stop interrupting the process immediately.
-        # However, unless forced to, we don't want to transition the same stop state.
-        if state_new in config.force_stop:
-            return True, '', state_current, state_new
+        if state_new_id is not None:
+
+            # Could be a a forced transition so if state_new exists at all in the definition, this is all good.
+            if force and compiled.is_node(state_new_id):
+                return True, '', state_current, state_new
+
+            # Perhaps it's a forced stop interrupting the process immediately.
+            # However, unless forced to, we don't want to transition the same stop state.
+            if compiled.is_force_stop(state_new_id):
+                return True, '', state_current, state_new
 
         # If not found and it's not a root node, just return False and reason - we cannot work with unknown objects
-        if not state_current_info and state_new not in config.def_.roots:
+        if not state_current_info and (state_new_id is None or not compiled.is_root(state_new_id)):
             msg = 'Object `{}` of `{}` not found and target state `{}` is not one of roots `{}`'.format(
-                object_tag, config.def_.tag, state_new, ', '.join(config.def_.roots))
+                object_tag, compiled.tag, state_new, ', '.join(compiled.root_names))
             logger.warn(msg)
             return False, msg, None, state_new
 
         # If there is no current state it means we want to transit to one of roots so the check below is skipped.
         if state_current:
 
-            if not config.def_.has_edge(state_current, state_new):
+            state_current_id = compiled.get_id(state_current)
+
+            if state_current_id is None or state_new_id is None or not compiled.has_edge(state_current_id, state_new_id):
                 msg = 'No transition found from `{}` to `{}` for `{}` in `{}`'.format(
                     state_current, state_new, object_tag, def_tag)
                 logger.warn(msg)
@@ -561,26 +4142,277 @@ class StateMachine(object):
 
     def transition(self, object_tag, state_new, def_tag, server_ctx, user_ctx=None, force=False, raise_on_error=True):
 
-        # Make sure this is a valid transition
-        can_transition, reason, state_current, _ = self.can_transition(object_tag, state_new, def_tag, force)
+        # Backends that can do it validate and write in one go, with no race between the two
+        if self.backend.supports_atomic_transition:
+            return self._transition_atomic(object_tag, state_new, def_tag, server_ctx, user_ctx, force, raise_on_error)
 
-        if not can_transition:
-            if raise_on_error:
-                raise TransitionError(reason)
-            else:
+        # Otherwise, the state is set only if the object has not been transitioned since it was validated,
+        # and validated again against its new state if it has.
+        for attempt in range(CONST.TRANSITION_MAX_ATTEMPTS):
+
+            # Make sure this is a valid transition
+            can_transition, reason, state_current, _, version = self.check_transition(object_tag, state_new, def_tag, force)
+
+            if not can_transition:
+                if raise_on_error:
+                    raise TransitionError(reason)
+                else:
+                    return can_transition, reason, state_current, state_new
+
+            if self.backend.set_current_state_info_if(object_tag, def_tag, dumps(self.get_transition_info(
+                    state_current, state_new, object_tag, def_tag, server_ctx, user_ctx, force, version)), version):
                 return can_transition, reason, state_current, state_new
 
-        self.backend.set_current_state_info(
-            object_tag, def_tag, dumps(self.get_transition_info(
-                state_current, state_new, object_tag, def_tag, server_ctx, user_ctx, force)))
+        msg = self._get_conflict_msg(object_tag, def_tag, state_current, state_new)
+
+        if raise_on_error:
+            raise TransitionConflictError(msg)
+
+        return False, msg, state_current, state_new
+
+    def _get_conflict_msg(self, object_tag, def_tag, state_current, state_new):
+        msg = 'Object `{}` of `{}` was transitioned by someone else after it was found in `{}`, '\
+            'cannot transition it to `{}`'.format(object_tag, def_tag, state_current, state_new)
+        logger.warn(msg)
+        return msg
+
+# ################################################################################################################################
+
+    def transition_if(self, object_tag, state_new, def_tag, state_current, version, server_ctx, user_ctx=None, force=False):
+        """ Performs a transition already validated by check_transition against state_current, of a given version stamp.
+        Raises TransitionConflictError if the object has been transitioned since then.
+        """
+        is_set = self.backend.set_current_state_info_if(object_tag, def_tag, dumps(self.get_transition_info(
+            state_current, state_new, object_tag, def_tag, server_ctx, user_ctx, force, version)), version)
+
+        if not is_set:
+            raise TransitionConflictError(self._get_conflict_msg(object_tag, def_tag, state_current, state_new))
+
+        return True, '', state_current, state_new
+
+# ################################################################################################################################
+
+    def _get_edge_args(self, config, state_new, force):
+        """ Returns the allowed edge set of a transition to state_new, as expected by backend.transition_atomic.
+        """
+        compiled = config.compiled
+        state_new_id = compiled.get_id(state_new)
+
+        if state_new_id is None:
+            return False, False, ()
+
+        any_state = (force and compiled.is_node(state_new_id)) or compiled.is_force_stop(state_new_id)
+        allow_none = any_state or compiled.is_root(state_new_id)
+        state_sources = () if any_state else compiled.sources[state_new_id]
+
+        return any_state, allow_none, state_sources
+
+    def _transition_atomic(self, object_tag, state_new, def_tag, server_ctx, user_ctx, force, raise_on_error):
+
+        config = self.config[def_tag]
+
+        # State_old is not known until backend reads it
+        transition_info = self.get_transition_info(None, state_new, object_tag, def_tag, server_ctx, user_ctx, force)
+        del transition_info['state_old']
+
+        is_allowed, state_current = self.backend.transition_atomic(
+            object_tag, def_tag, dumps(transition_info), *self._get_edge_args(config, state_new, force))
+
+        if is_allowed:
+            return True, '', state_current, state_new
+
+        # Validate it again against the state backend saw in order to get the same reason a non-atomic transition would
+        can_transition, reason, state_current, _ = self._can_transition(
+            config, object_tag, state_new, def_tag, force, {'state_current': state_current} if state_current else None)
+
+        if raise_on_error:
+            raise TransitionError(reason)
 
         return can_transition, reason, state_current, state_new
 
 # ################################################################################################################################
 
+    def _get_mass_transition_item(self, object_tag, state_new, def_tag, server_ctx, user_ctx=None, force=False,
+            raise_on_error=True):
+        return Bunch(object_tag=object_tag, state_new=state_new, def_tag=def_tag, server_ctx=server_ctx, user_ctx=user_ctx,
+            force=force, raise_on_error=raise_on_error)
+
     def mass_transition(self, items):
+        """ Performs transitions of many objects, each item being a tuple of arguments to self.transition. For each definition
+        involved, current states of all its objects are read from backend in one call, transitions are validated in memory
+        and all of them are written in another call. Returns a list of results of each transition, in the same format
+        self.transition does. If any item that should raise an exception is invalid, no transitions are written at all.
+
+        Transitions of an object are written only if it has not been transitioned since it was validated, otherwise
+        its items are validated again against its new state, as self.transition does, at which point transitions
+        of other objects may have been written already.
+        """
+        results = []
+        by_def_tag = OrderedDict()
+
+        for item in items:
+            item = self._get_mass_transition_item(*item)
+            by_def_tag.setdefault(item.def_tag, []).append((len(results), item))
+            results.append(None)
+
+        to_write = []
+
+        for def_tag, def_items in by_def_tag.items():
+            state_infos, versions = self._validate_mass_items(def_tag, def_items, results)
+            if state_infos:
+                to_write.append((def_tag, def_items, state_infos, versions))
+
+        for def_tag, def_items, state_infos, versions in to_write:
+            for attempt in range(CONST.TRANSITION_MAX_ATTEMPTS):
+
+                conflicts = self.backend.set_current_state_info_many_if(def_tag, state_infos, versions)
+                if not conflicts:
+                    break
+
+                def_items = [(idx, elem) for idx, elem in def_items if elem.object_tag in conflicts]
+                state_infos, versions = self._validate_mass_items(def_tag, def_items, results)
+
+                if not state_infos:
+                    break
+
+            else:
+                for idx, item in def_items:
+                    can_transition, _, state_current, state_new = results[idx]
+                    if can_transition:
+                        msg = self._get_conflict_msg(item.object_tag, def_tag, state_current, state_new)
+
+                        if item.raise_on_error:
+                            raise TransitionConflictError(msg)
+
+                        results[idx] = False, msg, state_current, state_new
+
+        return results
+
+    def _validate_mass_items(self, def_tag, def_items, results):
+        """ Validates (idx, item) tuples of a definition against current states of their objects, storing each result
+        under its idx in results. Returns transitions to write and versions of the current states they were validated against.
+        """
+        config = self.config[def_tag]
+        current = self.backend.get_current_state_info_many(set(item.object_tag for _, item in def_items), def_tag)
+
+        state_infos = []
+        versions = {}
+
+        for idx, item in def_items:
+            result = results[idx] = self._can_transition(
+                config, item.object_tag, item.state_new, def_tag, item.force, current.get(item.object_tag))
+
+            can_transition, reason, state_current, _ = result
+
+            if not can_transition:
+                if item.raise_on_error:
+                    raise TransitionError(reason)
+                continue
+
+            version = get_state_version(current.get(item.object_tag))
+            versions.setdefault(item.object_tag, version)
+
+            # Later items may transition the same object again so they need to see its new state
+            transition_info = current[item.object_tag] = self.get_transition_info(
+                state_current, item.state_new, item.object_tag, def_tag, item.server_ctx, item.user_ctx, item.force, version)
+
+            state_infos.append((item.object_tag, dumps(transition_info)))
+
+        return state_infos, versions
+
+# ################################################################################################################################
+
+    def _get_bulk_item(self, item, server_ctx):
+        """ Returns arguments to mass_transition out of a dictionary with the same keys labs.proc.bst.transition expects
+        or a result explaining why the item is invalid.
+        """
+        if isinstance(item, Exception):
+            return get_bulk_result(False, str(item))
+
+        if not isinstance(item, dict):
+            return get_bulk_result(False, 'Expected an object instead of `{}`'.format(item))
+
+        missing = [name for name in ('object_type', 'object_id', 'state_new') if item.get(name) in (None, '')]
+        if missing:
+            return get_bulk_result(False, 'Missing {}'.format(', '.join('`{}`'.format(name) for name in missing)))
+
+        object_type, object_id, state_new = item['object_type'], item['object_id'], item['state_new']
+
+        if object_type not in self.object_type_to_def:
+            return get_bulk_result(False, 'Unknown object type `{}`'.format(object_type), None, state_new)
+
+        try:
+            def_tag = self.get_def_tag(object_type, object_id, state_new, item.get('def_name'), item.get('def_version'))
+        except TransitionError as e:
+            return get_bulk_result(False, e.message, None, state_new)
+
+        force = item.get('force')
+        force = force if isinstance(force, bool) else unicode(force).lower() in CONST.TRUE_VALUES
+
+        return (self.get_object_tag(object_type, object_id), state_new, def_tag, server_ctx, item.get('user_ctx'), force, False)
+
+    def _transition_bulk_batch(self, batch):
+        results = iter(self.mass_transition([elem for elem in batch if isinstance(elem, tuple)]))
+
+        for elem in batch:
+            yield get_bulk_result(*next(results)) if isinstance(elem, tuple) else elem
+
+    def transition_many(self, items, server_ctx=None, batch_size=1000):
+        """ Performs transitions out of an iterable of dictionaries with the same keys labs.proc.bst.transition expects,
+        each batch_size of them with a single call to mass_transition. Yields a result of each item, in the same order,
+        as soon as its batch is done. Items that are invalid or cannot be transitioned do not stop the rest of them.
+        """
+        batch = []
+
         for item in items:
-            self.transition(*item)
+            batch.append(self._get_bulk_item(item, server_ctx))
+
+            if len(batch) == batch_size:
+                for result in self._transition_bulk_batch(batch):
+                    yield result
+                batch = []
+
+        if batch:
+            for result in self._transition_bulk_batch(batch):
+                yield result
+
+# ################################################################################################################################
+
+    def time_out(self, def_tag, now=None, limit=100, server_ctx=None):
+        """ Moves at most limit objects whose current states timed out by now to the timeout target of their definition.
+        Objects transitioned since they were found to have timed out are not moved. Returns a Bunch with the number
+        of objects found to have timed out and that of objects actually moved.
+        """
+        config = self.config[def_tag]
+        expired = self.backend.get_expired(def_tag, now or datetime.utcnow(), limit)
+        moved = 0
+
+        if self.backend.supports_atomic_transition:
+
+            # Objects are moved only if they are still in states that timed out, in case they have been transitioned since
+            for object_tag, state_info in expired:
+                transition_info = self.get_transition_info(
+                    None, config.timeout_target, object_tag, def_tag, server_ctx, None, True)
+                del transition_info['state_old']
+
+                is_allowed, _ = self.backend.transition_atomic(
+                    object_tag, def_tag, dumps(transition_info), False, False, (state_info['state_current'],))
+                moved += is_allowed
+
+        elif expired:
+
+            # Otherwise, objects are moved only if they still have the versions of states that timed out
+            state_infos = []
+            versions = {}
+
+            for object_tag, state_info in expired:
+                version = versions[object_tag] = get_state_version(state_info)
+                state_infos.append((object_tag, dumps(self.get_transition_info(
+                    state_info['state_current'], config.timeout_target, object_tag, def_tag, server_ctx, None, True, version))))
+
+            moved = len(expired) - len(self.backend.set_current_state_info_many_if(def_tag, state_infos, versions))
+
+        return Bunch(expired=len(expired), moved=moved)
 
 # ################################################################################################################################
 
@@ -591,10 +4423,59 @@ class StateMachine(object):
             state_info['def_tag'] = def_tag
             return state_info
 
+    def get_current_state_info_many(self, object_tags, def_tag):
+        """ Returns a dictionary of object tags to information on their current states, read from the backend at once,
+        skipping objects that have no state.
+        """
+        out = self.backend.get_current_state_info_many(object_tags, def_tag)
+
+        for object_tag, state_info in out.items():
+            state_info['object_tag'] = object_tag
+            state_info['def_tag'] = def_tag
+
+        return out
+
+# ################################################################################################################################
+
+    def get_history(self, object_tag, def_tag, limit=None, offset=0, since_ts=None, until_ts=None, newest_first=False):
+        return [decode_record(elem) for elem in self.backend.get_history(
+            object_tag, def_tag, limit, offset, since_ts, until_ts, newest_first)]
+
 # ################################################################################################################################
 
-    def get_history(self, object_tag, def_tag):
-        return [loads(elem) for elem in self.backend.get_history(object_tag, def_tag)]
+    def get_objects_in_state(self, def_tag, state, limit=100, cursor=None):
+        """ Returns a page of information on current states of objects that are in a given state, along with a cursor
+        to read the next page with, or None if there are no more pages.
+        """
+        objects, cursor = self.backend.get_objects_in_state(def_tag, state, limit, cursor)
+
+        out = []
+        for object_tag, state_info in objects:
+            state_info['object_tag'] = object_tag
+            state_info['def_tag'] = def_tag
+            out.append(state_info)
+
+        return out, cursor
+
+    def get_state_stats(self, def_tag, minutes=60):
+        """ Returns numbers of objects in each state of a definition along with numbers of transitions along each edge
+        in each of the last few minutes. Cost depends on the number of states and minutes, not on that of objects.
+        """
+        return self.backend.get_state_stats(def_tag, datetime.utcnow() - timedelta(minutes=minutes))
+
+    def get_events(self, def_tag, cursor=None, limit=100, group=None, consumer=None, pending=False):
+        """ Returns a batch of events of transitions in a definition along with a cursor to read the next one with. Events
+        are read either after cursor or, if group is given, by a consumer of that group, in which case the cursor returned
+        is None and events are to be acknowledged with ack_events once processed.
+        """
+        if group:
+            return self.backend.read_event_group(def_tag, group, consumer, limit, pending), None
+        return self.backend.get_events(def_tag, cursor, limit)
+
+    def ack_events(self, def_tag, group, ids):
+        """ Acknowledges events read by a consumer group, returning the number of those acknowledged.
+        """
+        return self.backend.ack_events(def_tag, group, ids)
 
 # ################################################################################################################################
 
@@ -665,6 +4546,8 @@ class transition_to(object):
         self.ctx = TransitionInfo(user_ctx)
         self.object_tag = StateMachine.get_object_tag(self.object_type, self.object_id)
         self.def_tag = '' # We cannot be certain what it is yet, we may not have definition's name/version yet
+        self.state_current = None
+        self.version = None
 
     def __enter__(self):
 
@@ -679,7 +4562,10 @@ class transition_to(object):
             self.def_tag = self.state_machine.get_def_tag(
                 self.object_type, self.object_id, self.state_new, self.def_name, self.def_version)
 
-        can_transition, reason, _, _= self.state_machine.can_transition(self.object_tag, self.state_new, self.def_tag, self.force)
+        # What the transition is validated against is kept so that it is not read again when the transition is performed
+        can_transition, reason, self.state_current, _, self.version = self.state_machine.check_transition(
+            self.object_tag, self.state_new, self.def_tag, self.force)
+
         if not can_transition:
             raise TransitionError(reason)
 
@@ -688,8 +4574,9 @@ class transition_to(object):
     def __exit__(self, exc_type, exc_value, traceback):
 
         if not exc_type:
-            # TODO: Use server_ctx in .transition
-            self.state_machine.transition(self.object_tag, self.state_new, self.def_tag, None, self.ctx, self.force)
+            # TODO: Use server_ctx in .transition_if
+            self.state_machine.transition_if(
+                self.object_tag, self.state_new, self.def_tag, self.state_current, self.version, None, self.ctx, self.force)
             return True
 
 # ################################################################################################################################
@@ -4,6 +4,7 @@ from __future__ import absolute_import, division, print_function, unicode_litera
 
 # stdlib
 import logging
+from multiprocessing import Process
 
 # Redis
 import redis
@@ -17,11 +18,15 @@ from zato.common.odb.model import Cluster
 
 # zato-labs
 try:
-    from zato_bst_core import RedisBackend
-    from zato_bst_sql import Item, label, SubGroup
+    from zato_bst_core import RedisBackend, SQLBackend
+    from zato_bst_migration import add_state_deadline, backfill_lookup_key, Checkpoint, get_redis_current_keys, \
+         migrate_sql_history, rebuild_redis_state_counts, rebuild_sql_state_counts, RedisMigration
+    from zato_bst_sql import BSTEdgeCount, BSTEvent, BSTEventCounter, BSTState, BSTStateCount
 except ImportError:
-    from zato.bst.core import RedisBackend
-    from zato.bst.sql import Item, label, SubGroup
+    from zato.bst.core import RedisBackend, SQLBackend
+    from zato.bst.migration import add_state_deadline, backfill_lookup_key, Checkpoint, get_redis_current_keys, \
+         migrate_sql_history, rebuild_redis_state_counts, rebuild_sql_state_counts, RedisMigration
+    from zato.bst.sql import BSTEdgeCount, BSTEvent, BSTEventCounter, BSTState, BSTStateCount
 
 # ################################################################################################################################
 
@@ -35,68 +40,124 @@ def get_session(engine):
     session.configure(bind=engine)
     return session()
 
+def get_engine(args):
+    connect_args = {'application_name':util.get_component_name('bst.migrate')} if args.odb_type == 'postgresql' else {}
+    return create_engine(odb_util.get_engine_url(args), connect_args=connect_args)
+
+def get_redis_conn(args):
+    redis_conn = redis.StrictRedis(args.redis_host, args.redis_port, password=args.redis_password)
+    redis_conn.ping()
+    return redis_conn
+
+# ################################################################################################################################
+
+def migrate_redis_worker(args, cluster_id, keys, worker_id):
+    """ Migrates a worker's share of objects from hashes of given keys, using connections and a checkpoint file of its own.
+    """
+    checkpoint = Checkpoint('{}.{}'.format(args.checkpoint, worker_id) if args.checkpoint else None)
+    session = get_session(get_engine(args))
+
+    try:
+        RedisMigration(session, cluster_id, get_redis_conn(args), keys, checkpoint, args.batch_size, args.pause,
+            worker_id, args.workers).run()
+    finally:
+        session.close()
+
 # ################################################################################################################################
 
 def migrate(args):
 
     logger.info('Migrating BST data using: `%s`', args.__dict__)
 
-    connect_args = {'application_name':util.get_component_name('bst.migrate')} if args.odb_type == 'postgresql' else {}
-    engine = create_engine(odb_util.get_engine_url(args), connect_args=connect_args)
+    engine = get_engine(args)
     session = get_session(engine)
 
     c = session.query(Cluster).\
         filter(Cluster.id==args.cluster_id).\
         one()
 
-    redis_conn = redis.StrictRedis(args.redis_host, args.redis_port, password=args.redis_password)
-    redis_conn.ping()
+    if args.action == 'sql-history':
+        total = migrate_sql_history(engine, session, c.id, args.batch_size, args.pause, Checkpoint(args.checkpoint))
+        logger.info('BST history migrated, objects:`%s`', total)
+        return
+
+    if args.action == 'lookup-key':
+        backfill_lookup_key(engine, session, c.id, args.batch_size, args.pause)
+        logger.info('BST lookup keys filled in')
+        return
+
+    if args.action == 'sql-events':
+        for table in (BSTEvent, BSTEventCounter):
+            table.__table__.create(engine, checkfirst=True)
+        logger.info('BST outbox of events created')
+        return
+
+    if args.action == 'state-index':
+        for table in (BSTState, BSTStateCount, BSTEdgeCount):
+            table.__table__.create(engine, checkfirst=True)
+
+        add_state_deadline(engine)
+
+        backend = SQLBackend(session, c.id)
+        total = backend.index_current_states(batch_size=args.batch_size, pause=args.pause)
+        rebuild_sql_state_counts(session, backend)
+
+        logger.info('BST state index and counters filled in, objects:`%s`', total)
+        return
+
+    redis_conn = get_redis_conn(args)
+
+    if args.action == 'redis-state-index':
+        backend = RedisBackend(redis_conn, current_buckets=args.buckets)
+        total = backend.index_current_states(batch_size=args.batch_size, pause=args.pause)
+        rebuild_redis_state_counts(redis_conn, backend)
 
-    for current_key in redis_conn.keys(RedisBackend.PATTERN_STATE_CURRENT.format('*')):
-        for object_tag, value in redis_conn.hgetall(current_key).items():
+        logger.info('BST state index and counters filled in Redis, objects:`%s`', total)
+        return
 
-            def_tag = current_key.replace(RedisBackend.PATTERN_STATE_CURRENT.replace('{}', ''), '')
+    if args.action == 'redis-records':
+        total = RedisBackend(redis_conn, codec=args.codec, current_buckets=args.buckets).convert_records(
+            batch_size=args.batch_size, pause=args.pause)
+        logger.info('BST records converted in Redis, records:`%s`', total)
+        return
 
-            sub_group_id, group_id = session.query(SubGroup.id, SubGroup.group_id).\
-                filter(SubGroup.name==label.sub_group.conf.process_bst).\
-                filter(SubGroup.cluster_id==c.id).\
-                one()
+    if args.action == 'redis-layout':
+        if args.previous_buckets is None:
+            raise ValueError('--previous_buckets is required to convert the layout of current states')
 
-            item = Item()
-            item.name = label.item.process_bst_inst_current % (def_tag, object_tag)
-            item.is_internal = False
-            item.cluster_id = c.id
-            item.group_id = group_id
-            item.sub_group_id = sub_group_id
-            item.value = value
+        backend = RedisBackend(redis_conn, current_buckets=args.buckets, previous_buckets=args.previous_buckets)
+        total = backend.convert_layout(batch_size=args.batch_size, pause=args.pause)
 
-            logger.info('Adding `current`, name:`%s`, value:`%s`', item.name, item.value)
+        logger.info('BST current states moved to `%s` bucket(s) in Redis, objects:`%s`', args.buckets, total)
+        return
 
-            session.add(item)
-            session.commit()
+    # Hashes of current states are found once and each worker goes through all of them, migrating its own share of objects
+    keys = get_redis_current_keys(redis_conn, args.batch_size)
 
-    for history_key in redis_conn.keys(RedisBackend.PATTERN_STATE_HISTORY.format('*')):
-        for object_tag, value in redis_conn.hgetall(history_key).items():
+    # Workers open connections of their own so the ones opened so far must not be shared with them
+    session.close()
+    engine.dispose()
 
-            def_tag = history_key.replace(RedisBackend.PATTERN_STATE_HISTORY.replace('{}', ''), '')
+    if args.workers > 1:
+        workers = [Process(target=migrate_redis_worker, args=(args, c.id, keys, worker_id),
+            name='bst-migrate-{}'.format(worker_id)) for worker_id in range(args.workers)]
 
-            sub_group_id, group_id = session.query(SubGroup.id, SubGroup.group_id).\
-                filter(SubGroup.name==label.sub_group.conf.process_bst).\
-                filter(SubGroup.cluster_id==c.id).\
-                one()
+        for worker in workers:
+            worker.start()
 
-            item = Item()
-            item.name = label.item.process_bst_inst_history % (def_tag, object_tag)
-            item.is_internal = False
-            item.cluster_id = c.id
-            item.group_id = group_id
-            item.sub_group_id = sub_group_id
-            item.value = value
+        for worker in workers:
+            worker.join()
 
-            logger.info('Adding `history`, name:`%s`, value:`%s`', item.name, item.value)
+        failed = [worker.name for worker in workers if worker.exitcode]
+        if failed:
+            logger.error('BST data not migrated, workers failed:`%s`, re-run to resume', ', '.join(failed))
+            return
+    else:
+        migrate_redis_worker(args, c.id, keys, 0)
 
-            session.add(item)
-            session.commit()
+    backend = SQLBackend(session, c.id)
+    backend.index_current_states(batch_size=args.batch_size)
+    rebuild_sql_state_counts(session, backend)
 
     logger.info('BST data migrated')
 
@@ -124,8 +185,29 @@ if __name__ == '__main__':
     parser.add_argument('--cluster_id', type=str, help='ID of cluster to install BST in', required=True)
     parser.add_argument('--dev_mode', type=str, help='(Reserved for internal use)', default=False)
 
-    parser.add_argument('--redis_host', type=str, help='Redis host to connect to', required=True)
-    parser.add_argument('--redis_port', type=str, help='Redis port to connect to', required=True)
+    parser.add_argument('--action', type=str,
+        help='What to migrate - Redis data to SQL, SQL history to data_bst_history, lookup keys of SQL rows, '
+        'current states of objects to the index of objects by state and counters of objects in each state, in SQL or in Redis, '
+        'Redis records to the format set with --codec, current states in Redis from the layout set with --previous_buckets '
+        'to the one set with --buckets, or to create the SQL outbox of events of transitions',
+        choices=('redis', 'sql-history', 'lookup-key', 'state-index', 'redis-state-index', 'redis-records', 'redis-layout',
+        'sql-events'), default='redis')
+    parser.add_argument('--batch_size', type=int, help='How many rows to update in one transaction', default=1000)
+    parser.add_argument('--pause', type=float, help='How many seconds to wait between batches', default=0.1)
+    parser.add_argument('--workers', type=int,
+        help='How many processes to migrate Redis data with, each taking its own share of objects', default=1)
+    parser.add_argument('--codec', type=str, help='What to encode Redis records with', choices=('json', 'msgpack'),
+        default='json')
+    parser.add_argument('--buckets', type=int,
+        help='How many hashes current states of each definition are kept in in Redis, 0 meaning a single one', default=0)
+    parser.add_argument('--previous_buckets', type=int,
+        help='How many hashes current states of each definition are being moved from in Redis, 0 meaning a single one')
+    parser.add_argument('--checkpoint', type=str,
+        help='Path to keep progress of migrating Redis data or SQL history in, so that an interrupted run resumes '
+        'where it stopped')
+
+    parser.add_argument('--redis_host', type=str, help='Redis host to connect to')
+    parser.add_argument('--redis_port', type=str, help='Redis port to connect to')
     parser.add_argument('--redis_password', type=str, help='Password for Redis user')
     parser.add_argument('--proc_names', type=str, help='Names of processes to migrate')
 
@@ -0,0 +1,511 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+# Part of Zato - Open-Source ESB, SOA, REST, APIs and Cloud Integrations in Python
+# https://zato.io
+
+""" Moves BST data between storage layouts and backends - Redis data to SQL, legacy SQL history to data_bst_history,
+lookup keys and indexes of states. migrate.py runs it from command line in a Zato environment, everything here needs
+only a SQLAlchemy session or engine and a Redis connection.
+"""
+
+# stdlib
+import logging
+import os
+from binascii import crc32
+from json import dumps
+from os.path import commonprefix
+from time import sleep
+
+# pyrapidjson
+from rapidjson import loads
+
+# SQLAlchemy
+from sqlalchemy import and_, bindparam, func, Index, inspect, select
+
+# zato-labs
+try:
+    from zato_bst_core import chunks, CONST, get_transition_ts, RedisBackend, to_json_record
+    from zato_bst_sql import BSTHistory, BSTState, get_lookup_key, Item, label, SubGroup
+except ImportError:
+    from zato.bst.core import chunks, CONST, get_transition_ts, RedisBackend, to_json_record
+    from zato.bst.sql import BSTHistory, BSTState, get_lookup_key, Item, label, SubGroup
+
+# ################################################################################################################################
+
+logger = logging.getLogger(__name__)
+
+# Checkpoint stage of migrate_sql_history
+SQL_HISTORY_STAGE = 'sql-history'
+
+# ################################################################################################################################
+
+def add_state_deadline(engine):
+    """ Adds data_bst_state.deadline_utc, along with its index, if the table was created before deadlines were introduced.
+    """
+    table = BSTState.__table__
+
+    if 'deadline_utc' not in [column['name'] for column in inspect(engine).get_columns(table.name)]:
+        logger.info('Adding column `%s.deadline_utc`', table.name)
+        engine.execute('ALTER TABLE {} ADD {} {}'.format(
+            table.name, 'deadline_utc', table.c.deadline_utc.type.compile(dialect=engine.dialect)))
+
+    if 'data_bst_state_deadline_idx' not in [index['name'] for index in inspect(engine).get_indexes(table.name)]:
+        logger.info('Adding index `data_bst_state_deadline_idx`')
+        Index('data_bst_state_deadline_idx', table.c.cluster_id, table.c.def_tag, table.c.deadline_utc).create(engine)
+
+# ################################################################################################################################
+
+def rebuild_sql_state_counts(session, backend):
+    """ Counts objects in each state of all definitions found in data_bst_state anew.
+    """
+    query = session.query(BSTState.def_tag).\
+        filter(BSTState.cluster_id==backend.cluster_id).\
+        distinct()
+
+    for def_tag, in query.all():
+        logger.info('Counting objects in states of `%s`, counts:`%s`', def_tag, backend.rebuild_state_counts(def_tag))
+
+def rebuild_redis_state_counts(redis_conn, backend):
+    """ Counts objects in each state of all definitions found in Redis anew.
+    """
+    for def_tag in backend.get_current_def_tags():
+        logger.info('Counting objects in states of `%s`, counts:`%s`', def_tag, backend.rebuild_state_counts(def_tag))
+
+# ################################################################################################################################
+
+def add_history(session, cluster_id, histories):
+    """ Writes history of objects, given as (def_tag, object_tag, list of serialized transitions) tuples, to data_bst_history
+    in one statement, numbering each object's transitions from 1, without committing the session.
+    """
+    rows = []
+
+    for def_tag, object_tag, history in histories:
+        for seq, value in enumerate(history, 1):
+            rows.append({
+                'cluster_id': cluster_id,
+                'def_tag': def_tag,
+                'object_tag': object_tag,
+                'seq': seq,
+                'transition_ts_utc': get_transition_ts(value),
+                'value': value,
+            })
+
+    if rows:
+        session.execute(BSTHistory.__table__.insert(), rows)
+
+# ################################################################################################################################
+
+class Checkpoint(object):
+    """ Progress of a migration, kept in a JSON file so that an interrupted run can resume where it stopped.
+    Nothing is kept if there is no path.
+    """
+    DONE = 'done'
+
+    def __init__(self, path=None):
+        self.path = path
+        self.data = {}
+
+        if path and os.path.exists(path):
+            with open(path) as f:
+                self.data = loads(f.read())
+            logger.info('Resuming from checkpoint `%s`, `%s`', path, self.data)
+
+    def get(self, stage):
+        return self.data.get(stage)
+
+    def set(self, stage, value):
+        self.data[stage] = value
+
+        if self.path:
+            # Replaced in one go so that the file is never left half-written
+            tmp_path = '{}.tmp'.format(self.path)
+            with open(tmp_path, 'w') as f:
+                f.write(dumps(self.data))
+            os.rename(tmp_path, self.path)
+
+    def is_done(self, stage):
+        return self.get(stage) == self.DONE
+
+    def set_done(self, stage):
+        self.set(stage, self.DONE)
+
+# ################################################################################################################################
+
+def get_redis_current_keys(redis_conn, batch_size=1000):
+    """ Returns sorted keys of all hashes that current states are kept in in Redis, in either layout.
+    """
+    keys = set()
+
+    for pattern in (RedisBackend.PATTERN_STATE_CURRENT.format('*'), RedisBackend.PATTERN_STATE_CURRENT_BUCKET.format('*', '*')):
+        keys.update(redis_conn.scan_iter(match=pattern, count=batch_size))
+
+    return sorted(keys)
+
+def get_worker_id(object_tag, workers):
+    """ Returns the ID of the worker, out of a given number of them, that an object is migrated by. An object always goes
+    to the same worker, no matter what other objects there are, so that each worker's checkpoint stays valid between runs.
+    """
+    return (crc32(object_tag.encode('utf8')) & 0xffffffff) % workers
+
+# ################################################################################################################################
+
+class RedisMigration(object):
+    """ Moves current states and history of objects from Redis to SQL. Objects are found in hashes of current states,
+    read with HSCAN cursors so as not to block Redis, and history of each one is read from its list, and the legacy hash,
+    along with its current state, so there is no need to SCAN the whole keyspace for history lists. Rows are written
+    in bulk, one batch per transaction, and progress is checkpointed after each. Batches are idempotent so the one that
+    was in progress when a run was interrupted can be safely written again.
+
+    keys are those of hashes this migration is to go through. With more than one worker, each goes through all of them
+    but migrates only objects that get_worker_id assigns to it, so that objects of a single hash are split between workers
+    too, each keeping a checkpoint of its own.
+    """
+    STAGE = 'current'
+
+    def __init__(self, session, cluster_id, redis_conn, keys, checkpoint=None, batch_size=1000, pause=0, worker_id=0,
+            workers=1):
+        self.session = session
+        self.cluster_id = cluster_id
+        self.redis_conn = redis_conn
+        self.keys = sorted(keys)
+        self.checkpoint = checkpoint or Checkpoint()
+        self.batch_size = batch_size
+        self.pause = pause
+        self.worker_id = worker_id
+        self.workers = workers
+
+        # These never change so they are looked up once only
+        self.sub_group_id, self.group_id = session.query(SubGroup.id, SubGroup.group_id).\
+            filter(SubGroup.name==label.sub_group.conf.process_bst).\
+            filter(SubGroup.cluster_id==cluster_id).\
+            one()
+
+    def _get_def_tag(self, key):
+        """ Returns a definition's tag out of a key of a hash of its current states, in either layout.
+        """
+        bucket_prefix = RedisBackend.PATTERN_STATE_CURRENT_BUCKET.split('{}')[0]
+
+        if key.startswith(bucket_prefix):
+            return key[len(bucket_prefix):].rsplit(':', 1)[0]
+
+        return key[len(RedisBackend.PATTERN_STATE_CURRENT.split('{}')[0]):]
+
+    def run(self):
+        """ Migrates objects from all hashes, one key after another. A checkpoint is a list of keys done with, along with
+        the key and HSCAN cursor to resume from.
+        """
+        if self.checkpoint.is_done(self.STAGE):
+            return
+
+        state = self.checkpoint.get(self.STAGE) or {}
+        done = set(state.get('done', []))
+
+        for key in self.keys:
+            if key in done:
+                continue
+
+            def_tag = self._get_def_tag(key)
+            cursor = state['cursor'] if key == state.get('key') else 0
+            items = []
+
+            while True:
+                cursor, page = self.redis_conn.hscan(key, cursor, count=self.batch_size)
+                items.extend(item for item in page.items()
+                    if self.workers == 1 or get_worker_id(item[0], self.workers) == self.worker_id)
+
+                # Batches end at page boundaries so that the cursor points to where the next one starts
+                if len(items) >= self.batch_size or not cursor:
+                    self.migrate_batch(def_tag, items)
+
+                    if not cursor:
+                        done.add(key)
+
+                    state = {'done': sorted(done), 'key': key, 'cursor': cursor}
+                    self.checkpoint.set(self.STAGE, state)
+
+                    logger.info('Worker `%s` migrated `%s` objects of `%s`, checkpoint:`%s`', self.worker_id, len(items),
+                        def_tag, state)
+                    items = []
+
+                    if self.pause:
+                        sleep(self.pause)
+
+                if not cursor:
+                    break
+
+        self.checkpoint.set_done(self.STAGE)
+
+    def migrate_batch(self, def_tag, items):
+        """ Writes current states of objects of a definition, given as (object_tag, value) tuples, and history
+        of the objects, both legacy and list one, in one transaction.
+        """
+        object_tags = [object_tag for object_tag, _ in items]
+
+        pipe = self.redis_conn.pipeline(False)
+        pipe.hmget(RedisBackend.PATTERN_STATE_HISTORY.format(def_tag), object_tags)
+
+        for object_tag in object_tags:
+            pipe.lrange(RedisBackend.PATTERN_STATE_HISTORY_LIST.format(def_tag, object_tag), 0, -1)
+
+        result = pipe.execute() if object_tags else [[]]
+        histories = []
+
+        # Legacy history, if any, is older than what is in lists
+        for object_tag, legacy, history in zip(object_tags, result[0], result[1:]):
+            history = (loads(legacy) if legacy else []) + [to_json_record(value) for value in history]
+            if history:
+                histories.append((def_tag, object_tag, history))
+
+        try:
+            self.add_current(def_tag, items)
+            self.add_history(histories)
+            self.session.commit()
+        except Exception:
+            self.session.rollback()
+            raise
+
+    def add_current(self, def_tag, items):
+        """ Writes current states of objects of a definition, given as (object_tag, value) tuples, updating rows that exist,
+        without committing the session.
+        """
+        table = Item.__table__
+        names = dict((label.item.process_bst_inst_current % (def_tag, object_tag), to_json_record(value))
+            for object_tag, value in items)
+        existing = {}
+
+        for chunk in chunks(list(names), CONST.SQL_IN_CHUNK_SIZE):
+            query = self.session.query(Item.name, Item.id).\
+                filter(Item.cluster_id==self.cluster_id).\
+                filter(Item.name.in_(chunk))
+
+            existing.update(query.all())
+
+        if existing:
+            update = table.update().where(table.c.id==bindparam('_id')).values(value=bindparam('_value'))
+            self.session.execute(update, [{'_id':existing[name], '_value':names[name]} for name in existing])
+
+        missing = [name for name in names if name not in existing]
+
+        if missing:
+            self.session.execute(table.insert(), [{
+                'name': name,
+                'value': names[name],
+                'lookup_key': get_lookup_key(name),
+                'is_internal': False,
+                'is_active': True,
+                'group_id': self.group_id,
+                'sub_group_id': self.sub_group_id,
+                'cluster_id': self.cluster_id,
+            } for name in missing])
+
+    def add_history(self, histories):
+        """ Appends history of objects, given as (def_tag, object_tag, list of serialized transitions) tuples, to what they
+        already have in data_bst_history, without committing the session. Transitions older than the newest one
+        an object already has are taken to be there, e.g. written by an interrupted run, so only values of the newest
+        rows are read, to tell apart transitions made at the same time. History is expected to be migrated before
+        objects are transitioned in SQL.
+        """
+        table = BSTHistory.__table__
+        by_def_tag = {}
+
+        for def_tag, object_tag, history in histories:
+            by_def_tag.setdefault(def_tag, {}).setdefault(object_tag, []).extend(history)
+
+        rows = []
+
+        for def_tag, def_histories in sorted(by_def_tag.items()):
+
+            last_seq = {}
+            last_ts = {}
+            newest = {}
+
+            for chunk in chunks(list(def_histories), CONST.SQL_IN_CHUNK_SIZE):
+                last = select([table.c.object_tag, func.max(table.c.seq).label('seq'),
+                        func.max(table.c.transition_ts_utc).label('ts')]).\
+                    where(table.c.cluster_id==self.cluster_id).\
+                    where(table.c.def_tag==def_tag).\
+                    where(table.c.object_tag.in_(chunk)).\
+                    group_by(table.c.object_tag).\
+                    alias()
+
+                for object_tag, seq, ts in self.session.execute(select([last.c.object_tag, last.c.seq, last.c.ts])):
+                    last_seq[object_tag] = seq
+                    last_ts[object_tag] = ts
+
+                query = select([table.c.object_tag, table.c.value]).\
+                    select_from(table.join(last, and_(
+                        table.c.object_tag==last.c.object_tag, table.c.transition_ts_utc==last.c.ts))).\
+                    where(table.c.cluster_id==self.cluster_id).\
+                    where(table.c.def_tag==def_tag)
+
+                for object_tag, value in self.session.execute(query):
+                    newest.setdefault(object_tag, set()).add(value)
+
+            for object_tag, history in def_histories.items():
+                for value in history:
+                    transition_ts = get_transition_ts(value)
+
+                    if object_tag in last_ts:
+                        if transition_ts < last_ts[object_tag]:
+                            continue
+                        if transition_ts == last_ts[object_tag] and value in newest[object_tag]:
+                            continue
+
+                    seq = last_seq[object_tag] = last_seq.get(object_tag, 0) + 1
+                    rows.append({
+                        'cluster_id': self.cluster_id,
+                        'def_tag': def_tag,
+                        'object_tag': object_tag,
+                        'seq': seq,
+                        'transition_ts_utc': transition_ts,
+                        'value': value,
+                    })
+
+        if rows:
+            self.session.execute(table.insert(), rows)
+
+# ################################################################################################################################
+
+def migrate_sql_history(engine, session, cluster_id, batch_size=1000, pause=0, checkpoint=None):
+    """ Moves histories kept by previous versions as JSON lists in data_item over to data_bst_history, creating the table
+    first if it does not exist yet. Rows are read in batches of batch_size, in the order of their ids, and each batch
+    is moved in a transaction of its own, with a pause in between, so the process can be safely interrupted and re-run.
+    The last id moved is kept in checkpoint. Returns the number of rows moved.
+    """
+    BSTHistory.__table__.create(engine, checkfirst=True)
+
+    checkpoint = checkpoint or Checkpoint()
+    if checkpoint.is_done(SQL_HISTORY_STAGE):
+        return 0
+
+    name_prefix = label.item.process_bst_inst_history.split('%s')[0]
+    item_table = Item.__table__
+
+    last_id = checkpoint.get(SQL_HISTORY_STAGE) or 0
+    total = 0
+
+    while True:
+
+        items = session.query(Item.id, Item.value).\
+            filter(Item.id > last_id).\
+            filter(Item.cluster_id==cluster_id).\
+            filter(Item.name.startswith(name_prefix)).\
+            order_by(Item.id).\
+            limit(batch_size).\
+            all()
+
+        if not items:
+            break
+
+        histories = []
+        by_def_tag = {}
+
+        for item in items:
+            history = loads(item.value) if item.value else []
+
+            if history:
+
+                # Names in data_item cannot be split unambiguously into def_tag and object_tag
+                # because both may contain dots but each transition has them separately.
+                transition = loads(history[0])
+                def_tag, object_tag = transition['def_tag'], transition['object_tag']
+
+                histories.append((def_tag, object_tag, history))
+                by_def_tag.setdefault(def_tag, {})[object_tag] = len(history)
+
+        try:
+            for def_tag, counts in sorted(by_def_tag.items()):
+                for chunk in chunks(sorted(counts), CONST.SQL_IN_CHUNK_SIZE):
+
+                    transitioned = session.query(BSTHistory.object_tag).\
+                        filter(BSTHistory.cluster_id==cluster_id).\
+                        filter(BSTHistory.def_tag==def_tag).\
+                        filter(BSTHistory.object_tag.in_(chunk)).\
+                        distinct()
+
+                    for object_tag, in transitioned.all():
+
+                        query = session.query(BSTHistory).\
+                            filter(BSTHistory.cluster_id==cluster_id).\
+                            filter(BSTHistory.def_tag==def_tag).\
+                            filter(BSTHistory.object_tag==object_tag)
+
+                        # The object was transitioned after upgrading already so its newer rows need to be renumbered
+                        # to follow the legacy ones. Going through negative numbers means unique constraints hold throughout.
+                        query.update({BSTHistory.seq: -(BSTHistory.seq + counts[object_tag])}, synchronize_session=False)
+                        query.update({BSTHistory.seq: -BSTHistory.seq}, synchronize_session=False)
+
+            add_history(session, cluster_id, histories)
+
+            for chunk in chunks([item.id for item in items], CONST.SQL_IN_CHUNK_SIZE):
+                session.execute(item_table.delete().where(item_table.c.id.in_(chunk)))
+
+            session.commit()
+
+        except Exception:
+            session.rollback()
+            raise
+
+        last_id = items[-1].id
+        total += len(items)
+        checkpoint.set(SQL_HISTORY_STAGE, last_id)
+
+        logger.info('Moved history of %s objects, last id:`%s`', total, last_id)
+
+        if pause:
+            sleep(pause)
+
+    checkpoint.set_done(SQL_HISTORY_STAGE)
+
+    return total
+
+# ################################################################################################################################
+
+def backfill_lookup_key(engine, session, cluster_id, batch_size, pause):
+    """ Adds data_item.lookup_key if the table does not have it yet and fills it in for BST rows missing it. This can run
+    while servers are transitioning objects - rows are updated in small batches, each in a transaction of its own,
+    with a pause in between.
+    """
+    table = Item.__table__
+
+    if 'lookup_key' not in [column['name'] for column in inspect(engine).get_columns(table.name)]:
+        logger.info('Adding column `%s.lookup_key`', table.name)
+        engine.execute('ALTER TABLE {} ADD {} {}'.format(
+            table.name, 'lookup_key', table.c.lookup_key.type.compile(dialect=engine.dialect)))
+
+    if 'data_item_lookup_key_idx' not in [index['name'] for index in inspect(engine).get_indexes(table.name)]:
+        logger.info('Adding index `data_item_lookup_key_idx`')
+        Index('data_item_lookup_key_idx', table.c.cluster_id, table.c.lookup_key).create(engine)
+
+    name_prefix = commonprefix([label.item.process_bst_inst_current, label.item.process_bst_inst_history])
+    update = table.update().where(table.c.id==bindparam('_id')).values(lookup_key=bindparam('_lookup_key'))
+
+    last_id = 0
+    total = 0
+
+    while True:
+
+        items = session.query(Item.id, Item.name).\
+            filter(Item.id > last_id).\
+            filter(Item.cluster_id==cluster_id).\
+            filter(Item.lookup_key.is_(None)).\
+            filter(Item.name.startswith(name_prefix)).\
+            order_by(Item.id).\
+            limit(batch_size).\
+            all()
+
+        if not items:
+            break
+
+        session.execute(update, [{'_id':item.id, '_lookup_key':get_lookup_key(item.name)} for item in items])
+        session.commit()
+
+        last_id = items[-1].id
+        total += len(items)
+
+        logger.info('Filled in lookup keys of %s rows, last id:`%s`', total, last_id)
+
+        if pause:
+            sleep(pause)
@@ -6,17 +6,18 @@ from __future__ import absolute_import, division, print_function, unicode_litera
 # https://zato.io
 
 # stdlib
-from json import dumps, loads
+from json import dumps
 
 # Bunch
 from bunch import bunchify
 
 # zato-labs
-from zato_bst import CONST, Definition, setup_server_config, StateMachine, yield_definitions
+from zato_bst import CONST, DeadlineScheduler, Definition, HistoryCompactor, iter_json_items, parse_ts, setup_server_config, \
+     StateMachine, yield_definitions
 
 # Zato
 from zato.server.connection.http_soap import BadRequest
-from zato.server.service import AsIs, Bool, Service
+from zato.server.service import AsIs, Bool, Integer, List, Service
 
 # ################################################################################################################################
 
@@ -40,9 +41,25 @@ class Base(Service):
         req = self.request.input
         if req and 'object_type' in req:
             self.environ.def_version = req.get('def_version', CONST.DEFAULT_GRAPH_VERSION)
-            self.environ.object_tag = StateMachine.get_object_tag(req.object_type, req.object_id)
+
+            # Services reading many objects at once have no single object_id
+            if 'object_id' in req:
+                self.environ.object_tag = StateMachine.get_object_tag(req.object_type, req.object_id)
+
             self.environ.def_tag = self.environ.sm.get_def_tag(
-                req.object_type, req.object_id, req.get('state_new'), req.get('def_name'), self.environ.def_version)
+                req.object_type, req.get('object_id'), req.get('state_new'), req.get('def_name'), self.environ.def_version)
+
+    def _get_def_tag(self):
+        """ Returns a tag of the definition that def_name and def_version of the request point to,
+        raising BadRequest if there is no such definition.
+        """
+        req = self.request.input
+        def_tag = Definition.get_tag(Definition.get_name(req.def_name), req.get('def_version') or CONST.DEFAULT_GRAPH_VERSION)
+
+        if def_tag not in self.environ.sm.config:
+            raise BadRequest(self.cid, 'No such definition `{}`\n'.format(def_tag))
+
+        return def_tag
 
 # ################################################################################################################################
 
@@ -107,17 +124,33 @@ class Transition(SingleTransitionBase):
 
 # ################################################################################################################################
 
-class MassTransition(Base, JSONProducer):
-    """ Performs transitions on a list of object.
+class MassTransition(Base):
+    """ Performs transitions on a list of objects, given either as a JSON array or as newline-delimited JSON, one object
+    per line, each with the same keys labs.proc.bst.transition expects. Objects are transitioned in batches and a result
+    of each is returned in the same order and format as the input was in, including those that could not be transitioned.
     """
     name = 'labs.proc.bst.mass-transition'
+    batch_size = 1000
 
     def handle(self):
-        out = []
-        for item in loads(self.request.raw_request):
-            out.append(self.invoke(Transition.name, item))
+        data = self.request.raw_request
+        self.environ.is_ndjson = not data.lstrip().startswith('[')
 
-        self.response.payload = dumps(out)
+        try:
+            items = iter_json_items(data)
+        except ValueError as e:
+            raise BadRequest(self.cid, 'Invalid JSON array `{}`\n'.format(e))
+
+        # Zato responses are strings so results are buffered before they are returned
+        results = self.environ.sm.transition_many(items, self.server.name, self.batch_size)
+
+        if self.environ.is_ndjson:
+            self.response.payload = ''.join('{}\n'.format(dumps(result)) for result in results)
+        else:
+            self.response.payload = dumps(list(results))
+
+    def after_handle(self):
+        self.response.content_type = 'application/x-ndjson' if self.environ.get('is_ndjson') else 'application/json'
 
 # ################################################################################################################################
 
@@ -128,9 +161,165 @@ class GetHistory(SingleTransitionBase, JSONProducer):
 
     class SimpleIO:
         input_required = ('object_type', AsIs('object_id'))
+        input_optional = (Integer('limit'), Integer('offset'), 'since_ts', 'until_ts', Bool('newest_first'))
+
+    def validate_input(self):
+        for name in ('since_ts', 'until_ts'):
+            value = self.request.input.get(name)
+            if value:
+                try:
+                    parse_ts(value)
+                except ValueError:
+                    raise BadRequest(self.cid, 'Invalid {} `{}`, expected an ISO-8601 timestamp\n'.format(name, value))
+
+    def handle(self):
+        req = self.request.input
+        limit = req.get('limit')
+
+        self.response.payload = dumps(self.environ.sm.get_history(
+            self.environ.object_tag, self.environ.def_tag, limit if limit not in (None, '') else None, req.get('offset') or 0,
+            req.get('since_ts') or None, req.get('until_ts') or None, bool(req.get('newest_first'))))
+
+# ################################################################################################################################
+
+class CompactHistory(Base, JSONProducer):
+    """ Trims history of objects according to retention settings of definitions, e.g. when invoked from the scheduler.
+    """
+    name = 'labs.proc.bst.compact-history'
+
+    class SimpleIO:
+        input_optional = ('def_name', 'def_version', 'archive_dir', Integer('batch_size'))
+
+    def handle(self):
+        req = self.request.input
+        sm = self.environ.sm
+
+        compactor = HistoryCompactor(sm.config, sm.backend, req.get('archive_dir') or None, req.get('batch_size') or 100)
+
+        if req.get('def_name'):
+            def_tag = self._get_def_tag()
+            out = {def_tag: compactor.compact_def(sm.config[def_tag])}
+        else:
+            out = compactor.run()
+
+        self.response.payload = dumps(out)
+
+# ################################################################################################################################
+
+class TimeOut(Base, JSONProducer):
+    """ Moves objects that stayed in states with timeouts for too long to timeout targets of their definitions,
+    e.g. when invoked from the scheduler.
+    """
+    name = 'labs.proc.bst.time-out'
+
+    class SimpleIO:
+        input_optional = ('def_name', 'def_version', Integer('batch_size'))
+
+    def handle(self):
+        req = self.request.input
+        sm = self.environ.sm
+
+        scheduler = DeadlineScheduler(sm, req.get('batch_size') or 100, server_ctx=self.server.name)
+
+        if req.get('def_name'):
+            def_tag = self._get_def_tag()
+            out = {def_tag: scheduler.time_out_def(def_tag)}
+        else:
+            out = scheduler.run()
+
+        self.response.payload = dumps(out)
+
+# ################################################################################################################################
+
+class GetObjectsInState(Base, JSONProducer):
+    """ Returns a page of objects that are currently in a given state, ordered by the time they entered it,
+    along with a cursor to read the next page with, which is null once there are no more pages.
+    """
+    name = 'labs.proc.bst.get-objects-in-state'
+    max_limit = 1000
+
+    class SimpleIO:
+        input_required = ('def_name', 'state')
+        input_optional = ('def_version', Integer('limit'), 'cursor')
 
     def handle(self):
-        self.response.payload = dumps(self.environ.sm.get_history(self.environ.object_tag, self.environ.def_tag), indent=2)
+        req = self.request.input
+        def_tag = self._get_def_tag()
+
+        limit = min(req.get('limit') or 100, self.max_limit)
+        objects, cursor = self.environ.sm.get_objects_in_state(def_tag, req.state, limit, req.get('cursor') or None)
+
+        self.response.payload = dumps({'objects': objects, 'cursor': cursor})
+
+# ################################################################################################################################
+
+class GetStats(Base, JSONProducer):
+    """ Returns numbers of objects in each state of a definition and numbers of transitions along each edge in each
+    of the last few minutes, 60 by default. Both are read from counters rather than computed out of objects' states.
+    """
+    name = 'labs.proc.bst.get-stats'
+    max_minutes = CONST.STATS_TTL // 60
+
+    class SimpleIO:
+        input_required = ('def_name',)
+        input_optional = ('def_version', Integer('minutes'))
+
+    def handle(self):
+        req = self.request.input
+        def_tag = self._get_def_tag()
+
+        minutes = min(req.get('minutes') or 60, self.max_minutes)
+        self.response.payload = dumps(self.environ.sm.get_state_stats(def_tag, minutes))
+
+# ################################################################################################################################
+
+class GetEvents(Base, JSONProducer):
+    """ Returns a batch of transitions in a definition, published after the one a cursor points to or, if a group is given,
+    those not yet delivered to any consumer of that group, which are then to be acknowledged with labs.proc.bst.ack-events.
+    Consumers keep calling it with the cursor returned, which stays the same until there are new events.
+    """
+    name = 'labs.proc.bst.get-events'
+    max_limit = 1000
+
+    class SimpleIO:
+        input_required = ('def_name',)
+        input_optional = ('def_version', 'cursor', Integer('limit'), 'group', 'consumer', Bool('pending'))
+
+    def handle(self):
+        req = self.request.input
+        def_tag = self._get_def_tag()
+
+        if req.get('group') and not req.get('consumer'):
+            raise BadRequest(self.cid, 'Consumer is required along with group\n')
+
+        limit = min(req.get('limit') or 100, self.max_limit)
+
+        try:
+            events, cursor = self.environ.sm.get_events(def_tag, req.get('cursor') or None, limit, req.get('group') or None,
+                req.get('consumer'), bool(req.get('pending')))
+        except ValueError:
+            raise BadRequest(self.cid, 'Invalid cursor `{}`\n'.format(req.cursor))
+        except NotImplementedError:
+            raise BadRequest(self.cid, 'Consumer groups are not supported by the backend\n')
+
+        self.response.payload = dumps({'events': events, 'cursor': cursor})
+
+class AckEvents(Base, JSONProducer):
+    """ Acknowledges events read by a consumer group through labs.proc.bst.get-events once they have been processed.
+    """
+    name = 'labs.proc.bst.ack-events'
+
+    class SimpleIO:
+        input_required = ('def_name', 'group', List('ids'))
+        input_optional = ('def_version',)
+
+    def handle(self):
+        try:
+            count = self.environ.sm.ack_events(self._get_def_tag(), self.request.input.group, self.request.input.ids)
+        except NotImplementedError:
+            raise BadRequest(self.cid, 'Consumer groups are not supported by the backend\n')
+
+        self.response.payload = dumps({'acknowledged': count})
 
 # ################################################################################################################################
 
@@ -167,13 +356,7 @@ class GetDefinition(FormatBase):
         input_optional = ('format', 'def_version')
 
     def handle(self):
-        def_name = Definition.get_name(self.request.input.def_name)
-        def_tag = Definition.get_tag(def_name, self.request.input.get('def_version') or CONST.DEFAULT_GRAPH_VERSION)
-
-        if def_tag not in self.environ.sm.config:
-            raise BadRequest(self.cid, 'No such definition `{}`\n'.format(def_tag))
-
-        self._get_handle()(def_tag)
+        self._get_handle()(self._get_def_tag())
 
     def _get_handle(self):
 
@@ -207,3 +390,27 @@ class GetCurrentStateInfo(GetDefinition):
         self.response.payload = dumps(self.environ.sm.get_current_state_info(self.environ.object_tag, self.environ.def_tag))
 
 # ################################################################################################################################
+
+class GetCurrentStateInfoMany(Base, JSONProducer):
+    """ Returns information on states of many objects of the same type at once, as a JSON object of their IDs
+    to their states, null for objects that have none.
+    """
+    name = 'labs.proc.bst.get-current-state-info-many'
+    max_objects = 1000
+
+    class SimpleIO:
+        input_required = ('object_type', List('object_ids'))
+        input_optional = ('def_name', 'def_version')
+
+    def validate_input(self):
+        if len(self.request.input.object_ids) > self.max_objects:
+            raise BadRequest(self.cid, 'No more than {} objects can be read at once\n'.format(self.max_objects))
+
+    def handle(self):
+        req = self.request.input
+        object_tags = dict((StateMachine.get_object_tag(req.object_type, object_id), object_id) for object_id in req.object_ids)
+
+        current = self.environ.sm.get_current_state_info_many(object_tags, self.environ.def_tag)
+        self.response.payload = dumps(dict((object_id, current.get(object_tag)) for object_tag, object_id in object_tags.items()))
+
+# ################################################################################################################################
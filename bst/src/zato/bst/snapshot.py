@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+# Part of Zato - Open-Source ESB, SOA, REST, APIs and Cloud Integrations in Python
+# https://zato.io
+
+""" Exports current states and history of objects of selected definitions, from either backend, to gzip-compressed NDJSON
+snapshots, and loads such snapshots back into either backend, e.g. to back up, restore or clone environments.
+
+The first line of a snapshot is a header, each following one is a single object:
+
+{"version": 1, "created_ts_utc": "2016-01-01T00:00:00", "def_tags": ["Orders.v1"]}
+{"def_tag": "Orders.v1", "object_tag": "order.1", "current": {..}, "history": [{..}, {..}]}
+
+Objects are streamed in batches so memory use does not depend on how many of them there are.
+"""
+
+# stdlib
+import gzip
+import logging
+from datetime import datetime
+
+# pyrapidjson
+from rapidjson import dumps, loads
+
+# zato-labs
+try:
+    from zato_bst_core import decode_record, RedisBackend, SQLBackend
+except ImportError:
+    from zato.bst.core import decode_record, RedisBackend, SQLBackend
+
+# ################################################################################################################################
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# ################################################################################################################################
+
+SNAPSHOT_VERSION = 1
+
+# ################################################################################################################################
+
+def export_snapshot(backend, def_tags, path, batch_size=100):
+    """ Writes current states and history of all objects of given definitions to a snapshot. Objects are those that have
+    current states, as returned by backend.iter_current_states, so that objects whose history is still kept in the legacy
+    format are included too. Returns the number of objects written.
+    """
+    total = 0
+
+    with gzip.open(path, 'wb') as f:
+        f.write(dumps({'version': SNAPSHOT_VERSION, 'created_ts_utc': datetime.utcnow().isoformat(),
+            'def_tags': list(def_tags)}).encode('utf-8'))
+        f.write(b'\n')
+
+        for def_tag in def_tags:
+            for batch in backend.iter_current_states(def_tag, batch_size):
+                for object_tag, current in batch:
+                    f.write(dumps({
+                        'def_tag': def_tag,
+                        'object_tag': object_tag,
+                        'current': current,
+                        'history': [decode_record(value) for value in backend.get_history(object_tag, def_tag)],
+                    }).encode('utf-8'))
+                    f.write(b'\n')
+
+                total += len(batch)
+                logger.info('Exported `%s` objects of `%s`, total:`%s`', len(batch), def_tag, total)
+
+    return total
+
+# ################################################################################################################################
+
+def iter_snapshot(path):
+    """ Yields objects from a snapshot, one dictionary at a time, after making sure its header is in a supported version.
+    """
+    with gzip.open(path, 'rb') as f:
+        header = loads(f.readline().decode('utf-8'))
+
+        if header.get('version') != SNAPSHOT_VERSION:
+            raise ValueError('Unsupported snapshot version `{}` in `{}`'.format(header.get('version'), path))
+
+        for line in f:
+            line = line.strip()
+            if line:
+                yield loads(line.decode('utf-8'))
+
+# ################################################################################################################################
+
+def _import_batch(backend, batch):
+    """ Restores a batch of objects from a snapshot as they are, returning tags of definitions they belong to.
+    """
+    by_def_tag = {}
+
+    for item in batch:
+        by_def_tag.setdefault(item['def_tag'], []).append((item['object_tag'],
+            dumps(item['current']) if item['current'] else None, [dumps(value) for value in item['history']]))
+
+    for def_tag, objects in sorted(by_def_tag.items()):
+        backend.restore_objects(def_tag, objects)
+
+    return set(by_def_tag)
+
+def import_snapshot(backend, path, def_tags=None, batch_size=100):
+    """ Loads objects from a snapshot, of all definitions in it unless def_tags are given, into a backend. History is appended
+    to what objects already have so snapshots are meant to be loaded into environments that do not have them yet.
+    Objects are written as they were, without publishing events, and numbers of objects in each state are counted
+    anew once all of them are loaded. Returns the number of objects loaded.
+    """
+    batch = []
+    total = 0
+    imported = set()
+
+    for item in iter_snapshot(path):
+        if def_tags and item['def_tag'] not in def_tags:
+            continue
+
+        batch.append(item)
+
+        if len(batch) == batch_size:
+            imported.update(_import_batch(backend, batch))
+            total += len(batch)
+            logger.info('Imported `%s` objects', total)
+            batch = []
+
+    if batch:
+        imported.update(_import_batch(backend, batch))
+        total += len(batch)
+        logger.info('Imported `%s` objects', total)
+
+    # Transitions were not counted as they were loaded
+    for def_tag in sorted(imported):
+        backend.rebuild_state_counts(def_tag)
+
+    return total
+
+# ################################################################################################################################
+
+def get_backend(args):
+    """ Returns a backend to export from or import to, as selected in command line arguments.
+    """
+    if args.backend == 'redis':
+
+        # Redis
+        import redis
+
+        redis_conn = redis.StrictRedis(args.redis_host, args.redis_port, password=args.redis_password)
+        redis_conn.ping()
+
+        return RedisBackend(redis_conn, current_buckets=args.buckets, previous_buckets=args.previous_buckets)
+
+    # SQLAlchemy
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import sessionmaker
+
+    # Zato
+    from zato.common import util
+    from zato.common.odb import util as odb_util
+
+    connect_args = {'application_name':util.get_component_name('bst.snapshot')} if args.odb_type == 'postgresql' else {}
+    engine = create_engine(odb_util.get_engine_url(args), connect_args=connect_args)
+
+    return SQLBackend(sessionmaker(bind=engine), int(args.cluster_id))
+
+# ################################################################################################################################
+
+if __name__ == '__main__':
+
+    # stdlib
+    import argparse
+
+    db_choices = ('mysql', 'postgresql', 'oracle', 'sqlite')
+
+    parser = argparse.ArgumentParser(description='Export BST state to an NDJSON snapshot or import it from one')
+
+    parser.add_argument('--action', type=str, help='Whether to export or import', choices=('export', 'import'), required=True)
+    parser.add_argument('--path', type=str, help='Path to the gzip-compressed NDJSON snapshot', required=True)
+    parser.add_argument('--def_tags', type=str,
+        help='Comma-separated tags of definitions, e.g. Orders.v1, required on export, all in snapshot by default on import')
+    parser.add_argument('--batch_size', type=int, help='How many objects to read or write at once', default=100)
+    parser.add_argument('--backend', type=str, help='Backend to export from or import to', choices=('redis', 'sql'),
+        required=True)
+
+    parser.add_argument('--odb_type', type=str, help='Type of database to connect to', choices=db_choices)
+    parser.add_argument('--odb_host', type=str, help='SQL host to connect to')
+    parser.add_argument('--odb_port', type=str, help='SQL port to connect to')
+    parser.add_argument('--odb_user', type=str, help='ODB username to connect with')
+    parser.add_argument('--odb_password', type=str, help='Password for ODB user')
+    parser.add_argument('--odb_db_name', type=str, help='Name of database to connect to')
+    parser.add_argument('--cluster_id', type=str, help='ID of cluster BST is installed in')
+
+    parser.add_argument('--redis_host', type=str, help='Redis host to connect to')
+    parser.add_argument('--redis_port', type=str, help='Redis port to connect to')
+    parser.add_argument('--redis_password', type=str, help='Password for Redis user')
+    parser.add_argument('--buckets', type=int,
+        help='How many hashes current states of each definition are kept in in Redis, 0 meaning a single one', default=0)
+    parser.add_argument('--previous_buckets', type=int,
+        help='How many hashes current states of each definition are being moved from in Redis, 0 meaning a single one')
+
+    args = parser.parse_args()
+    def_tags = [elem.strip() for elem in args.def_tags.split(',') if elem.strip()] if args.def_tags else []
+
+    if args.action == 'export':
+        if not def_tags:
+            parser.error('--def_tags is required on export')
+        total = export_snapshot(get_backend(args), def_tags, args.path, args.batch_size)
+    else:
+        total = import_snapshot(get_backend(args), args.path, def_tags, args.batch_size)
+
+    logger.info('BST snapshot `%s` done, path:`%s`, objects:`%s`', args.action, args.path, total)
@@ -7,12 +7,15 @@ from __future__ import absolute_import, division, print_function, unicode_litera
 
 # stdlib
 import logging
+from hashlib import sha1
+from struct import unpack
 
 # dictalchemy
 from dictalchemy import make_class_dictable
 
 # SQLAlchemy
-from sqlalchemy import Boolean, Column, create_engine, ForeignKey, Integer, Sequence, String, Text, UniqueConstraint
+from sqlalchemy import BigInteger, Boolean, Column, create_engine, DateTime, ForeignKey, Index, Integer, Sequence, String, \
+     Text, UniqueConstraint
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import backref, relationship, sessionmaker
 
@@ -52,6 +55,14 @@ class label:
 
 # ################################################################################################################################
 
+def get_lookup_key(name):
+    """ Returns a signed 64-bit integer hash of an item's name, stored in data_item.lookup_key so that items can be
+    looked up through a compact index rather than through long names.
+    """
+    return unpack(b'>q', sha1(name.encode('utf8')).digest()[:8])[0]
+
+# ################################################################################################################################
+
 def get_session(engine):
     session = sessionmaker() # noqa
     session.configure(bind=engine)
@@ -107,7 +118,8 @@ class Item(Base):
     so as not to require 'value' to be parsed on client side in order to extract data or filter by 'value's contents.
     """
     __tablename__ = 'data_item'
-    __table_args__ = (UniqueConstraint('cluster_id', 'group_id', 'sub_group_id', 'name'), {})
+    __table_args__ = (UniqueConstraint('cluster_id', 'group_id', 'sub_group_id', 'name'),
+        Index('data_item_lookup_key_idx', 'cluster_id', 'lookup_key'), {})
 
     id = Column(Integer, Sequence('data_item_seq'), primary_key=True)
     parent_id = Column(Integer, ForeignKey('data_item.id', ondelete='CASCADE'), nullable=True)
@@ -117,6 +129,9 @@ class Item(Base):
     name = Column(String(2048), unique=True, nullable=False)
     value = Column(Text, nullable=True)
 
+    # A hash of name, computed by get_lookup_key. May be empty in rows created by previous versions.
+    lookup_key = Column(BigInteger, nullable=True)
+
     # Foreign keys are for both groups and sub-groups
 
     group_id = Column(Integer, ForeignKey('data_group.id', ondelete='CASCADE'), nullable=False)
@@ -192,6 +207,113 @@ class ItemTag(Base):
 
 # ################################################################################################################################
 
+class BSTHistory(Base):
+    """ History of transitions of objects in BST definitions, one row per transition. Each object's rows are numbered
+    with consecutive values of 'seq', starting from 1, so that adding a transition is always a single INSERT.
+    """
+    __tablename__ = 'data_bst_history'
+    __table_args__ = (UniqueConstraint('cluster_id', 'def_tag', 'object_tag', 'seq'), {})
+
+    id = Column(Integer, Sequence('data_bst_history_seq'), primary_key=True)
+    def_tag = Column(String(200), nullable=False)
+    object_tag = Column(String(200), nullable=False)
+    seq = Column(Integer, nullable=False)
+    transition_ts_utc = Column(DateTime, nullable=False)
+    value = Column(Text, nullable=False)
+
+    cluster_id = Column(Integer, ForeignKey('cluster.id', ondelete='CASCADE'), nullable=False)
+
+# ################################################################################################################################
+
+class BSTState(Base):
+    """ Current states of objects in BST definitions, one row per object, kept apart from data_item so that objects
+    can be looked up by the states they are in. transition_ts_utc is when an object entered its current state
+    and deadline_utc, if the state has a timeout, is when it will time out.
+    """
+    __tablename__ = 'data_bst_state'
+    __table_args__ = (UniqueConstraint('cluster_id', 'def_tag', 'object_tag'),
+        Index('data_bst_state_idx', 'cluster_id', 'def_tag', 'state', 'transition_ts_utc', 'object_tag'),
+        Index('data_bst_state_deadline_idx', 'cluster_id', 'def_tag', 'deadline_utc'), {})
+
+    id = Column(Integer, Sequence('data_bst_state_seq'), primary_key=True)
+    def_tag = Column(String(200), nullable=False)
+    object_tag = Column(String(200), nullable=False)
+    state = Column(String(200), nullable=False)
+    transition_ts_utc = Column(DateTime, nullable=False)
+    deadline_utc = Column(DateTime, nullable=True)
+
+    cluster_id = Column(Integer, ForeignKey('cluster.id', ondelete='CASCADE'), nullable=False)
+
+# ################################################################################################################################
+
+class BSTStateCount(Base):
+    """ Numbers of objects in each state of BST definitions, updated along with states of objects.
+    """
+    __tablename__ = 'data_bst_state_count'
+    __table_args__ = (UniqueConstraint('cluster_id', 'def_tag', 'state'), {})
+
+    id = Column(Integer, Sequence('data_bst_state_count_seq'), primary_key=True)
+    def_tag = Column(String(200), nullable=False)
+    state = Column(String(200), nullable=False)
+    value = Column(BigInteger, nullable=False)
+
+    cluster_id = Column(Integer, ForeignKey('cluster.id', ondelete='CASCADE'), nullable=False)
+
+# ################################################################################################################################
+
+class BSTEdgeCount(Base):
+    """ Numbers of transitions along each edge of BST definitions in each minute. state_old is an empty string
+    for transitions of objects that had no state before.
+    """
+    __tablename__ = 'data_bst_edge_count'
+    __table_args__ = (UniqueConstraint('cluster_id', 'def_tag', 'minute', 'state_old', 'state_new'), {})
+
+    id = Column(Integer, Sequence('data_bst_edge_count_seq'), primary_key=True)
+    def_tag = Column(String(200), nullable=False)
+    minute = Column(DateTime, nullable=False, index=True)
+    state_old = Column(String(200), nullable=False)
+    state_new = Column(String(200), nullable=False)
+    value = Column(BigInteger, nullable=False)
+
+    cluster_id = Column(Integer, ForeignKey('cluster.id', ondelete='CASCADE'), nullable=False)
+
+# ################################################################################################################################
+
+class BSTEvent(Base):
+    """ An outbox of transitions of objects in BST definitions for downstream consumers to read, ordered by seq. Rows are added
+    in the same transactions that transitions are committed in so there are no events of transitions that were rolled back.
+    Ids are taken when rows are added, which is not necessarily the order their transactions commit in, so seq is NULL
+    until a consumer numbers the row, which happens only once it is committed, see data_bst_event_counter.
+    """
+    __tablename__ = 'data_bst_event'
+    __table_args__ = (Index('data_bst_event_idx', 'cluster_id', 'def_tag', 'id'),
+        Index('data_bst_event_seq_idx', 'cluster_id', 'def_tag', 'seq'), {})
+
+    id = Column(Integer, Sequence('data_bst_event_seq'), primary_key=True)
+    def_tag = Column(String(200), nullable=False)
+    object_tag = Column(String(200), nullable=False)
+    value = Column(Text, nullable=False)
+    seq = Column(Integer, nullable=True)
+
+    cluster_id = Column(Integer, ForeignKey('cluster.id', ondelete='CASCADE'), nullable=False)
+
+# ################################################################################################################################
+
+class BSTEventCounter(Base):
+    """ The last seq given to events of each BST definition. Its row is locked while events committed since are numbered,
+    so consumers doing it at the same time take turns and no event is given a seq below one already read.
+    """
+    __tablename__ = 'data_bst_event_counter'
+    __table_args__ = (UniqueConstraint('cluster_id', 'def_tag'), {})
+
+    id = Column(Integer, Sequence('data_bst_event_counter_seq'), primary_key=True)
+    def_tag = Column(String(200), nullable=False)
+    value = Column(Integer, nullable=False)
+
+    cluster_id = Column(Integer, ForeignKey('cluster.id', ondelete='CASCADE'), nullable=False)
+
+# ################################################################################################################################
+
 def setup(args):
 
     logger.info('Setting up BST in `%s`', args.__dict__)
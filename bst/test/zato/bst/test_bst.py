@@ -6,17 +6,50 @@ from __future__ import absolute_import, division, print_function, unicode_litera
 # https://zato.io
 
 # stdlib
+import os
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from gzip import GzipFile
 from inspect import getargspec
 from json import dumps, loads
-from unittest import TestCase
+from operator import itemgetter
+from shutil import rmtree
+from tempfile import mkdtemp
+from threading import Event
+from time import time
+from unittest import skipIf, TestCase
 from uuid import uuid4
 
+# Bunch
+from bunch import Bunch
+
 # fakeredis
 from fakeredis import FakeRedis
 
+# msgpack
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# Redis
+import redis
+from redis import ResponseError
+
+# SQLAlchemy
+from sqlalchemy import create_engine, func
+from sqlalchemy.orm import scoped_session, sessionmaker
+
 # Zato
-from zato.bst import AddEdgeResult, ConfigItem, CONST, Definition, Node, parse_pretty_print, RedisBackend, \
-     StateBackendBase
+from zato.bst import AddEdgeResult, CachingBackend, ConfigItem, CONST, DeadlineScheduler, decode_record, Definition, \
+     encode_record, filter_history, HashRing, HistoryCompactor, iter_json_items, Node, parse_duration, parse_pretty_print, \
+     parse_ts, RedisBackend, setup_server_config, ShardedRedisBackend, SQLBackend, StateBackendBase, StateMachine, \
+     TransitionConflictError, TransitionError, transition_to
+from zato.bst.sql import Base, BSTEdgeCount, BSTEvent, BSTHistory, BSTState, BSTStateCount, Cluster, get_lookup_key, \
+     get_session, Group, Item, label, SubGroup
+from zato.bst.migration import Checkpoint, get_redis_current_keys, get_worker_id, migrate_sql_history, RedisMigration, \
+     SQL_HISTORY_STAGE
+from zato.bst.snapshot import export_snapshot, get_backend, import_snapshot, iter_snapshot
 
 # ################################################################################################################################
 
@@ -31,6 +64,557 @@ def rand_string(count=1, as_json=False):
     else:
         return value
 
+def rand_state_info(object_tag, def_tag):
+    return dumps({
+        'state_old': rand_string(),
+        'state_current': rand_string(),
+        'object_tag': object_tag,
+        'def_tag': def_tag,
+        'transition_ts_utc': datetime.utcnow().isoformat(),
+        'server_ctx': None,
+        'user_ctx': None,
+        'is_forced': False
+    })
+
+def get_timed_history(object_tag, def_tag, count, start=datetime(2016, 1, 1)):
+    """ Returns serialized transitions made one minute after another, beginning at start.
+    """
+    out = []
+    for idx in range(count):
+        state_info = loads(rand_state_info(object_tag, def_tag))
+        state_info['transition_ts_utc'] = (start + timedelta(minutes=idx)).isoformat()
+        out.append(dumps(state_info))
+
+    return out
+
+def check_history_pages(test, backend, set_legacy_history=None):
+    """ Runs get_history of a backend with various combinations of pagination and time ranges, comparing results
+    with what filter_history returns. If set_legacy_history is given, it is used to store the oldest transitions
+    the way previous versions did.
+    """
+    object_tag, def_tag = rand_string(2)
+    history = get_timed_history(object_tag, def_tag, 25)
+    legacy_count = 5 if set_legacy_history else 0
+
+    if set_legacy_history:
+        set_legacy_history(object_tag, def_tag, history[:legacy_count])
+
+    for state_info in history[legacy_count:]:
+        backend.set_current_state_info(object_tag, def_tag, state_info)
+
+    test.assertListEqual(backend.get_history(object_tag, def_tag), history)
+
+    ts = [datetime(2016, 1, 1) + timedelta(minutes=idx) for idx in (0, 7, 24, 30)]
+    ts.append(None)
+
+    for newest_first in (False, True):
+        for limit in (None, 0, 1, 3, 10, 30):
+            for offset in (0, 9, 30):
+
+                test.assertListEqual(
+                    backend.get_history(object_tag, def_tag, limit, offset, newest_first=newest_first),
+                    history[::-1 if newest_first else 1][offset:offset+limit if limit is not None else None])
+
+                for since_ts in ts:
+                    for until_ts in ts:
+                        test.assertListEqual(
+                            backend.get_history(object_tag, def_tag, limit, offset, since_ts, until_ts, newest_first),
+                            filter_history(history, limit, offset, since_ts, until_ts, newest_first),
+                            (limit, offset, since_ts, until_ts, newest_first))
+
+def check_trim_history(test, backend):
+    """ Trims history of an object by the number of transitions and by their age, making sure the newest one is always kept.
+    """
+    object_tag, def_tag = rand_string(2)
+    history = get_timed_history(object_tag, def_tag, 20)
+
+    for state_info in history:
+        backend.set_current_state_info(object_tag, def_tag, state_info)
+
+    trimmed = []
+
+    def on_trim(_object_tag, _def_tag, values):
+        test.assertEquals(_object_tag, object_tag)
+        test.assertEquals(_def_tag, def_tag)
+        test.assertListEqual(backend.get_history(object_tag, def_tag, len(values)), values)
+        trimmed.extend(values)
+
+    # Nothing to do
+    test.assertEquals(backend.trim_history(object_tag, def_tag), 0)
+    test.assertEquals(backend.trim_history(object_tag, def_tag, 30, datetime(2015, 1, 1), on_trim), 0)
+    test.assertListEqual(trimmed, [])
+
+    test.assertEquals(backend.trim_history(object_tag, def_tag, 15, on_trim=on_trim), 5)
+    test.assertListEqual(backend.get_history(object_tag, def_tag), history[5:])
+
+    test.assertEquals(backend.trim_history(object_tag, def_tag, min_ts='2016-01-01T00:08:00', on_trim=on_trim), 3)
+    test.assertListEqual(backend.get_history(object_tag, def_tag), history[8:])
+
+    # Whichever of the two leaves fewer transitions wins
+    test.assertEquals(backend.trim_history(object_tag, def_tag, 10, datetime(2016, 1, 1, 0, 9), on_trim), 2)
+    test.assertEquals(backend.trim_history(object_tag, def_tag, 5, datetime(2016, 1, 1, 0, 9), on_trim), 5)
+    test.assertListEqual(backend.get_history(object_tag, def_tag), history[15:])
+
+    # The newest transition is never removed
+    test.assertEquals(backend.trim_history(object_tag, def_tag, 0, datetime(2017, 1, 1), on_trim), 4)
+    test.assertListEqual(backend.get_history(object_tag, def_tag), history[19:])
+    test.assertEquals(backend.trim_history(object_tag, def_tag, 0, datetime(2017, 1, 1), on_trim), 0)
+
+    test.assertListEqual(trimmed, history[:19])
+
+    # Other objects are not affected
+    backend.set_current_state_info(object_tag + '2', def_tag, history[0])
+    backend.set_current_state_info(object_tag + '2', def_tag, history[1])
+    test.assertEquals(backend.trim_history(object_tag, def_tag, 0), 0)
+    test.assertListEqual(backend.get_history(object_tag + '2', def_tag), history[:2])
+
+def get_state_info(object_tag, def_tag, state_old, state_current, transition_ts, version=None):
+    state_info = {
+        'state_old': state_old,
+        'state_current': state_current,
+        'object_tag': object_tag,
+        'def_tag': def_tag,
+        'transition_ts_utc': transition_ts.isoformat(),
+        'server_ctx': None,
+        'user_ctx': None,
+        'is_forced': False
+    }
+
+    if version:
+        state_info['version'] = version
+
+    return dumps(state_info)
+
+def check_objects_in_state(test, backend):
+    """ Transitions objects between states, making sure that each can be found in its current state only.
+    """
+    def_tag = rand_string()
+    start = datetime(2016, 1, 1)
+
+    def get_all(state, limit):
+        out = []
+        cursor = None
+        while True:
+            objects, cursor = backend.get_objects_in_state(def_tag, state, limit, cursor)
+            out.extend(objects)
+            if not cursor:
+                return out
+
+    # Objects 0-2 enter the state at the same time
+    for idx in range(7):
+        object_tag = 'order.{}'.format(idx)
+        backend.set_current_state_info(
+            object_tag, def_tag, get_state_info(object_tag, def_tag, None, 'new', start + timedelta(minutes=max(idx, 2))))
+
+    backend.set_current_state_info(
+        'order.1', def_tag, get_state_info('order.1', def_tag, 'new', 'submitted', start + timedelta(minutes=10)))
+
+    backend.set_current_state_info_many(def_tag, [
+        ('order.4', get_state_info('order.4', def_tag, 'new', 'submitted', start + timedelta(minutes=11))),
+        ('order.5', get_state_info('order.5', def_tag, 'new', 'submitted', start + timedelta(minutes=11))),
+        ('order.5', get_state_info('order.5', def_tag, 'submitted', 'ready', start + timedelta(minutes=12))),
+    ])
+
+    for limit in (1, 2, 3, 10):
+        objects = get_all('new', limit)
+        test.assertListEqual([elem[0] for elem in objects], ['order.0', 'order.2', 'order.3', 'order.6'])
+        test.assertListEqual([elem[1]['state_current'] for elem in objects], ['new'] * 4)
+
+        test.assertListEqual([elem[0] for elem in get_all('submitted', limit)], ['order.1', 'order.4'])
+        test.assertListEqual([elem[0] for elem in get_all('ready', limit)], ['order.5'])
+        test.assertListEqual(get_all(rand_string(), limit), [])
+
+    objects, cursor = backend.get_objects_in_state(def_tag, 'new', 3)
+    test.assertEquals(len(objects), 3)
+    test.assertTrue(cursor)
+
+    objects, cursor = backend.get_objects_in_state(def_tag, 'new', 3, cursor)
+    test.assertEquals(len(objects), 1)
+    test.assertIsNone(cursor)
+
+def check_state_stats(test, backend, check_rebuild=True):
+    """ Transitions objects between states, making sure that counters of objects in each state and of transitions
+    along each edge in each minute follow.
+    """
+    def_tag = rand_string()
+    start = datetime.utcnow().replace(second=0, microsecond=0) - timedelta(minutes=10)
+
+    for idx in range(3):
+        object_tag = 'order.{}'.format(idx)
+        backend.set_current_state_info(object_tag, def_tag, get_state_info(object_tag, def_tag, None, 'new', start))
+
+    backend.set_current_state_info(
+        'order.1', def_tag, get_state_info('order.1', def_tag, 'new', 'submitted', start + timedelta(minutes=1)))
+
+    backend.set_current_state_info_many(def_tag, [
+        ('order.0', get_state_info('order.0', def_tag, 'new', 'submitted', start + timedelta(minutes=2))),
+        ('order.0', get_state_info('order.0', def_tag, 'submitted', 'ready', start + timedelta(minutes=2, seconds=30))),
+        ('order.2', get_state_info('order.2', def_tag, 'new', 'new', start + timedelta(minutes=2))),
+    ])
+
+    def get_minute(minutes):
+        return (start + timedelta(minutes=minutes)).strftime(CONST.STATS_MINUTE_FORMAT)
+
+    stats = backend.get_state_stats(def_tag, start)
+    test.assertDictEqual(stats['states'], {'new': 1, 'submitted': 1, 'ready': 1})
+    test.assertListEqual(stats['transitions'], [
+        {'minute': get_minute(0), 'state_old': None, 'state_new': 'new', 'count': 3},
+        {'minute': get_minute(1), 'state_old': 'new', 'state_new': 'submitted', 'count': 1},
+        {'minute': get_minute(2), 'state_old': 'new', 'state_new': 'new', 'count': 1},
+        {'minute': get_minute(2), 'state_old': 'new', 'state_new': 'submitted', 'count': 1},
+        {'minute': get_minute(2), 'state_old': 'submitted', 'state_new': 'ready', 'count': 1},
+    ])
+
+    stats = backend.get_state_stats(def_tag, start + timedelta(minutes=1, seconds=30))
+    test.assertListEqual([elem['minute'] for elem in stats['transitions']], [get_minute(1)] + [get_minute(2)] * 3)
+
+    empty = backend.get_state_stats(rand_string(), start)
+    test.assertDictEqual(empty, {'states': {}, 'transitions': []})
+
+    if not check_rebuild:
+        return
+
+    # Counting objects anew arrives at the same numbers
+    test.assertDictEqual(backend.rebuild_state_counts(def_tag), {'new': 1, 'submitted': 1, 'ready': 1})
+    test.assertDictEqual(backend.get_state_stats(def_tag, start)['states'], {'new': 1, 'submitted': 1, 'ready': 1})
+
+def check_expired(test, backend):
+    """ Transitions objects between states with and without deadlines, making sure that only those whose deadlines
+    have passed are returned, earliest first.
+    """
+    def_tag = rand_string()
+    start = datetime(2016, 1, 1)
+
+    def get_info(object_tag, state_old, state_current, minutes, deadline_minutes=None):
+        state_info = loads(get_state_info(object_tag, def_tag, state_old, state_current, start + timedelta(minutes=minutes)))
+        if deadline_minutes is not None:
+            state_info['deadline_utc'] = (start + timedelta(minutes=deadline_minutes)).isoformat()
+        return dumps(state_info)
+
+    for idx in range(5):
+        object_tag = 'order.{}'.format(idx)
+        backend.set_current_state_info(object_tag, def_tag, get_info(object_tag, None, 'new', idx, 60 - idx))
+
+    # No longer in a state with a timeout ..
+    backend.set_current_state_info('order.1', def_tag, get_info('order.1', 'new', 'submitted', 10))
+
+    # .. in another one with a later deadline ..
+    backend.set_current_state_info_many(def_tag, [
+        ('order.2', get_info('order.2', 'new', 'submitted', 10)),
+        ('order.2', get_info('order.2', 'submitted', 'ready', 11, 120)),
+    ])
+
+    def get_expired(minutes, limit=100):
+        return [object_tag for object_tag, _ in backend.get_expired(def_tag, start + timedelta(minutes=minutes), limit)]
+
+    test.assertListEqual(get_expired(55), [])
+    test.assertListEqual(get_expired(56), ['order.4'])
+    test.assertListEqual(get_expired(60), ['order.4', 'order.3', 'order.0'])
+    test.assertListEqual(get_expired(60, 2), ['order.4', 'order.3'])
+    test.assertListEqual(get_expired(120), ['order.4', 'order.3', 'order.0', 'order.2'])
+
+    object_tag, state_info = backend.get_expired(def_tag, start + timedelta(minutes=60), 1)[0]
+    test.assertEquals(object_tag, 'order.4')
+    test.assertEquals(state_info['state_current'], 'new')
+    test.assertEquals(state_info['deadline_utc'], (start + timedelta(minutes=56)).isoformat())
+
+def check_rename_def(test, backend):
+    """ Moves objects from one version of a definition to another, making sure that everything about them is moved.
+    """
+    def_name = rand_string()
+    old_def_tag, new_def_tag = Definition.get_tag(def_name, 1), Definition.get_tag(def_name, 2)
+    start = datetime(2016, 1, 1)
+    object_tags = ['order.{}'.format(idx) for idx in range(5)]
+
+    for object_tag in object_tags:
+        backend.set_current_state_info_many(old_def_tag, [
+            (object_tag, get_state_info(object_tag, old_def_tag, None, 'new', start)),
+            (object_tag, get_state_info(object_tag, old_def_tag, 'new', 'submitted', start + timedelta(minutes=1))),
+        ])
+
+    progress = []
+    stats = backend.get_state_stats(old_def_tag, start)
+
+    test.assertEquals(backend.rename_def(def_name, 1, def_name, 2, 2, 0, lambda *args: progress.append(args)), 5)
+    test.assertIn(('current states', 2), progress)
+    test.assertIn(('current states', 5), progress)
+
+    for object_tag in object_tags:
+        test.assertIsNone(backend.get_current_state_info(object_tag, old_def_tag))
+        test.assertListEqual(backend.get_history(object_tag, old_def_tag), [])
+
+        state_info = backend.get_current_state_info(object_tag, new_def_tag)
+        test.assertEquals(state_info['def_tag'], new_def_tag)
+        test.assertEquals(state_info['state_current'], 'submitted')
+        test.assertListEqual([loads(elem)['state_current'] for elem in backend.get_history(object_tag, new_def_tag)],
+            ['new', 'submitted'])
+
+    test.assertListEqual(backend.get_objects_in_state(old_def_tag, 'submitted')[0], [])
+    test.assertEquals(len(backend.get_objects_in_state(new_def_tag, 'submitted')[0]), 5)
+    test.assertEquals(backend.get_state_stats(new_def_tag, start), stats)
+
+    # Objects are never moved to a definition that already has some
+    backend.set_current_state_info('order.1', old_def_tag, get_state_info('order.1', old_def_tag, None, 'new', start))
+    test.assertRaises(ValueError, backend.rename_def, def_name, 1, def_name, 2)
+
+def check_set_current_state_info_if(test, backend):
+    """ Sets states of objects conditionally on version stamps of their current states, making sure that nothing is set
+    if the stamps do not match.
+    """
+    def_tag = rand_string()
+    start = datetime(2016, 1, 1)
+
+    def get_info(state_old, state_current, minutes):
+        return get_state_info('order.1', def_tag, state_old, state_current, start + timedelta(minutes=minutes))
+
+    test.assertTrue(backend.set_current_state_info_if('order.1', def_tag, get_info(None, 'new', 0), None))
+    version = backend.get_current_state_info('order.1', def_tag)['version']
+    test.assertEquals(version, 1)
+
+    # Someone else has already added the object ..
+    test.assertFalse(backend.set_current_state_info_if('order.1', def_tag, get_info(None, 'new', 1), None))
+
+    # .. or transitioned it since its state was read.
+    test.assertFalse(backend.set_current_state_info_if('order.1', def_tag, get_info('new', 'submitted', 1), version + 1))
+
+    test.assertTrue(backend.set_current_state_info_if('order.1', def_tag, get_info('new', 'submitted', 1), version))
+    test.assertFalse(backend.set_current_state_info_if('order.1', def_tag, get_info('new', 'submitted', 2), version))
+
+    # Versions are not times, transitions at the same time as previous ones still change them
+    test.assertTrue(backend.set_current_state_info_if('order.1', def_tag, get_info('submitted', 'sent', 1), version + 1))
+    test.assertFalse(backend.set_current_state_info_if('order.1', def_tag, get_info('submitted', 'sent', 1), version + 1))
+
+    test.assertEquals(backend.get_current_state_info('order.1', def_tag)['state_current'], 'sent')
+    test.assertListEqual([(decode_record(elem)['state_current'], decode_record(elem)['version'])
+        for elem in backend.get_history('order.1', def_tag)], [('new', 1), ('submitted', 2), ('sent', 3)])
+    test.assertEquals(backend.get_objects_in_state(def_tag, 'sent')[0][0][0], 'order.1')
+
+def check_set_current_state_info_many_if(test, backend):
+    """ Sets states of many objects conditionally on version stamps of their current states, making sure that
+    only objects whose stamps do not match are left as they are.
+    """
+    def_tag = rand_string()
+    start = datetime(2016, 1, 1)
+
+    def get_info(object_tag, state_old, state_current, minutes):
+        return get_state_info(object_tag, def_tag, state_old, state_current, start + timedelta(minutes=minutes))
+
+    test.assertEquals(backend.set_current_state_info_many_if(def_tag, [], {}), set())
+
+    test.assertEquals(backend.set_current_state_info_many_if(def_tag, [
+        ('order.1', get_info('order.1', None, 'new', 0)),
+        ('order.1', get_info('order.1', 'new', 'submitted', 1)),
+        ('order.2', get_info('order.2', None, 'new', 0)),
+    ], {'order.1': None, 'order.2': None}), set())
+
+    # Objects added ..
+    test.assertEquals(backend.set_current_state_info_many_if(def_tag, [
+        ('order.2', get_info('order.2', None, 'new', 1)),
+        ('order.3', get_info('order.3', None, 'new', 1)),
+    ], {'order.2': None, 'order.3': None}), set(['order.2']))
+
+    # .. or transitioned by someone else are not overwritten, unlike the rest of them.
+    test.assertEquals(backend.set_current_state_info_many_if(def_tag, [
+        ('order.1', get_info('order.1', 'submitted', 'ready', 2)),
+        ('order.1', get_info('order.1', 'ready', 'sent', 3)),
+        ('order.2', get_info('order.2', 'new', 'submitted', 2)),
+        ('order.3', get_info('order.3', 'new', 'submitted', 2)),
+    ], {'order.1': 1, 'order.2': 1, 'order.3': 1}), set(['order.1']))
+
+    current = backend.get_current_state_info_many(['order.1', 'order.2', 'order.3'], def_tag)
+    test.assertDictEqual(dict((object_tag, (info['state_current'], info['version'])) for object_tag, info in current.items()),
+        {'order.1': ('submitted', 2), 'order.2': ('submitted', 2), 'order.3': ('submitted', 2)})
+
+    test.assertListEqual([(decode_record(elem)['state_current'], decode_record(elem)['version'])
+        for elem in backend.get_history('order.1', def_tag)], [('new', 1), ('submitted', 2)])
+    test.assertListEqual(sorted(elem[0] for elem in backend.get_objects_in_state(def_tag, 'submitted')[0]),
+        ['order.1', 'order.2', 'order.3'])
+
+    test.assertEquals(backend.set_current_state_info_many_if(def_tag, [
+        ('order.1', get_info('order.1', 'submitted', 'ready', 2)),
+        ('order.1', get_info('order.1', 'ready', 'sent', 3)),
+    ], {'order.1': 2}), set())
+
+    test.assertListEqual([(decode_record(elem)['state_current'], decode_record(elem)['version'])
+        for elem in backend.get_history('order.1', def_tag)], [('new', 1), ('submitted', 2), ('ready', 3), ('sent', 4)])
+
+def check_events(test, backend, ordered=True):
+    """ Reads events published by a backend in batches, following cursors returned, whichever way objects were transitioned.
+    Unless ordered is True, only events of each object are expected to be in the order of its transitions.
+    """
+    def_tag1, def_tag2 = rand_string(2)
+    start = datetime(2016, 1, 1)
+
+    def get_info(object_tag, def_tag, state_old, state_current, minutes, version=None):
+        return get_state_info(object_tag, def_tag, state_old, state_current, start + timedelta(minutes=minutes), version)
+
+    state_infos = [
+        ('order.1', get_info('order.1', def_tag1, None, 'new', 0)),
+        ('order.2', get_info('order.2', def_tag1, None, 'new', 1)),
+        ('order.1', get_info('order.1', def_tag1, 'new', 'submitted', 2)),
+        ('order.3', get_info('order.3', def_tag1, None, 'new', 3, 1)),
+        ('order.3', get_info('order.3', def_tag1, 'new', 'submitted', 4)),
+    ]
+
+    test.assertEquals(backend.get_events(def_tag1), ([], None))
+
+    backend.set_current_state_info('order.1', def_tag1, state_infos[0][1])
+    backend.set_current_state_info_many(def_tag1, state_infos[1:3])
+    test.assertTrue(backend.set_current_state_info_if('order.3', def_tag1, state_infos[3][1], None))
+    backend.set_current_state_info_many(def_tag1, state_infos[4:])
+    backend.set_current_state_info('order.1', def_tag2, get_info('order.1', def_tag2, None, 'new', 0))
+
+    # Nothing is published for transitions that are not committed
+    test.assertFalse(backend.set_current_state_info_if('order.3', def_tag1, state_infos[4][1], None))
+
+    events = []
+    cursor = None
+
+    while True:
+        batch, cursor = backend.get_events(def_tag1, cursor, 2)
+        if not batch:
+            break
+        test.assertLessEqual(len(batch), 2)
+        events.extend(batch)
+
+    read = [(event['object_tag'], event['state_info']) for event in events]
+    expected = [(object_tag, loads(state_info)) for object_tag, state_info in state_infos]
+
+    # Sorting is stable so events of each object stay in the order they were read in
+    if not ordered:
+        read, expected = sorted(read, key=itemgetter(0)), sorted(expected, key=itemgetter(0))
+
+    test.assertListEqual(read, expected)
+    test.assertEquals(len(set(event['id'] for event in events)), len(events))
+
+    # The cursor stays where it was until there are new events
+    test.assertEquals(backend.get_events(def_tag1, cursor), ([], cursor))
+
+    backend.set_current_state_info('order.2', def_tag1, get_info('order.2', def_tag1, 'new', 'submitted', 5))
+    batch, cursor = backend.get_events(def_tag1, cursor)
+    test.assertListEqual([(event['object_tag'], event['state_info']['state_current']) for event in batch],
+        [('order.2', 'submitted')])
+
+    test.assertEquals(len(backend.get_events(def_tag2)[0]), 1)
+
+def check_iter_history_objects(test, backend):
+    def_tag = rand_string()
+    object_tags = ['order.{}'.format(idx) for idx in range(7)]
+
+    for object_tag in object_tags:
+        backend.set_current_state_info(object_tag, def_tag, rand_state_info(object_tag, def_tag))
+    backend.set_current_state_info('order.1', rand_string(), rand_state_info('order.1', def_tag))
+
+    batches = list(backend.iter_history_objects(def_tag, 3))
+
+    test.assertListEqual([len(batch) for batch in batches], [3, 3, 1])
+    test.assertListEqual(sorted(sum(batches, [])), object_tags)
+
+# ################################################################################################################################
+
+def get_sql_session():
+    """ Returns a session to an in-memory SQLite database with everything BST needs set up in it.
+    """
+    engine = create_engine('sqlite://')
+    Base.metadata.create_all(engine)
+    session = get_session(engine)
+
+    cluster = Cluster()
+    session.add(cluster)
+    session.commit()
+
+    group = Group()
+    group.name = label.group.conf.process
+    group.is_internal = True
+    group.cluster_id = cluster.id
+
+    sub_group = SubGroup()
+    sub_group.name = label.sub_group.conf.process_bst
+    sub_group.is_internal = True
+    sub_group.group = group
+    sub_group.cluster_id = cluster.id
+
+    session.add(group)
+    session.add(sub_group)
+    session.commit()
+
+    return session, cluster.id
+
+# ################################################################################################################################
+
+class StreamRedis(FakeRedis):
+    """ fakeredis along with the subset of Redis streams that RedisBackend uses through execute_command,
+    with each command it receives kept in self.commands.
+    """
+    def __init__(self, *args, **kwargs):
+        super(StreamRedis, self).__init__(*args, **kwargs)
+        self.commands = []
+
+        # key -> [(id, fields)], oldest first
+        self.streams = {}
+
+        # (key, group) -> [last delivered id, OrderedDict of pending ids to consumers]
+        self.groups = {}
+
+    def _get_id(self, id):
+        return tuple(int(elem) for elem in id.split('-'))
+
+    def execute_command(self, *args):
+        self.commands.append(args)
+        return getattr(self, '_{}'.format(args[0].lower()))(*args[1:])
+
+    def _xadd(self, key, maxlen, approx, count, id, *fields):
+        entries = self.streams.setdefault(key, [])
+        ms, seq = int(time() * 1000), 0
+
+        if entries:
+            last_ms, last_seq = self._get_id(entries[-1][0])
+            if ms <= last_ms:
+                ms, seq = last_ms, last_seq + 1
+
+        id = '{}-{}'.format(ms, seq)
+        entries.append((id, list(fields)))
+        del entries[:-int(count)]
+
+        return id
+
+    def _xrange(self, key, start, end, _count, count):
+        start = (0, 0) if start == '-' else self._get_id(start)
+        return [[id, fields] for id, fields in self.streams.get(key, []) if self._get_id(id) >= start][:count]
+
+    def _xgroup(self, _create, key, group, id, _mkstream):
+        if (key, group) in self.groups:
+            raise ResponseError('BUSYGROUP Consumer Group name already exists')
+
+        self.streams.setdefault(key, [])
+        self.groups[key, group] = ['0-0', OrderedDict()]
+
+    def _xreadgroup(self, _group, group, consumer, _count, count, _streams, key, id):
+        if (key, group) not in self.groups:
+            raise ResponseError('NOGROUP No such key `{}` or consumer group `{}`'.format(key, group))
+
+        last_id, pending = self.groups[key, group]
+        entries = dict(self.streams[key])
+
+        # Pending entries that were trimmed from the stream are returned without fields
+        if id == '0':
+            ids = [elem for elem, elem_consumer in pending.items() if elem_consumer == consumer][:count]
+            return [[key, [[elem, entries.get(elem)] for elem in ids]]]
+
+        out = [[elem, fields] for elem, fields in self.streams[key] if self._get_id(elem) > self._get_id(last_id)][:count]
+        if not out:
+            return None
+
+        for elem, _ in out:
+            pending[elem] = consumer
+        self.groups[key, group][0] = out[-1][0]
+
+        return [[key, out]]
+
+    def _xack(self, key, group, *ids):
+        pending = self.groups.get((key, group), [None, {}])[1]
+        return len([pending.pop(id) for id in ids if id in pending])
+
 # ################################################################################################################################
 
 class AddEdgeResultTestCase(TestCase):
@@ -205,6 +789,48 @@ class DefinitionTestCase(TestCase):
         self.assertFalse(self.d.has_edge(name5, name3))
         self.assertFalse(self.d.has_edge(name5, name4))
 
+    def test_roots_after_changes(self):
+        name1, name2 = rand_string(2)
+
+        self.assertListEqual(self.d.roots, ['new', 'returned'])
+
+        self.d.add_node(name1)
+        self.assertListEqual(self.d.roots, sorted(['new', 'returned', name1]))
+
+        self.d.add_node(name2)
+        self.d.add_edge(name1, name2)
+        self.d.add_edge(name1, 'new')
+        self.assertListEqual(self.d.roots, sorted(['returned', name1]))
+
+    def test_compile(self):
+        compiled = self.d.compile(['canceled'])
+
+        self.assertEquals(compiled.tag, 'Orders.v1')
+        self.assertEquals(compiled.names, ('client_confirmed', 'client_rejected', 'new', 'ready', 'returned',
+            'sent_to_client', 'submitted', 'updated', 'canceled'))
+        self.assertEquals(compiled.root_names, ('new', 'returned'))
+
+        for idx, name in enumerate(compiled.names):
+            self.assertEquals(compiled.get_id(name), idx)
+        self.assertIsNone(compiled.get_id(rand_string()))
+
+        for from_ in self.d.nodes:
+            for to in self.d.nodes:
+                self.assertEquals(
+                    compiled.has_edge(compiled.get_id(from_), compiled.get_id(to)), self.d.has_edge(from_, to))
+
+        self.assertEquals(compiled.sources[compiled.get_id('ready')], ('submitted', 'updated'))
+        self.assertEquals(compiled.sources[compiled.get_id('new')], ())
+
+        for name in compiled.names:
+            id = compiled.get_id(name)
+            self.assertEquals(compiled.is_node(id), name != 'canceled')
+            self.assertEquals(compiled.is_root(id), name in ('new', 'returned'))
+            self.assertEquals(compiled.is_force_stop(id), name == 'canceled')
+
+        # Compiled definitions are immutable
+        self.assertRaises(AttributeError, setattr, compiled, 'roots_mask', 0)
+
     def test_has_edge_missing_nodes(self):
         name1, name2, name3, name4, name5 = rand_string(5)
 
@@ -281,6 +907,80 @@ class ConfigItemTestCase(TestCase):
         self.assertSetEqual(ci.def_.nodes['submitted'].edges, set(['ready']))
         self.assertSetEqual(ci.def_.nodes['updated'].edges, set(['ready']))
 
+        self.assertIsNone(ci.retention.max_history)
+        self.assertIsNone(ci.retention.max_history_age)
+        self.assertFalse(ci.retention.compact_on_stop)
+        self.assertFalse(ci.has_retention())
+
+    def test_parse_config_ini_retention(self):
+
+        config = """
+            [Orders]
+            objects=order
+            force_stop=canceled
+            max_history=100
+            max_history_age=30d
+            compact_on_stop=yes
+            new=submitted
+            submitted=ready
+            """.strip()
+
+        ci = ConfigItem()
+        ci.parse_config_ini(config)
+
+        self.assertEquals(ci.retention.max_history, 100)
+        self.assertEquals(ci.retention.max_history_age, 30 * 24 * 3600)
+        self.assertTrue(ci.retention.compact_on_stop)
+        self.assertTrue(ci.has_retention())
+
+        # Retention settings are not states
+        self.assertListEqual(sorted(ci.def_.nodes), ['new', 'ready', 'submitted'])
+
+    def test_parse_config_ini_timeouts(self):
+
+        config = """
+            [Orders]
+            objects=order
+            force_stop=canceled, timed_out
+            timeout=submitted 2h, sent to client 3d
+            timeout_target=timed_out
+            new=submitted
+            submitted=sent to client
+            """.strip()
+
+        ci = ConfigItem()
+        ci.parse_config_ini(config)
+
+        self.assertDictEqual(ci.timeouts, {'submitted': 7200, 'sent to client': 259200})
+        self.assertEquals(ci.timeout_target, 'timed_out')
+        self.assertListEqual(sorted(ci.def_.nodes), ['new', 'sent to client', 'submitted'])
+
+        self.assertEquals(ci.get_deadline('submitted', datetime(2016, 1, 1)), datetime(2016, 1, 1, 2))
+        self.assertIsNone(ci.get_deadline('new', datetime(2016, 1, 1)))
+
+    def test_parse_config_ini_timeouts_invalid(self):
+
+        config = """
+            [Orders]
+            objects=order
+            force_stop=canceled
+            {}
+            new=submitted
+            """.strip()
+
+        for timeouts in ('timeout=submitted 2h', 'timeout=2h\n timeout_target=canceled',
+                'timeout=ready 2h\n timeout_target=canceled', 'timeout=submitted 2h\n timeout_target=timed_out'):
+            self.assertRaises(ValueError, ConfigItem().parse_config_ini, config.format(timeouts))
+
+    def test_parse_duration(self):
+        self.assertEquals(parse_duration('90'), 90)
+        self.assertEquals(parse_duration('90s'), 90)
+        self.assertEquals(parse_duration(' 15m'), 900)
+        self.assertEquals(parse_duration('12H'), 43200)
+        self.assertEquals(parse_duration('30 d'), 2592000)
+        self.assertEquals(parse_duration('2w'), 1209600)
+        self.assertRaises(ValueError, parse_duration, '2y')
+
     def test_parse_config_ini2(self):
 
         config = """
@@ -331,7 +1031,9 @@ class StateBackendBaseTestCase(TestCase):
 
         base = StateBackendBase()
 
-        for name in ['rename_def', 'get_current_state_info', 'get_history', 'set_current_state_info', 'set_ctx']:
+        for name in ['rename_def', 'get_current_state_info', 'get_history', 'set_current_state_info',
+                'set_current_state_info_if', 'set_current_state_info_many_if', 'get_events', 'read_event_group', 'ack_events',
+                'prune_events', 'iter_current_states', 'restore_objects', 'set_ctx']:
             func = getattr(base, name)
             args = rand_string(len(getargspec(func).args)-1)
             try:
@@ -351,9 +1053,15 @@ class RedisBackendTestCase(TestCase):
     def test_patterns(self):
         self.assertEquals(RedisBackend.PATTERN_STATE_CURRENT, 'zato:bst:state:current:{}')
         self.assertEquals(RedisBackend.PATTERN_STATE_HISTORY, 'zato:bst:state:history:{}')
+        self.assertEquals(RedisBackend.PATTERN_STATE_HISTORY_LIST, 'zato:bst:state:history-list:{}:{}')
+        self.assertEquals(RedisBackend.PATTERN_STATE_INDEX, 'zato:bst:state:index:{}:{}')
+        self.assertEquals(RedisBackend.PATTERN_STATS_STATES, 'zato:bst:stats:states:{}')
+        self.assertEquals(RedisBackend.PATTERN_STATS_EDGES, 'zato:bst:stats:edges:{}:{}')
+        self.assertEquals(RedisBackend.PATTERN_EVENTS, 'zato:bst:events:{}')
 
     def test_set_current_state_info(self):
-        object_tag, def_tag, state_info = rand_string(3, True)
+        object_tag, def_tag = rand_string(2)
+        state_info = rand_state_info(object_tag, def_tag)
 
         backend = RedisBackend(self.conn)
         backend.set_current_state_info(object_tag, def_tag, state_info)
@@ -362,7 +1070,8 @@ class RedisBackendTestCase(TestCase):
         self.assertEquals(state, state_info)
 
     def test_get_current_state_info(self):
-        object_tag, def_tag, state_info = rand_string(3, True)
+        object_tag, def_tag = rand_string(2)
+        state_info = rand_state_info(object_tag, def_tag)
 
         backend = RedisBackend(self.conn)
         backend.set_current_state_info(object_tag, def_tag, state_info)
@@ -372,7 +1081,7 @@ class RedisBackendTestCase(TestCase):
 
     def test_get_history(self):
         object_tag, def_tag = rand_string(2)
-        state_info1, state_info2, state_info3 = rand_string(3, True)
+        state_info1, state_info2, state_info3 = [rand_state_info(object_tag, def_tag) for x in range(3)]
 
         backend = RedisBackend(self.conn)
 
@@ -384,6 +1093,2084 @@ class RedisBackendTestCase(TestCase):
 
         self.assertListEqual(history, [state_info1, state_info2, state_info3])
 
+    def test_history_is_appended_to_list(self):
+        object_tag, def_tag = rand_string(2)
+        state_info1, state_info2 = [rand_state_info(object_tag, def_tag) for x in range(2)]
+
+        backend = RedisBackend(self.conn)
+
+        backend.set_current_state_info(object_tag, def_tag, state_info1)
+        backend.set_current_state_info(object_tag, def_tag, state_info2)
+
+        history_key = backend.PATTERN_STATE_HISTORY_LIST.format(def_tag, object_tag)
+        self.assertListEqual(self.conn.lrange(history_key, 0, -1), [state_info1, state_info2])
+
+        # Nothing is written to the legacy hash anymore
+        self.assertIsNone(self.conn.hget(backend.PATTERN_STATE_HISTORY.format(def_tag), object_tag))
+
+    def test_get_history_legacy(self):
+        object_tag, def_tag = rand_string(2)
+        state_info1, state_info2, state_info3 = [rand_state_info(object_tag, def_tag) for x in range(3)]
+
+        # Older entries are in the legacy hash, as they would have been stored by previous versions
+        self.conn.hset(RedisBackend.PATTERN_STATE_HISTORY.format(def_tag), object_tag, dumps([state_info1, state_info2]))
+
+        backend = RedisBackend(self.conn)
+        backend.set_current_state_info(object_tag, def_tag, state_info3)
+
+        history = backend.get_history(object_tag, def_tag)
+
+        self.assertListEqual(history, [state_info1, state_info2, state_info3])
+
+    def test_get_history_pages(self):
+        backend = RedisBackend(self.conn)
+
+        def set_legacy_history(object_tag, def_tag, history):
+            self.conn.hset(backend.PATTERN_STATE_HISTORY.format(def_tag), object_tag, dumps(history))
+
+        check_history_pages(self, backend)
+        check_history_pages(self, backend, set_legacy_history)
+
+    def test_convert_legacy_history(self):
+        object_tag, def_tag = rand_string(2)
+        history = [rand_state_info(object_tag, def_tag) for x in range(3)]
+        legacy_key = RedisBackend.PATTERN_STATE_HISTORY.format(def_tag)
+
+        self.conn.hset(legacy_key, object_tag, dumps(history[:2]))
+
+        backend = RedisBackend(self.conn, convert_legacy_history=True)
+        backend.set_current_state_info(object_tag, def_tag, history[2])
+
+        self.assertListEqual(backend.get_history(object_tag, def_tag, 2, newest_first=True), history[:0:-1])
+
+        # Legacy entries have been moved to the beginning of the list
+        self.assertIsNone(self.conn.hget(legacy_key, object_tag))
+        self.assertListEqual(self.conn.lrange(backend.PATTERN_STATE_HISTORY_LIST.format(def_tag, object_tag), 0, -1), history)
+
+        def set_legacy_history(object_tag, def_tag, history):
+            self.conn.hset(backend.PATTERN_STATE_HISTORY.format(def_tag), object_tag, dumps(history))
+
+        check_history_pages(self, backend, set_legacy_history)
+
+    @skipIf(not msgpack, 'msgpack is not installed')
+    def test_msgpack_codec(self):
+        object_tag, def_tag = rand_string(2)
+        start = datetime(2016, 1, 1)
+
+        backend = RedisBackend(self.conn, codec=CONST.RECORD_CODEC_MSGPACK)
+        state_info1 = get_state_info(object_tag, def_tag, None, 'new', start)
+        state_info2 = get_state_info(object_tag, def_tag, 'new', 'submitted', start + timedelta(minutes=1))
+
+        backend.set_current_state_info(object_tag, def_tag, state_info1)
+        backend.set_current_state_info_many(def_tag, [(object_tag, state_info2)])
+
+        # Everything is stored in msgpack but read back the same way JSON is
+        value = self.conn.hget(backend.PATTERN_STATE_CURRENT.format(def_tag), object_tag)
+        self.assertTrue(value.startswith(CONST.RECORD_MSGPACK_PREFIX))
+
+        self.assertDictEqual(backend.get_current_state_info(object_tag, def_tag), loads(state_info2))
+        self.assertListEqual([decode_record(elem) for elem in backend.get_history(object_tag, def_tag)],
+            [loads(state_info1), loads(state_info2)])
+        self.assertListEqual(backend.get_history(object_tag, def_tag, since_ts=start + timedelta(seconds=30)), [value])
+
+        # Records already stored in JSON are still read
+        self.conn.hset(backend.PATTERN_STATE_CURRENT.format(def_tag), object_tag, state_info1)
+        self.assertDictEqual(backend.get_current_state_info(object_tag, def_tag), loads(state_info1))
+
+        check_objects_in_state(self, backend)
+        check_expired(self, backend)
+        check_set_current_state_info_if(self, backend)
+
+        self.assertRaises(ValueError, RedisBackend, self.conn, True, codec=CONST.RECORD_CODEC_MSGPACK)
+        self.assertRaises(ValueError, RedisBackend, self.conn, codec=rand_string())
+
+    def test_trim_history(self):
+        check_trim_history(self, RedisBackend(self.conn))
+
+    def test_get_history_range_reads(self):
+        object_tag, def_tag = rand_string(2)
+        backend = RedisBackend(self.conn)
+        history = get_timed_history(object_tag, def_tag, 1000)
+
+        backend.set_current_state_info_many(def_tag, [(object_tag, state_info) for state_info in history])
+
+        conn = backend.conn = Bunch(lindex=self.conn.lindex, lrange=self.conn.lrange, llen=self.conn.llen,
+            pipeline=self.conn.pipeline, calls=[])
+
+        def lindex(key, idx):
+            conn.calls.append('lindex')
+            return self.conn.lindex(key, idx)
+
+        def lrange(key, start, end):
+            conn.calls.append(end - start + 1)
+            return self.conn.lrange(key, start, end)
+
+        conn.lindex, conn.lrange = lindex, lrange
+
+        since_ts, until_ts = datetime(2016, 1, 1, 5), datetime(2016, 1, 1, 10)
+
+        self.assertListEqual(backend.get_history(object_tag, def_tag, 10, 5, since_ts, until_ts, True),
+            filter_history(history, 10, 5, since_ts, until_ts, True))
+
+        # Each end of the range takes a binary search and only the page itself is read
+        self.assertLessEqual(conn.calls.count('lindex'), 20)
+        self.assertListEqual([elem for elem in conn.calls if elem != 'lindex'], [10])
+
+    def test_iter_history_objects(self):
+        check_iter_history_objects(self, RedisBackend(self.conn))
+
+    def test_get_objects_in_state(self):
+        check_objects_in_state(self, RedisBackend(self.conn))
+
+    def test_get_state_stats(self):
+        # fakeredis has no HSCAN that rebuild_state_counts needs
+        check_state_stats(self, RedisBackend(self.conn), False)
+
+    def test_get_state_stats_ttl(self):
+        def_tag = rand_string()
+        backend = RedisBackend(self.conn, stats_ttl=120)
+        backend.set_current_state_info('order.1', def_tag, get_state_info('order.1', def_tag, None, 'new', datetime.utcnow()))
+
+        key = backend.PATTERN_STATS_EDGES.format(def_tag, datetime.utcnow().strftime(CONST.STATS_MINUTE_FORMAT))
+        self.assertTrue(0 < self.conn.ttl(key) <= 120)
+        self.assertEquals(backend.prune_state_stats(), 0)
+
+    def test_get_expired(self):
+        check_expired(self, RedisBackend(self.conn))
+
+    def test_set_current_state_info_if(self):
+        check_set_current_state_info_if(self, RedisBackend(self.conn))
+
+    def test_set_current_state_info_many_if(self):
+        check_set_current_state_info_many_if(self, RedisBackend(self.conn))
+
+    def test_restore_objects(self):
+        def_tag = rand_string()
+        start = datetime(2016, 1, 1)
+        backend = RedisBackend(self.conn, publish_events=True)
+
+        state_info1 = get_state_info('order.1', def_tag, 'submitted', 'sent', start)
+        state_info2 = get_state_info('order.2', def_tag, 'new', 'submitted', start)
+
+        backend.restore_objects(def_tag, [('order.1', state_info1, [state_info1]), ('order.2', state_info2, [])])
+
+        self.assertDictEqual(backend.get_current_state_info('order.1', def_tag), loads(state_info1))
+        self.assertListEqual(backend.get_history('order.1', def_tag), [state_info1])
+        self.assertListEqual(backend.get_history('order.2', def_tag), [])
+        self.assertListEqual([elem[0] for elem in backend.get_objects_in_state(def_tag, 'submitted')[0]], ['order.2'])
+
+        # Neither counters nor events are written
+        self.assertDictEqual(self.conn.hgetall(backend.PATTERN_STATS_STATES.format(def_tag)), {})
+        self.assertFalse(self.conn.exists(backend._get_events_key(def_tag)))
+
+    def test_set_current_state_info_if_contention(self):
+        def_tag = rand_string()
+        start = datetime(2016, 1, 1)
+
+        backend = RedisBackend(self.conn)
+        other = FakeRedis()
+        set_current = backend._set_current
+        attempts = []
+
+        def get_info(object_tag, state_old, state_current, minutes):
+            return get_state_info(object_tag, def_tag, state_old, state_current, start + timedelta(minutes=minutes))
+
+        # Another client keeps changing the object's history list each time a transaction is about to be executed ..
+        def set_current_contended(pipe, object_tag, def_tag, state_info):
+            attempts.append(object_tag)
+            other.rpush(backend._get_history_key(object_tag, def_tag), get_info(object_tag, 'new', 'new', 0))
+            set_current(pipe, object_tag, def_tag, state_info)
+
+        backend.set_current_state_info('order.1', def_tag, get_info('order.1', None, 'new', 0))
+        backend._set_current = set_current_contended
+
+        # .. so it gives up after a few attempts ..
+        self.assertFalse(backend.set_current_state_info_if('order.1', def_tag, get_info('order.1', 'new', 'submitted', 1), 0))
+        self.assertEquals(len(attempts), CONST.WATCH_MAX_ATTEMPTS)
+        self.assertEquals(backend.get_current_state_info('order.1', def_tag)['state_current'], 'new')
+
+        # .. whereas transitions of other objects do not abort it.
+        def set_current_other(pipe, object_tag, def_tag, state_info):
+            attempts.append(object_tag)
+            other.rpush(backend._get_history_key('order.2', def_tag), get_info('order.2', None, 'new', 0))
+            set_current(pipe, object_tag, def_tag, state_info)
+
+        backend._set_current = set_current_other
+        del attempts[:]
+
+        self.assertTrue(backend.set_current_state_info_if('order.1', def_tag, get_info('order.1', 'new', 'submitted', 1), 0))
+        self.assertListEqual(attempts, ['order.1'])
+
+    def test_events(self):
+        self.conn = StreamRedis()
+        self.conn.flushall()
+        check_events(self, RedisBackend(self.conn, publish_events=True))
+
+        def_tag = rand_string()
+        backend = RedisBackend(self.conn, publish_events=True, events_max_len=3)
+
+        for idx in range(3):
+            object_tag = 'order.{}'.format(idx)
+            backend.set_current_state_info(object_tag, def_tag, rand_state_info(object_tag, def_tag))
+
+        # Each event is delivered to one consumer of a group ..
+        events1 = backend.read_event_group(def_tag, 'group1', 'consumer1', 2)
+        events2 = backend.read_event_group(def_tag, 'group1', 'consumer2', 2)
+
+        self.assertListEqual([event['object_tag'] for event in events1], ['order.0', 'order.1'])
+        self.assertListEqual([event['object_tag'] for event in events2], ['order.2'])
+        self.assertListEqual(backend.read_event_group(def_tag, 'group1', 'consumer1'), [])
+
+        # .. but to each group.
+        self.assertEquals(len(backend.read_event_group(def_tag, 'group2', 'consumer1')), 3)
+
+        # Events stay pending until acknowledged
+        self.assertListEqual(backend.read_event_group(def_tag, 'group1', 'consumer1', pending=True), events1)
+        self.assertEquals(backend.ack_events(def_tag, 'group1', [event['id'] for event in events1]), 2)
+        self.assertListEqual(backend.read_event_group(def_tag, 'group1', 'consumer1', pending=True), [])
+
+        # Events are not published by default ..
+        RedisBackend(self.conn).set_current_state_info('order.3', def_tag, rand_state_info('order.3', def_tag))
+        self.assertEquals(len(backend.get_events(def_tag)[0]), 3)
+
+        # .. and streams are capped as they are added to, in the same pipelines that transitions are made in.
+        self.conn.commands = []
+        backend.set_current_state_info('order.4', def_tag, rand_state_info('order.4', def_tag))
+
+        self.assertListEqual([elem[:6] for elem in self.conn.commands],
+            [('XADD', backend._get_events_key(def_tag), 'MAXLEN', '~', 3, '*')])
+        self.assertListEqual([event['object_tag'] for event in backend.get_events(def_tag)[0]],
+            ['order.1', 'order.2', 'order.4'])
+
+        # Events trimmed while pending are not returned to their consumers
+        self.assertListEqual([event['object_tag'] for event in backend.read_event_group(
+            def_tag, 'group2', 'consumer1', pending=True)], ['order.1', 'order.2'])
+
+    def test_get_objects_in_state_stale(self):
+        object_tag, def_tag = rand_string(2)
+        backend = RedisBackend(self.conn)
+
+        backend.set_current_state_info(object_tag, def_tag, get_state_info(object_tag, def_tag, None, 'new', datetime.utcnow()))
+
+        # Another process transitioned the object concurrently, based on a state it had read earlier
+        backend.set_current_state_info(
+            object_tag, def_tag, get_state_info(object_tag, def_tag, None, 'submitted', datetime.utcnow()))
+
+        self.assertEquals(self.conn.zcard(backend.PATTERN_STATE_INDEX.format(def_tag, 'new')), 1)
+        self.assertEquals(backend.get_objects_in_state(def_tag, 'new'), ([], None))
+        self.assertEquals(backend.get_objects_in_state(def_tag, 'submitted')[0][0][0], object_tag)
+
+    def test_buckets(self):
+        self.conn.flushall()
+
+        def_tag = rand_string()
+        start = datetime(2016, 1, 1)
+        object_tags = ['order.{}'.format(idx) for idx in range(20)]
+
+        backend = RedisBackend(self.conn, current_buckets=8)
+        backend.set_current_state_info_many(def_tag, [
+            (object_tag, get_state_info(object_tag, def_tag, None, 'new', start)) for object_tag in object_tags])
+
+        # Objects are spread over small hashes rather than kept in a single one
+        keys = self.conn.keys(RedisBackend.PATTERN_STATE_CURRENT_BUCKET.format(def_tag, '*'))
+        self.assertTrue(1 < len(keys) <= 8)
+        self.assertEquals(sum(self.conn.hlen(key) for key in keys), 20)
+        self.assertFalse(self.conn.exists(RedisBackend.PATTERN_STATE_CURRENT.format(def_tag)))
+
+        self.assertEquals(backend.get_current_state_info('order.1', def_tag)['state_current'], 'new')
+        current = backend.get_current_state_info_many(object_tags + ['order.20'], def_tag)
+        self.assertListEqual(sorted(current), sorted(object_tags))
+        self.assertListEqual(backend.get_current_def_tags(), [def_tag])
+        self.assertTrue(backend.has_objects(def_tag))
+
+        check_objects_in_state(self, backend)
+        check_state_stats(self, backend, False)
+        check_expired(self, backend)
+        check_set_current_state_info_if(self, backend)
+
+        self.assertRaises(ValueError, RedisBackend, self.conn, current_buckets=-1)
+        self.assertRaises(ValueError, RedisBackend, self.conn, current_buckets=8, previous_buckets=8)
+
+    def test_previous_layout(self):
+        def_tag = rand_string()
+        start = datetime(2016, 1, 1)
+        object_tags = ['order.{}'.format(idx) for idx in range(5)]
+
+        old_backend = RedisBackend(self.conn)
+        old_backend.set_current_state_info_many(def_tag, [
+            (object_tag, get_state_info(object_tag, def_tag, None, 'new', start)) for object_tag in object_tags])
+
+        backend = RedisBackend(self.conn, current_buckets=4, previous_buckets=0)
+        old_key = RedisBackend.PATTERN_STATE_CURRENT.format(def_tag)
+
+        def get_info(object_tag, minutes):
+            return get_state_info(object_tag, def_tag, 'new', 'submitted', start + timedelta(minutes=minutes))
+
+        # Objects not moved yet are read from the previous layout ..
+        self.assertEquals(backend.get_current_state_info('order.0', def_tag)['state_current'], 'new')
+        self.assertEquals(len(backend.get_objects_in_state(def_tag, 'new')[0]), 5)
+
+        # .. until they are written to the current one, which removes them from the previous one.
+        backend.set_current_state_info('order.0', def_tag, get_info('order.0', 1))
+        backend.set_current_state_info_many(def_tag, [('order.1', get_info('order.1', 2)), ('order.2', get_info('order.2', 2))])
+
+        # States stored without versions are of version 0
+        self.assertNotIn('version', backend.get_current_state_info('order.3', def_tag))
+        self.assertTrue(backend.set_current_state_info_if('order.3', def_tag, get_info('order.3', 3), 0))
+
+        self.assertListEqual(self.conn.hkeys(old_key), ['order.4'])
+
+        current = backend.get_current_state_info_many(object_tags, def_tag)
+        self.assertListEqual([current[object_tag]['state_current'] for object_tag in object_tags], ['submitted'] * 4 + ['new'])
+        self.assertListEqual([elem[0] for elem in backend.get_objects_in_state(def_tag, 'submitted')[0]], object_tags[:4])
+
+        self.assertRaises(ValueError, RedisBackend(self.conn).convert_layout)
+
+    def test_rename_def(self):
+        check_rename_def(self, RedisBackend(self.conn))
+        check_rename_def(self, RedisBackend(self.conn, current_buckets=4))
+
+    def test_rename_def_concurrent(self):
+        def_name = rand_string()
+        old_def_tag, new_def_tag = Definition.get_tag(def_name, 1), Definition.get_tag(def_name, 2)
+        start = datetime(2016, 1, 1)
+
+        backend = RedisBackend(self.conn)
+        for object_tag in ('order.1', 'order.2'):
+            backend.set_current_state_info(object_tag, old_def_tag, get_state_info(object_tag, old_def_tag, None, 'new', start))
+
+        # The object is transitioned after its page was read but before it was moved ..
+        hscan = self.conn.hscan
+
+        def hscan_transitioned(*args, **kwargs):
+            out = hscan(*args, **kwargs)
+            if not hscan_transitioned.calls:
+                backend.set_current_state_info('order.1', old_def_tag,
+                    get_state_info('order.1', old_def_tag, 'new', 'submitted', start + timedelta(minutes=1)))
+            hscan_transitioned.calls += 1
+            return out
+
+        hscan_transitioned.calls = 0
+        self.conn.hscan = hscan_transitioned
+
+        # .. so the page is read again and the state it was transitioned to is moved.
+        self.assertEquals(backend.rename_def(def_name, 1, def_name, 2), 2)
+        self.assertEquals(hscan_transitioned.calls, 2)
+
+        self.assertEquals(backend.get_current_state_info('order.1', new_def_tag)['state_current'], 'submitted')
+        self.assertListEqual([loads(elem)['state_current'] for elem in backend.get_history('order.1', new_def_tag)],
+            ['new', 'submitted'])
+        self.assertDictEqual(backend.get_current_state_info_many(['order.1', 'order.2'], old_def_tag), {})
+        self.assertListEqual(backend.get_history('order.1', old_def_tag), [])
+
+        # Definitions whose objects are still being transitioned are not renamed
+        backend.set_current_state_info('order.1', new_def_tag,
+            get_state_info('order.1', new_def_tag, 'submitted', 'ready', datetime.utcnow()))
+        self.assertRaises(ValueError, backend.rename_def, def_name, 2, def_name, 3)
+
+    def test_convert_layout(self):
+        self.conn.flushall()
+
+        def_tag1, def_tag2 = rand_string(2)
+        start = datetime(2016, 1, 1)
+
+        old_backend = RedisBackend(self.conn)
+        for def_tag in (def_tag1, def_tag2):
+            old_backend.set_current_state_info_many(def_tag, [
+                (object_tag, get_state_info(object_tag, def_tag, None, 'new', start)) for object_tag in ('order.1', 'order.2')])
+
+        # An object already written to the new layout is not overwritten by its state from the previous one
+        backend = RedisBackend(self.conn, current_buckets=4, previous_buckets=0)
+        backend.set_current_state_info(
+            'order.1', def_tag1, get_state_info('order.1', def_tag1, 'new', 'submitted', start + timedelta(minutes=1)))
+
+        self.assertEquals(backend.convert_layout(def_tag1, batch_size=1), 1)
+        self.assertEquals(backend.convert_layout(), 2)
+        self.assertEquals(backend.convert_layout(), 0)
+
+        for def_tag in (def_tag1, def_tag2):
+            self.assertFalse(self.conn.hlen(RedisBackend.PATTERN_STATE_CURRENT.format(def_tag)))
+
+        backend = RedisBackend(self.conn, current_buckets=4)
+        self.assertEquals(backend.get_current_state_info('order.1', def_tag1)['state_current'], 'submitted')
+        self.assertEquals(backend.get_current_state_info('order.2', def_tag1)['state_current'], 'new')
+        self.assertEquals(len(backend.get_current_state_info_many(['order.1', 'order.2'], def_tag2)), 2)
+
+        # Converting back to a single hash works the same way
+        self.assertEquals(RedisBackend(self.conn, previous_buckets=4).convert_layout(), 4)
+        self.assertEquals(len(old_backend.get_current_state_info_many(['order.1', 'order.2'], def_tag2)), 2)
+        self.assertEquals(old_backend.rebuild_state_counts(def_tag1), {'new': 1, 'submitted': 1})
+
+# ################################################################################################################################
+
+class HashRingTestCase(TestCase):
+
+    def test_get_node(self):
+        keys = ['order.{}'.format(idx) for idx in range(1000)]
+        nodes = [HashRing(['a', 'b', 'c']).get_node(key) for key in keys]
+
+        # Keys are spread over all nodes ..
+        for idx in range(3):
+            self.assertGreater(nodes.count(idx), 200)
+
+        # .. always in the same way ..
+        self.assertListEqual([HashRing(['a', 'b', 'c']).get_node(key) for key in keys], nodes)
+
+        # .. and only those of a node that is removed are moved to other nodes.
+        ring = HashRing(['a', 'c'])
+        for key, node in zip(keys, nodes):
+            if node != 1:
+                self.assertEquals(ring.get_node(key), 0 if node == 0 else 1)
+
+# ################################################################################################################################
+
+class ShardedRedisBackendTestCase(TestCase):
+
+    def setUp(self):
+        self.conns = [FakeRedis(db=idx) for idx in range(3)]
+        self.conns[0].flushall()
+
+    def test_shards(self):
+        def_tag = rand_string()
+        object_tags = ['order.{}'.format(idx) for idx in range(30)]
+        state_infos = [(object_tag, rand_state_info(object_tag, def_tag)) for object_tag in object_tags]
+
+        backend = ShardedRedisBackend(self.conns)
+        backend.set_current_state_info(object_tags[0], def_tag, state_infos[0][1])
+        backend.set_current_state_info_many(def_tag, state_infos[1:])
+
+        # Each object is kept in its shard only and all shards have some objects
+        key = RedisBackend.PATTERN_STATE_CURRENT.format(def_tag)
+        shards = [set(conn.hkeys(key)) for conn in self.conns]
+
+        self.assertTrue(all(shards))
+        self.assertEquals(sum(len(elem) for elem in shards), len(object_tags))
+
+        for object_tag, state_info in state_infos:
+            self.assertIn(object_tag, shards[backend.shards.index(backend.get_shard(object_tag))])
+            self.assertEquals(backend.get_current_state_info(object_tag, def_tag), loads(state_info))
+            self.assertListEqual(backend.get_history(object_tag, def_tag), [state_info])
+
+        current = backend.get_current_state_info_many(object_tags + ['order.x'], def_tag)
+        self.assertDictEqual(current, dict((object_tag, loads(state_info)) for object_tag, state_info in state_infos))
+
+        # Shards are found by names, not positions
+        other = ShardedRedisBackend(self.conns[::-1], ['shard-2', 'shard-1', 'shard-0'])
+        self.assertDictEqual(other.get_current_state_info_many(object_tags, def_tag), current)
+
+        self.assertRaises(ValueError, ShardedRedisBackend, [])
+        self.assertRaises(ValueError, ShardedRedisBackend, self.conns, ['a', 'a', 'b'])
+
+    def test_get_history_pages(self):
+        check_history_pages(self, ShardedRedisBackend(self.conns))
+
+    def test_trim_history(self):
+        check_trim_history(self, ShardedRedisBackend(self.conns))
+
+    def test_iter_history_objects(self):
+        check_iter_history_objects(self, ShardedRedisBackend(self.conns))
+
+    def test_get_objects_in_state(self):
+        check_objects_in_state(self, ShardedRedisBackend(self.conns))
+
+    def test_get_state_stats(self):
+        check_state_stats(self, ShardedRedisBackend(self.conns), False)
+
+    def test_get_expired(self):
+        check_expired(self, ShardedRedisBackend(self.conns))
+
+    def test_set_current_state_info_if(self):
+        check_set_current_state_info_if(self, ShardedRedisBackend(self.conns))
+
+    def test_set_current_state_info_many_if(self):
+        check_set_current_state_info_many_if(self, ShardedRedisBackend(self.conns))
+
+    def test_events(self):
+        conns = [StreamRedis(db=idx) for idx in range(3)]
+        check_events(self, ShardedRedisBackend(conns, publish_events=True), False)
+
+        def_tag = rand_string()
+        backend = ShardedRedisBackend(conns, publish_events=True)
+
+        for idx in range(10):
+            object_tag = 'order.{}'.format(idx)
+            backend.set_current_state_info(object_tag, def_tag, rand_state_info(object_tag, def_tag))
+
+        events = backend.read_event_group(def_tag, 'group1', 'consumer1', 4)
+        events += backend.read_event_group(def_tag, 'group1', 'consumer1')
+
+        self.assertItemsEqual([event['object_tag'] for event in events], ['order.{}'.format(idx) for idx in range(10)])
+        self.assertEquals(backend.ack_events(def_tag, 'group1', [event['id'] for event in events]), 10)
+        self.assertListEqual(backend.read_event_group(def_tag, 'group1', 'consumer1', pending=True), [])
+
+# ################################################################################################################################
+
+class SQLBackendTestCase(TestCase):
+
+    def setUp(self):
+        self.session, self.cluster_id = get_sql_session()
+
+    def test_set_current_state_info(self):
+        object_tag, def_tag = rand_string(2)
+        state_info1, state_info2 = rand_state_info(object_tag, def_tag), rand_state_info(object_tag, def_tag)
+
+        backend = SQLBackend(self.session, self.cluster_id)
+        backend.set_current_state_info(object_tag, def_tag, state_info1)
+        backend.set_current_state_info(object_tag, def_tag, state_info2)
+
+        self.assertEquals(backend.get_current_state_info(object_tag, def_tag), loads(state_info2))
+
+        history = self.session.query(BSTHistory).order_by(BSTHistory.seq).all()
+        self.assertEquals(len(history), 2)
+
+        for seq, item, state_info in zip([1, 2], history, [state_info1, state_info2]):
+            self.assertEquals(item.seq, seq)
+            self.assertEquals(item.cluster_id, self.cluster_id)
+            self.assertEquals(item.def_tag, def_tag)
+            self.assertEquals(item.object_tag, object_tag)
+            self.assertEquals(item.transition_ts_utc.isoformat(), loads(state_info)['transition_ts_utc'])
+            self.assertEquals(item.value, state_info)
+
+    def test_set_current_state_info_upsert(self):
+        object_tag1, object_tag2, def_tag = rand_string(3)
+
+        backend = SQLBackend(self.session, self.cluster_id)
+        self.assertIsNotNone(backend._upsert_current) # SQLite >= 3.24 has ON CONFLICT
+
+        # Both with and without native upserts
+        for upsert_current in [backend._upsert_current, None]:
+            backend._upsert_current = upsert_current
+
+            for object_tag in [object_tag1, object_tag2]:
+                state_info1, state_info2 = rand_state_info(object_tag, def_tag), rand_state_info(object_tag, def_tag)
+                backend.set_current_state_info(object_tag, def_tag, state_info1)
+                backend.set_current_state_info(object_tag, def_tag, state_info2)
+
+                self.assertEquals(backend.get_current_state_info(object_tag, def_tag), loads(state_info2))
+
+            state_info3, state_info4 = rand_state_info(object_tag1, def_tag), rand_state_info(object_tag2, def_tag)
+            backend.set_current_state_info_many(def_tag, [(object_tag1, state_info3), (object_tag2, state_info4)])
+
+            self.assertEquals(backend.get_current_state_info(object_tag1, def_tag), loads(state_info3))
+            self.assertEquals(backend.get_current_state_info(object_tag2, def_tag), loads(state_info4))
+
+        # One current state per object, all in the same group and sub-group
+        items = self.session.query(Item).all()
+        self.assertEquals(len(items), 2)
+
+        sub_group = self.session.query(SubGroup).one()
+
+        for item in items:
+            self.assertEquals(item.sub_group_id, sub_group.id)
+            self.assertEquals(item.group_id, sub_group.group_id)
+            self.assertEquals(item.cluster_id, self.cluster_id)
+            self.assertFalse(item.is_internal)
+            self.assertTrue(item.is_active)
+
+        self.assertEquals(len(backend.get_history(object_tag1, def_tag)), 6)
+        self.assertEquals(len(backend.get_history(object_tag2, def_tag)), 6)
+
+    def test_lookup_key(self):
+        object_tag1, object_tag2, def_tag = rand_string(3)
+        state_info1, state_info2 = rand_state_info(object_tag1, def_tag), rand_state_info(object_tag2, def_tag)
+
+        backend = SQLBackend(self.session, self.cluster_id)
+        backend.set_current_state_info(object_tag1, def_tag, state_info1)
+        backend.set_current_state_info(object_tag2, def_tag, state_info2)
+
+        for item in self.session.query(Item).all():
+            self.assertEquals(item.lookup_key, get_lookup_key(item.name))
+
+        # Rows created by previous versions have no lookup keys
+        item = self.session.query(Item).filter(Item.name.endswith(object_tag2)).one()
+        item.lookup_key = None
+        self.session.commit()
+
+        self.assertEquals(backend.get_current_state_info(object_tag2, def_tag), loads(state_info2))
+        self.assertEquals(backend.get_current_state_info_many([object_tag1, object_tag2], def_tag), {
+            object_tag1: loads(state_info1),
+            object_tag2: loads(state_info2),
+        })
+
+        backend.legacy_lookup = False
+        self.assertIsNone(backend.get_current_state_info(object_tag2, def_tag))
+        self.assertEquals(backend.get_current_state_info_many([object_tag1, object_tag2], def_tag), {
+            object_tag1: loads(state_info1),
+        })
+
+        # Each new transition fills in a missing key
+        backend.set_current_state_info(object_tag2, def_tag, state_info2)
+        self.assertEquals(backend.get_current_state_info(object_tag2, def_tag), loads(state_info2))
+
+    def test_session_factory(self):
+        object_tag, def_tag = rand_string(2)
+        state_info1, state_info2 = rand_state_info(object_tag, def_tag), rand_state_info(object_tag, def_tag)
+
+        engine = self.session.get_bind()
+
+        for session_factory in [sessionmaker(bind=engine), scoped_session(sessionmaker(bind=engine))]:
+            backend = SQLBackend(session_factory, self.cluster_id)
+
+            self.assertIsNone(backend.session)
+
+            if isinstance(session_factory, scoped_session):
+
+                # The session that the thread already uses is left as it was
+                self.assertIs(backend.session_factory, session_factory.session_factory)
+                thread_session = session_factory()
+                cluster = thread_session.query(Cluster).filter(Cluster.id==self.cluster_id).one()
+            else:
+                self.assertIs(backend.session_factory, session_factory)
+
+            backend.set_current_state_info(object_tag, def_tag, state_info1)
+            backend.set_current_state_info_many(def_tag, [(object_tag, state_info2)])
+
+            self.assertEquals(backend.get_current_state_info(object_tag, def_tag), loads(state_info2))
+            self.assertEquals(backend.get_current_state_info_many([object_tag], def_tag), {object_tag: loads(state_info2)})
+            self.assertListEqual(backend.get_history(object_tag, def_tag)[-2:], [state_info1, state_info2])
+
+            self.assertIn('status', backend.get_pool_stats())
+
+            if isinstance(session_factory, scoped_session):
+                self.assertIs(session_factory(), thread_session)
+                self.assertIn(cluster, thread_session)
+
+    def test_get_history(self):
+        object_tag1, object_tag2, def_tag = rand_string(3)
+        state_info1, state_info2, state_info3 = [rand_state_info(object_tag1, def_tag) for x in range(3)]
+        state_info4 = rand_state_info(object_tag2, def_tag)
+
+        backend = SQLBackend(self.session, self.cluster_id)
+        backend.set_current_state_info(object_tag1, def_tag, state_info1)
+        backend.set_current_state_info(object_tag1, def_tag, state_info2)
+        backend.set_current_state_info(object_tag2, def_tag, state_info4)
+        backend.set_current_state_info(object_tag1, def_tag, state_info3)
+
+        self.assertListEqual(backend.get_history(object_tag1, def_tag), [state_info1, state_info2, state_info3])
+        self.assertListEqual(backend.get_history(object_tag2, def_tag), [state_info4])
+
+    def test_get_history_legacy(self):
+        object_tag, def_tag = rand_string(2)
+        state_info1, state_info2, state_info3 = [rand_state_info(object_tag, def_tag) for x in range(3)]
+
+        backend = SQLBackend(self.session, self.cluster_id)
+
+        # Older entries are in data_item, as they would have been stored by previous versions
+        item = backend._create_item(
+            self.session, label.sub_group.conf.process_bst, label.item.process_bst_inst_history, def_tag, object_tag)
+        item.value = dumps([state_info1, state_info2])
+        self.session.add(item)
+        self.session.commit()
+
+        backend.set_current_state_info(object_tag, def_tag, state_info3)
+
+        self.assertListEqual(backend.get_history(object_tag, def_tag), [state_info1, state_info2, state_info3])
+
+        backend.read_legacy_history = False
+        self.assertListEqual(backend.get_history(object_tag, def_tag), [state_info3])
+        self.assertEquals(self.session.query(Item).count(), 2) # Current state and legacy history
+
+    def test_get_history_pages(self):
+        backend = SQLBackend(self.session, self.cluster_id)
+
+        def set_legacy_history(object_tag, def_tag, history):
+            item = backend._create_item(
+                self.session, label.sub_group.conf.process_bst, label.item.process_bst_inst_history, def_tag, object_tag)
+            item.value = dumps(history)
+            self.session.add(item)
+            self.session.commit()
+
+        check_history_pages(self, backend)
+        check_history_pages(self, backend, set_legacy_history)
+
+    def test_convert_legacy_history(self):
+        object_tag, def_tag = rand_string(2)
+        state_info1, state_info2, state_info3 = [rand_state_info(object_tag, def_tag) for x in range(3)]
+
+        backend = SQLBackend(self.session, self.cluster_id, convert_legacy_history=True)
+
+        def set_legacy_history(object_tag, def_tag, history):
+            item = backend._create_item(
+                self.session, label.sub_group.conf.process_bst, label.item.process_bst_inst_history, def_tag, object_tag)
+            item.value = dumps(history)
+            self.session.add(item)
+            self.session.commit()
+
+        set_legacy_history(object_tag, def_tag, [state_info1, state_info2])
+        backend.set_current_state_info(object_tag, def_tag, state_info3)
+
+        self.assertListEqual(backend.get_history(object_tag, def_tag), [state_info1, state_info2, state_info3])
+
+        # Legacy entries have been moved to data_bst_history, before the row that was already there
+        self.assertEquals(self.session.query(Item).count(), 1)
+        self.assertListEqual([(item.seq, item.value) for item in self.session.query(BSTHistory).order_by(BSTHistory.seq)],
+            [(1, state_info1), (2, state_info2), (3, state_info3)])
+
+        check_history_pages(self, backend, set_legacy_history)
+
+    def test_migrate_sql_history(self):
+        def_tag = rand_string()
+        object_tags = ['order.{}'.format(idx) for idx in range(5)]
+        histories = dict((object_tag, [rand_state_info(object_tag, def_tag) for x in range(2)]) for object_tag in object_tags)
+        engine = self.session.get_bind()
+
+        backend = SQLBackend(self.session, self.cluster_id)
+
+        for object_tag in object_tags:
+            item = backend._create_item(
+                self.session, label.sub_group.conf.process_bst, label.item.process_bst_inst_history, def_tag, object_tag)
+            item.value = dumps(histories[object_tag])
+            self.session.add(item)
+            self.session.commit()
+
+        # Objects may have been transitioned since upgrading, in which case their newer rows are to follow the legacy ones
+        state_info = rand_state_info('order.1', def_tag)
+        backend.set_current_state_info('order.1', def_tag, state_info)
+        histories['order.1'].append(state_info)
+
+        checkpoint_dir = mkdtemp()
+        try:
+            path = os.path.join(checkpoint_dir, 'checkpoint')
+
+            self.assertEquals(migrate_sql_history(engine, self.session, self.cluster_id, 2, 0, Checkpoint(path)), 5)
+            self.assertTrue(Checkpoint(path).is_done(SQL_HISTORY_STAGE))
+
+            # Nothing is looked into again once the checkpoint says it is done
+            self.assertEquals(migrate_sql_history(engine, self.session, self.cluster_id, 2, 0, Checkpoint(path)), 0)
+        finally:
+            rmtree(checkpoint_dir)
+
+        self.assertEquals(self.session.query(Item).count(), 1) # Current state of order.1
+        for object_tag in object_tags:
+            self.assertListEqual(backend.get_history(object_tag, def_tag), histories[object_tag])
+
+    def test_migrate_sql_history_no_table(self):
+        object_tag, def_tag = rand_string(2)
+        history = [rand_state_info(object_tag, def_tag) for x in range(2)]
+        engine = self.session.get_bind()
+
+        backend = SQLBackend(self.session, self.cluster_id)
+        item = backend._create_item(
+            self.session, label.sub_group.conf.process_bst, label.item.process_bst_inst_history, def_tag, object_tag)
+        item.value = dumps(history)
+        self.session.add(item)
+        self.session.commit()
+
+        # Deployments upgraded from previous versions have no data_bst_history yet
+        BSTHistory.__table__.drop(engine)
+
+        self.assertEquals(migrate_sql_history(engine, self.session, self.cluster_id), 1)
+
+        self.assertEquals(self.session.query(Item).count(), 0)
+        self.assertListEqual(backend.get_history(object_tag, def_tag), history)
+
+    def test_trim_history(self):
+        check_trim_history(self, SQLBackend(self.session, self.cluster_id))
+
+    def test_iter_history_objects(self):
+        check_iter_history_objects(self, SQLBackend(self.session, self.cluster_id))
+
+    def test_get_objects_in_state(self):
+        check_objects_in_state(self, SQLBackend(self.session, self.cluster_id))
+
+    def test_get_state_stats(self):
+        check_state_stats(self, SQLBackend(self.session, self.cluster_id))
+
+    def test_get_state_stats_no_upsert(self):
+        backend = SQLBackend(self.session, self.cluster_id)
+        backend._upsert_counter = dict.fromkeys(backend._upsert_counter)
+        check_state_stats(self, backend)
+
+    def test_get_expired(self):
+        check_expired(self, SQLBackend(self.session, self.cluster_id))
+
+    def test_rename_def(self):
+        check_rename_def(self, SQLBackend(self.session, self.cluster_id))
+
+    def test_rename_def_legacy(self):
+        backend = SQLBackend(self.session, self.cluster_id)
+        start = datetime(2016, 1, 1)
+
+        # Names of rows of the other definition begin with the same prefix as those of the renamed one
+        def_name = rand_string()
+        old_def_tag, new_def_tag = Definition.get_tag(def_name, 1), Definition.get_tag(def_name, 2)
+        other_def_tag = Definition.get_tag(old_def_tag, 1)
+
+        for def_tag in (old_def_tag, other_def_tag):
+            item = backend._create_item(
+                self.session, label.sub_group.conf.process_bst, label.item.process_bst_inst_history, def_tag, 'order.1')
+            item.value = dumps([get_state_info('order.1', def_tag, None, 'new', start)])
+            self.session.add(item)
+            self.session.commit()
+
+            backend.set_current_state_info('order.1', def_tag,
+                get_state_info('order.1', def_tag, 'new', 'submitted', start + timedelta(minutes=1)))
+
+        self.assertEquals(backend.rename_def(def_name, 1, def_name, 2), 1)
+
+        # Legacy histories are renamed along with transitions in them, the other definition's one is left as it was
+        for def_tag in (new_def_tag, other_def_tag):
+            history = [loads(elem) for elem in backend.get_history('order.1', def_tag)]
+            self.assertListEqual([state_info['state_current'] for state_info in history], ['new', 'submitted'])
+            self.assertEquals(history[0]['def_tag'], def_tag)
+
+        self.assertListEqual(backend.get_history('order.1', old_def_tag), [])
+
+    def test_set_current_state_info_if(self):
+        check_set_current_state_info_if(self, SQLBackend(self.session, self.cluster_id))
+
+    def test_set_current_state_info_many_if(self):
+        check_set_current_state_info_many_if(self, SQLBackend(self.session, self.cluster_id))
+
+    def test_concurrent_transitions(self):
+        def_tag = rand_string()
+        start = datetime(2016, 1, 1)
+        backend = SQLBackend(self.session, self.cluster_id)
+
+        get_history_insert = backend._get_history_insert
+        set_state_index = backend._set_state_index
+
+        # Another transaction has committed order.1's first history row after this one read the highest number
+        # of its rows, which is what an INSERT .. SELECT may do under READ COMMITTED ..
+        def get_stale_history_insert(object_tag, def_tag, state_info):
+            backend._get_history_insert = get_history_insert
+            return BSTHistory.__table__.insert().values(cluster_id=self.cluster_id, def_tag=def_tag, object_tag=object_tag,
+                seq=1, transition_ts_utc=parse_ts(loads(state_info)['transition_ts_utc']), value=state_info)
+
+        backend.set_current_state_info('order.1', def_tag, get_state_info('order.1', def_tag, None, 'new', start))
+        backend._get_history_insert = get_stale_history_insert
+        backend.set_current_state_info('order.1', def_tag,
+            get_state_info('order.1', def_tag, 'new', 'submitted', start + timedelta(minutes=1)))
+
+        rows = self.session.query(BSTHistory).filter(BSTHistory.def_tag==def_tag).order_by(BSTHistory.seq)
+        self.assertListEqual([(row.seq, loads(row.value)['state_current']) for row in rows], [(1, 'new'), (2, 'submitted')])
+
+        # .. or has added order.2's state index row after this one found none to update.
+        def set_stale_state_index(session, def_tag, states, only_newer=False):
+            backend._set_state_index = set_state_index
+            session.execute(BSTState.__table__.insert(), [{'cluster_id':self.cluster_id, 'def_tag':def_tag,
+                'object_tag':object_tag, 'state':state, 'transition_ts_utc':ts, 'deadline_utc':deadline}
+                    for object_tag, (state, ts, deadline) in states.items()])
+
+        self.session.add(BSTState(cluster_id=self.cluster_id, def_tag=def_tag, object_tag='order.2', state='new',
+            transition_ts_utc=start))
+        self.session.commit()
+
+        backend._set_state_index = set_stale_state_index
+        backend.set_current_state_info_many(def_tag, [
+            ('order.2', get_state_info('order.2', def_tag, 'new', 'submitted', start + timedelta(minutes=2)))])
+
+        # Either way, the transition is run again and ends up where it would have without the other transaction
+        self.assertEquals(backend.get_current_state_info('order.2', def_tag)['state_current'], 'submitted')
+        self.assertListEqual(sorted(object_tag for object_tag, _ in backend.get_objects_in_state(def_tag, 'submitted')[0]),
+            ['order.1', 'order.2'])
+
+    def test_events(self):
+        check_events(self, SQLBackend(self.session, self.cluster_id, publish_events=True))
+
+        # Events are not published by default
+        count = self.session.query(BSTEvent).count()
+        def_tag = rand_string()
+        SQLBackend(self.session, self.cluster_id).set_current_state_info('order.1', def_tag, rand_state_info('order.1', def_tag))
+        self.assertEquals(self.session.query(BSTEvent).count(), count)
+
+    def test_events_commit_order(self):
+        def_tag = rand_string()
+        backend = SQLBackend(self.session, self.cluster_id, publish_events=True)
+        last_id = self.session.query(func.max(BSTEvent.id)).scalar() or 0
+
+        def add_event(session, event_id, object_tag):
+            session.execute(BSTEvent.__table__.insert(), {'id':event_id, 'cluster_id':self.cluster_id, 'def_tag':def_tag,
+                'object_tag':object_tag, 'value':rand_state_info(object_tag, def_tag)})
+            session.commit()
+
+        # Transaction A takes the next id but commits only after transaction B, which takes the one after it, has committed.
+        # SQLite lets one transaction write at a time so A's row is added as it would be seen once A commits.
+        add_event(sessionmaker(bind=self.session.get_bind())(), last_id + 2, 'order.2')
+
+        events, cursor = backend.get_events(def_tag)
+        self.assertListEqual([event['object_tag'] for event in events], ['order.2'])
+
+        add_event(sessionmaker(bind=self.session.get_bind())(), last_id + 1, 'order.1')
+
+        # A's event is not skipped even though the cursor was moved past its id before A committed ..
+        events, cursor = backend.get_events(def_tag, cursor)
+        self.assertListEqual([event['object_tag'] for event in events], ['order.1'])
+        self.assertEquals(backend.get_events(def_tag, cursor), ([], cursor))
+
+        # .. and all consumers see events in the order they were committed in.
+        self.assertListEqual([event['object_tag'] for event in SQLBackend(self.session, self.cluster_id).get_events(def_tag)[0]],
+            ['order.2', 'order.1'])
+
+    def test_events_rename_def(self):
+        def_name = rand_string()
+        old_def_tag, new_def_tag = Definition.get_tag(def_name, 1), Definition.get_tag(def_name, 2)
+        backend = SQLBackend(self.session, self.cluster_id, publish_events=True)
+
+        backend.set_current_state_info('order.1', old_def_tag, rand_state_info('order.1', old_def_tag))
+        cursor = backend.get_events(old_def_tag)[1]
+
+        backend.rename_def(def_name, 1, def_name, 2)
+        backend.set_current_state_info('order.2', new_def_tag, rand_state_info('order.2', new_def_tag))
+
+        # Events keep their numbers so consumers carry on from where they were
+        events, _ = backend.get_events(new_def_tag, cursor)
+        self.assertListEqual([event['object_tag'] for event in events], ['order.2'])
+
+    def test_prune_events(self):
+        def_tag1, def_tag2 = rand_string(2)
+        backend = SQLBackend(self.session, self.cluster_id, publish_events=True, events_max_len=2)
+
+        for idx in range(5):
+            object_tag = 'order.{}'.format(idx)
+            backend.set_current_state_info(object_tag, def_tag1, rand_state_info(object_tag, def_tag1))
+
+        backend.set_current_state_info('order.1', def_tag2, rand_state_info('order.1', def_tag2))
+
+        self.assertEquals(backend.prune_events(), 3)
+        self.assertListEqual([event['object_tag'] for event in backend.get_events(def_tag1)[0]], ['order.3', 'order.4'])
+        self.assertEquals(len(backend.get_events(def_tag2)[0]), 1)
+        self.assertEquals(backend.prune_events(), 0)
+
+    def test_prune_state_stats(self):
+        def_tag = rand_string()
+        backend = SQLBackend(self.session, self.cluster_id, stats_ttl=120)
+
+        for minutes in (0, 1, 5):
+            object_tag = 'order.{}'.format(minutes)
+            backend.set_current_state_info(object_tag, def_tag,
+                get_state_info(object_tag, def_tag, None, 'new', datetime.utcnow() - timedelta(minutes=minutes)))
+
+        self.assertEquals(backend.prune_state_stats(), 1)
+        self.assertEquals(self.session.query(BSTEdgeCount).filter(BSTEdgeCount.def_tag==def_tag).count(), 2)
+        self.assertEquals(self.session.query(BSTStateCount).filter(BSTStateCount.def_tag==def_tag).one().value, 3)
+
+    def test_index_current_states(self):
+        def_tag1, def_tag2 = rand_string(2)
+        backend = SQLBackend(self.session, self.cluster_id)
+
+        for def_tag in (def_tag1, def_tag2):
+            for idx in range(5):
+                object_tag = 'order.{}'.format(idx)
+                backend.set_current_state_info(
+                    object_tag, def_tag, get_state_info(object_tag, def_tag, None, 'new', datetime(2016, 1, 1, 0, idx)))
+
+        # As though the objects had been transitioned before the index was introduced
+        self.session.query(BSTState).delete()
+        self.session.commit()
+
+        self.assertEquals(backend.index_current_states(def_tag1, batch_size=2), 5)
+        self.assertEquals(len(backend.get_objects_in_state(def_tag1, 'new')[0]), 5)
+        self.assertEquals(len(backend.get_objects_in_state(def_tag2, 'new')[0]), 0)
+
+        # Objects transitioned after their current states were read keep their newer states
+        self.session.add(BSTState(cluster_id=self.cluster_id, def_tag=def_tag2, object_tag='order.1', state='submitted',
+            transition_ts_utc=datetime(2017, 1, 1)))
+        self.session.commit()
+
+        self.assertEquals(backend.index_current_states(batch_size=3), 10)
+        self.assertEquals(len(backend.get_objects_in_state(def_tag1, 'new')[0]), 5)
+        self.assertEquals(len(backend.get_objects_in_state(def_tag2, 'new')[0]), 4)
+
+    def test_filter_history(self):
+        object_tag, def_tag = rand_string(2)
+        history = get_timed_history(object_tag, def_tag, 10)
+
+        self.assertListEqual(filter_history(history), history)
+        self.assertListEqual(filter_history(history, 3), history[:3])
+        self.assertListEqual(filter_history(history, 3, 8), history[8:])
+        self.assertListEqual(filter_history(history, 2, 1, newest_first=True), [history[8], history[7]])
+        self.assertListEqual(filter_history(history, since_ts='2016-01-01T00:08:00'), history[8:])
+        self.assertListEqual(filter_history(history, until_ts=datetime(2016, 1, 1, 0, 2)), history[:2])
+        self.assertListEqual(filter_history(history, 1, 1, '2016-01-01T00:03:00', '2016-01-01T00:06:00', True), [history[4]])
+
+# ################################################################################################################################
+
+class CachingBackendTestCase(TestCase):
+
+    def setUp(self):
+        self.conn = FakeRedis()
+        self.conn.flushall()
+
+    def test_read_through(self):
+        object_tag1, object_tag2, def_tag = rand_string(3)
+        state_info1, state_info2 = rand_state_info(object_tag1, def_tag), rand_state_info(object_tag1, def_tag)
+
+        backend = CachingBackend(RedisBackend(self.conn))
+
+        # Objects without a state are cached too
+        self.assertIsNone(backend.get_current_state_info(object_tag1, def_tag))
+        self.assertIsNone(backend.get_current_state_info(object_tag1, def_tag))
+        self.assertEquals(backend.get_stats()['hits'], 1)
+        self.assertEquals(backend.get_stats()['misses'], 1)
+
+        # Local writes invalidate entries
+        backend.set_current_state_info(object_tag1, def_tag, state_info1)
+        self.assertEquals(backend.get_current_state_info(object_tag1, def_tag), loads(state_info1))
+        self.assertEquals(backend.get_current_state_info(object_tag1, def_tag), loads(state_info1))
+
+        backend.set_current_state_info_many(def_tag, [(object_tag1, state_info2)])
+        self.assertEquals(backend.get_current_state_info_many([object_tag1, object_tag2], def_tag), {
+            object_tag1: loads(state_info2)})
+        self.assertEquals(backend.get_current_state_info_many([object_tag1, object_tag2], def_tag), {
+            object_tag1: loads(state_info2)})
+
+        stats = backend.get_stats()
+        self.assertEquals(stats['hits'], 4)
+        self.assertEquals(stats['misses'], 4)
+        self.assertEquals(stats['size'], 2)
+        self.assertEquals(stats['hit_ratio'], 0.5)
+
+        # Other methods go straight to the underlying backend
+        self.assertListEqual(backend.get_history(object_tag1, def_tag), [state_info1, state_info2])
+
+    def test_invalidation_by_other_processes(self):
+        object_tag, def_tag = rand_string(2)
+        state_info1, state_info2 = rand_state_info(object_tag, def_tag), rand_state_info(object_tag, def_tag)
+
+        backend = CachingBackend(RedisBackend(self.conn))
+        other = RedisBackend(self.conn)
+
+        backend.set_current_state_info(object_tag, def_tag, state_info1)
+        self.assertEquals(backend.get_current_state_info(object_tag, def_tag), loads(state_info1))
+
+        # Not seen until a message from the other process arrives
+        other.set_current_state_info(object_tag, def_tag, state_info2)
+        self.assertEquals(backend.get_current_state_info(object_tag, def_tag), loads(state_info1))
+
+        backend.on_message({'type': 'message', 'data': dumps({'def_tag': def_tag, 'object_tags': [object_tag]})})
+        self.assertEquals(backend.get_current_state_info(object_tag, def_tag), loads(state_info2))
+
+    def test_invalidation_by_other_processes_rename_def(self):
+        def_name = rand_string()
+        old_def_tag, new_def_tag = Definition.get_tag(def_name, 1), Definition.get_tag(def_name, 2)
+        state_info = get_state_info('order.1', old_def_tag, None, 'new', datetime(2016, 1, 1))
+
+        messages = []
+        publisher = Bunch(publish=lambda channel, data: messages.append({'type': 'message', 'data': data}))
+
+        sql_backend = SQLBackend(*get_sql_session())
+        backend = CachingBackend(sql_backend, conn=publisher)
+        other = CachingBackend(sql_backend)
+
+        backend.set_current_state_info('order.1', old_def_tag, state_info)
+
+        # The other process caches the object under the old definition and as having no state under the new one ..
+        self.assertEquals(other.get_current_state_info('order.1', old_def_tag)['state_current'], 'new')
+        self.assertIsNone(other.get_current_state_info('order.1', new_def_tag))
+
+        del messages[:]
+        self.assertEquals(backend.rename_def(def_name, 1, def_name, 2), 1)
+
+        # .. until it learns of the rename, which invalidates everything of both definitions.
+        for message in messages:
+            other.on_message(message)
+
+        self.assertIsNone(other.get_current_state_info('order.1', old_def_tag))
+        self.assertEquals(other.get_current_state_info('order.1', new_def_tag)['state_current'], 'new')
+
+    def test_setup_server_config(self):
+        base_dir = mkdtemp()
+        os.makedirs(os.path.join(base_dir, 'config', 'repo', 'proc', 'bst'))
+
+        session, cluster_id = get_sql_session()
+        subscribed = []
+        listening = Event()
+
+        # Blocks, as a subscription with no messages would, in the listener's daemon thread
+        def listen():
+            listening.set()
+            yield {'type': 'subscribe'}
+            Event().wait()
+
+        conn = Bunch(pubsub=lambda: Bunch(subscribe=subscribed.append, listen=listen))
+        server = Bunch(base_dir=base_dir, odb=Bunch(pool=Bunch(engine=session.get_bind())), cluster_id=cluster_id,
+            kvdb=Bunch(conn=conn))
+
+        try:
+            # Current states are not cached by default ..
+            for fs_server_config in (Bunch(), Bunch(bst=Bunch(cache='false'))):
+                server.update(user_ctx=Bunch(), fs_server_config=fs_server_config)
+                setup_server_config(Bunch(server=server))
+                self.assertIsInstance(server.user_ctx.zato_state_machine.backend, SQLBackend)
+
+            # .. unless configured to, in which case invalidations from other server processes are listened for.
+            server.update(user_ctx=Bunch(), fs_server_config=Bunch(bst=Bunch(cache='true', cache_ttl='30')))
+            setup_server_config(Bunch(server=server))
+
+            backend = server.user_ctx.zato_state_machine.backend
+            self.assertIsInstance(backend, CachingBackend)
+            self.assertIsInstance(backend.backend, SQLBackend)
+            self.assertEquals(backend.ttl, 30)
+            self.assertEquals(backend.max_size, 10000)
+            self.assertIs(backend.conn, conn)
+
+            self.assertTrue(listening.wait(5))
+            self.assertListEqual(subscribed, [CachingBackend.CHANNEL])
+
+        finally:
+            rmtree(base_dir)
+
+    def test_lru_ttl(self):
+        object_tag1, object_tag2, object_tag3, def_tag = rand_string(4)
+
+        backend = CachingBackend(RedisBackend(self.conn), max_size=2)
+
+        backend.get_current_state_info(object_tag1, def_tag)
+        backend.get_current_state_info(object_tag2, def_tag)
+        backend.get_current_state_info(object_tag1, def_tag)
+        backend.get_current_state_info(object_tag3, def_tag) # Evicts object_tag2, used least recently
+
+        self.assertListEqual(backend._cache.keys(), [(def_tag, object_tag1), (def_tag, object_tag3)])
+        self.assertEquals(backend.get_stats()['evictions'], 1)
+
+        backend.ttl = -1
+        backend.clear()
+        backend.get_current_state_info(object_tag1, def_tag)
+        backend.get_current_state_info(object_tag1, def_tag)
+        self.assertEquals(backend.get_stats()['hits'], 1) # Both calls above were misses because entries expired at once
+
+# ################################################################################################################################
+
+class StateMachineTestCase(TestCase):
+
+    config = """
+        [Orders]
+        objects=order
+        force_stop=canceled
+        new=submitted
+        submitted=ready
+        ready=sent
+        sent=confirmed, rejected
+        rejected=updated
+        updated=ready
+        """.strip()
+
+    def get_state_machine(self, backend):
+        config_item = ConfigItem()
+        config_item.parse_config_ini(self.config)
+
+        return StateMachine({config_item.def_.tag: config_item}, backend)
+
+    def get_backends(self):
+        conn = FakeRedis()
+        conn.flushall()
+
+        session, cluster_id = get_sql_session()
+        backends = [RedisBackend(conn), SQLBackend(session, cluster_id)]
+
+        if msgpack:
+            msgpack_conn = FakeRedis(db=1)
+            msgpack_conn.flushdb()
+            backends.append(RedisBackend(msgpack_conn, codec=CONST.RECORD_CODEC_MSGPACK))
+
+        shard_conns = [FakeRedis(db=idx) for idx in (2, 3)]
+        for shard_conn in shard_conns:
+            shard_conn.flushdb()
+
+        backends.append(ShardedRedisBackend(shard_conns))
+
+        bucket_conn = FakeRedis(db=4)
+        bucket_conn.flushdb()
+        backends.append(RedisBackend(bucket_conn, current_buckets=16))
+
+        return backends
+
+    def test_mass_transition(self):
+        for backend in self.get_backends():
+            sm = self.get_state_machine(backend)
+            def_tag = 'Orders.v1'
+
+            sm.transition('order.1', 'new', def_tag, None)
+
+            results = sm.mass_transition([
+                ('order.1', 'submitted', def_tag, None),
+                ('order.2', 'new', def_tag, None),
+                ('order.1', 'ready', def_tag, None, None, False, False),
+                ('order.3', 'ready', def_tag, None, None, False, False), # Not a root
+                ('order.2', 'sent', def_tag, None, None, False, False), # No such edge
+                ('order.2', 'canceled', def_tag, None, None, False, False),
+            ])
+
+            self.assertEquals(len(results), 6)
+
+            self.assertEquals(results[0], (True, '', 'new', 'submitted'))
+            self.assertEquals(results[1], (True, '', None, 'new'))
+            self.assertEquals(results[2], (True, '', 'submitted', 'ready'))
+            self.assertEquals(results[5], (True, '', 'new', 'canceled'))
+
+            self.assertFalse(results[3][0])
+            self.assertTrue(results[3][1].startswith('Object `order.3` of `Orders.v1` not found'))
+
+            self.assertFalse(results[4][0])
+            self.assertTrue(results[4][1].startswith('No transition found from `new` to `sent`'))
+
+            self.assertEquals(sm.get_current_state_info('order.1', def_tag)['state_current'], 'ready')
+            self.assertEquals(sm.get_current_state_info('order.2', def_tag)['state_current'], 'canceled')
+            self.assertIsNone(sm.get_current_state_info('order.3', def_tag))
+
+            self.assertListEqual(
+                [elem['state_current'] for elem in sm.get_history('order.1', def_tag)], ['new', 'submitted', 'ready'])
+            self.assertListEqual(
+                [elem['state_current'] for elem in sm.get_history('order.2', def_tag)], ['new', 'canceled'])
+
+    def test_get_objects_in_state(self):
+        for backend in self.get_backends():
+            sm = self.get_state_machine(backend)
+            def_tag = 'Orders.v1'
+
+            sm.mass_transition([
+                ('order.1', 'new', def_tag, None),
+                ('order.2', 'new', def_tag, None),
+                ('order.1', 'submitted', def_tag, None),
+            ])
+            sm.transition('order.3', 'new', def_tag, None)
+
+            objects, cursor = sm.get_objects_in_state(def_tag, 'new')
+
+            self.assertIsNone(cursor)
+            self.assertListEqual([(elem['object_tag'], elem['def_tag']) for elem in objects],
+                [('order.2', def_tag), ('order.3', def_tag)])
+
+            objects, cursor = sm.get_objects_in_state(def_tag, 'submitted', 1)
+            self.assertEquals(objects[0]['object_tag'], 'order.1')
+            self.assertListEqual(sm.get_objects_in_state(def_tag, 'submitted', 1, cursor)[0], [])
+
+    def test_get_current_state_info_many(self):
+        for backend in self.get_backends():
+            sm = self.get_state_machine(backend)
+            def_tag = 'Orders.v1'
+
+            sm.mass_transition([
+                ('order.1', 'new', def_tag, None),
+                ('order.2', 'new', def_tag, None),
+                ('order.1', 'submitted', def_tag, None),
+            ])
+
+            current = sm.get_current_state_info_many(['order.1', 'order.2', 'order.3'], def_tag)
+
+            self.assertItemsEqual(current.keys(), ['order.1', 'order.2'])
+            self.assertDictEqual(current['order.1'], sm.get_current_state_info('order.1', def_tag))
+            self.assertEquals(current['order.2']['state_current'], 'new')
+            self.assertEquals(current['order.2']['object_tag'], 'order.2')
+            self.assertEquals(current['order.2']['def_tag'], def_tag)
+            self.assertDictEqual(sm.get_current_state_info_many([], def_tag), {})
+
+    def test_get_state_stats(self):
+        for backend in self.get_backends():
+            sm = self.get_state_machine(backend)
+            def_tag = 'Orders.v1'
+
+            sm.mass_transition([
+                ('order.1', 'new', def_tag, None),
+                ('order.2', 'new', def_tag, None),
+                ('order.1', 'submitted', def_tag, None),
+            ])
+            sm.transition('order.2', 'canceled', def_tag, None)
+
+            stats = sm.get_state_stats(def_tag)
+            self.assertDictEqual(stats['states'], {'new': 0, 'submitted': 1, 'canceled': 1})
+            self.assertEquals(sum(elem['count'] for elem in stats['transitions']), 4)
+
+    def test_transition_many(self):
+        for backend in self.get_backends():
+            sm = self.get_state_machine(backend)
+            def_tag = 'Orders.v1'
+
+            sm.transition('order.1', 'new', def_tag, None)
+
+            items = [
+                {'object_type': 'order', 'object_id': 1, 'state_new': 'submitted', 'user_ctx': {'a': 1}},
+                {'object_type': 'order', 'object_id': 2, 'state_new': 'new'},
+                {'object_type': 'order', 'object_id': 2, 'state_new': 'sent'}, # No such edge
+                ValueError('Invalid JSON in line 4'),
+                {'object_type': 'invoice', 'object_id': 1, 'state_new': 'new'},
+                {'object_type': 'order', 'state_new': 'new'},
+                'abc',
+                {'object_type': 'order', 'object_id': 3, 'state_new': 'ready', 'force': 'true'},
+            ]
+
+            results = list(sm.transition_many(items, 'server1', 3))
+
+            self.assertListEqual([(result['can_transition'], result['state_old'], result['state_new']) for result in results], [
+                (True, 'new', 'submitted'),
+                (True, None, 'new'),
+                (False, 'new', 'sent'),
+                (False, None, None),
+                (False, None, 'new'),
+                (False, None, None),
+                (False, None, None),
+                (True, None, 'ready'),
+            ])
+
+            self.assertEquals(results[2]['reason'], 'No transition found from `new` to `sent` for `order.2` in `Orders.v1`')
+            self.assertEquals(results[3]['reason'], 'Invalid JSON in line 4')
+            self.assertEquals(results[4]['reason'], 'Unknown object type `invoice`')
+            self.assertEquals(results[5]['reason'], 'Missing `object_id`')
+            self.assertEquals(results[6]['reason'], 'Expected an object instead of `abc`')
+
+            state_info = sm.get_current_state_info('order.1', def_tag)
+            self.assertEquals(state_info['server_ctx'], 'server1')
+            self.assertDictEqual(state_info['user_ctx'], {'a': 1})
+            self.assertTrue(sm.get_current_state_info('order.3', def_tag)['is_forced'])
+
+    def test_transition_to(self):
+
+        class CountingBackend(CachingBackend):
+            """ Counts reads of current states instead of caching them.
+            """
+            reads = 0
+
+            def get_current_state_info(self, object_tag, def_tag):
+                self.reads += 1
+                return self.backend.get_current_state_info(object_tag, def_tag)
+
+        for backend in self.get_backends():
+            backend = CountingBackend(backend)
+            sm = self.get_state_machine(backend)
+            service = Bunch(server=Bunch(user_ctx=Bunch(zato_state_machine=sm)))
+            def_tag = 'Orders.v1'
+
+            with transition_to(service, 'order', 1, 'new'):
+                pass
+
+            with transition_to(service, 'order', 1, 'submitted') as ctx:
+                ctx.comment = 'abc'
+
+            # Each transition is validated and performed after a single read
+            self.assertEquals(backend.reads, 2)
+
+            state_info = sm.get_current_state_info('order.1', def_tag)
+            self.assertEquals(state_info['state_old'], 'new')
+            self.assertEquals(state_info['state_current'], 'submitted')
+            self.assertDictEqual(state_info['user_ctx'], {'comment': 'abc'})
+
+            with self.assertRaises(TransitionError):
+                with transition_to(service, 'order', 1, 'sent'):
+                    pass
+
+            # Someone else transitions the object in the meantime
+            with self.assertRaises(TransitionConflictError):
+                with transition_to(service, 'order', 1, 'ready'):
+                    sm.transition('order.1', 'canceled', def_tag, None)
+
+            with self.assertRaises(TransitionConflictError):
+                with transition_to(service, 'order', 2, 'new'):
+                    sm.transition('order.2', 'new', def_tag, None)
+
+            self.assertEquals(sm.get_current_state_info('order.1', def_tag)['state_current'], 'canceled')
+            self.assertListEqual([elem['state_current'] for elem in sm.get_history('order.2', def_tag)], ['new'])
+
+    def test_transition_conflict(self):
+
+        class InterleavingBackend(CachingBackend):
+            """ Reads current states without caching them and lets another transition of an object in just before
+            the first conditional write of its state.
+            """
+            other = None
+
+            def get_current_state_info(self, object_tag, def_tag):
+                return self.backend.get_current_state_info(object_tag, def_tag)
+
+            def set_current_state_info_if(self, object_tag, def_tag, state_info, version):
+                if self.other:
+                    other, self.other = self.other, None
+                    other()
+                return self.backend.set_current_state_info_if(object_tag, def_tag, state_info, version)
+
+        for backend in self.get_backends():
+            backend = InterleavingBackend(backend)
+            sm = self.get_state_machine(backend)
+            def_tag = 'Orders.v1'
+
+            sm.transition('order.1', 'new', def_tag, None)
+            sm.transition('order.1', 'submitted', def_tag, None)
+
+            # The object changed only its version in the meantime so the transition is still valid once validated again ..
+            backend.other = lambda: sm.transition('order.1', 'submitted', def_tag, None, None, True)
+            self.assertEquals(sm.transition('order.1', 'ready', def_tag, None), (True, '', 'submitted', 'ready'))
+
+            self.assertListEqual([(elem['state_current'], elem['version']) for elem in sm.get_history('order.1', def_tag)],
+                [('new', 1), ('submitted', 2), ('submitted', 3), ('ready', 4)])
+
+            # .. unlike here, where it is not overwritten either.
+            backend.other = lambda: sm.transition('order.1', 'canceled', def_tag, None)
+            self.assertRaises(TransitionError, sm.transition, 'order.1', 'sent', def_tag, None)
+
+            sm.transition('order.1', 'new', def_tag, None, None, True)
+            backend.other = lambda: sm.transition('order.1', 'submitted', def_tag, None)
+
+            can_transition, _, state_current, _ = sm.transition('order.1', 'submitted', def_tag, None, None, False, False)
+            self.assertFalse(can_transition)
+            self.assertEquals(state_current, 'submitted')
+
+            self.assertListEqual([elem['state_current'] for elem in sm.get_history('order.1', def_tag)[-4:]],
+                ['ready', 'canceled', 'new', 'submitted'])
+
+    def test_mass_transition_conflict(self):
+
+        class InterleavingBackend(CachingBackend):
+            """ Reads current states without caching them and lets other transitions in just before each conditional write
+            of a batch, for as long as they keep setting other again.
+            """
+            other = None
+
+            def get_current_state_info_many(self, object_tags, def_tag):
+                return self.backend.get_current_state_info_many(object_tags, def_tag)
+
+            def set_current_state_info_many_if(self, def_tag, state_infos, versions):
+                if self.other:
+                    other, self.other = self.other, None
+                    other()
+                return self.backend.set_current_state_info_many_if(def_tag, state_infos, versions)
+
+        for backend in self.get_backends():
+            backend = InterleavingBackend(backend)
+            sm = self.get_state_machine(backend)
+            def_tag = 'Orders.v1'
+
+            sm.mass_transition([
+                ('order.1', 'new', def_tag, None),
+                ('order.1', 'submitted', def_tag, None),
+                ('order.2', 'new', def_tag, None),
+            ])
+
+            # Transitions of order.1 are validated again against its new state, those of order.2 are written as they were ..
+            backend.other = lambda: sm.transition('order.1', 'ready', def_tag, None)
+
+            self.assertListEqual(sm.mass_transition([
+                ('order.1', 'canceled', def_tag, None),
+                ('order.2', 'submitted', def_tag, None),
+            ]), [(True, '', 'ready', 'canceled'), (True, '', 'new', 'submitted')])
+
+            self.assertListEqual([(elem['state_current'], elem['version']) for elem in sm.get_history('order.1', def_tag)],
+                [('new', 1), ('submitted', 2), ('ready', 3), ('canceled', 4)])
+
+            self.assertListEqual([(elem['state_current'], elem['version']) for elem in sm.get_history('order.2', def_tag)],
+                [('new', 1), ('submitted', 2)])
+
+            # .. and not written if they are no longer valid ..
+            backend.other = lambda: sm.transition('order.2', 'canceled', def_tag, None)
+
+            self.assertListEqual(sm.mass_transition([
+                ('order.2', 'ready', def_tag, None, None, False, False),
+                ('order.2', 'sent', def_tag, None, None, False, False),
+                ('order.3', 'new', def_tag, None, None, False, False),
+            ]), [
+                (False, 'No transition found from `canceled` to `ready` for `order.2` in `Orders.v1`', 'canceled', 'ready'),
+                (False, 'No transition found from `canceled` to `sent` for `order.2` in `Orders.v1`', 'canceled', 'sent'),
+                (True, '', None, 'new')])
+
+            self.assertListEqual([elem['state_current'] for elem in sm.get_history('order.2', def_tag)],
+                ['new', 'submitted', 'canceled'])
+
+            # .. or if objects keep being transitioned by someone else.
+            def interfere():
+                sm.transition('order.3', 'new', def_tag, None, None, True)
+                backend.other = interfere
+
+            backend.other = interfere
+
+            can_transition, reason, state_current, _ = sm.mass_transition([
+                ('order.3', 'submitted', def_tag, None, None, False, False)])[0]
+
+            self.assertFalse(can_transition)
+            self.assertIn('was transitioned by someone else', reason)
+            self.assertEquals(state_current, 'new')
+
+            self.assertRaises(TransitionConflictError, sm.mass_transition, [('order.3', 'submitted', def_tag, None)])
+
+            backend.other = None
+
+            self.assertListEqual(sm.mass_transition([('order.3', 'submitted', def_tag, None)]), [(True, '', 'new', 'submitted')])
+            self.assertEquals(sm.get_current_state_info('order.3', def_tag)['version'], 2 + 2 * CONST.TRANSITION_MAX_ATTEMPTS)
+
+    def test_time_out(self):
+        config = self.config.replace('force_stop=canceled', 'force_stop=canceled, timed_out') + """
+        timeout=submitted 1h, sent 1d
+        timeout_target=timed_out
+        """.rstrip()
+
+        for backend in self.get_backends():
+            config_item = ConfigItem()
+            config_item.parse_config_ini(config)
+            sm = StateMachine({config_item.def_.tag: config_item}, backend)
+            def_tag = 'Orders.v1'
+
+            sm.mass_transition([
+                ('order.1', 'new', def_tag, None),
+                ('order.2', 'new', def_tag, None),
+                ('order.3', 'new', def_tag, None),
+                ('order.1', 'submitted', def_tag, None),
+                ('order.2', 'submitted', def_tag, None),
+                ('order.2', 'ready', def_tag, None),
+                ('order.2', 'sent', def_tag, None),
+            ])
+            sm.transition('order.3', 'submitted', def_tag, None)
+
+            state_info = sm.get_current_state_info('order.1', def_tag)
+            self.assertEquals(
+                parse_ts(state_info['deadline_utc']), parse_ts(state_info['transition_ts_utc']) + timedelta(hours=1))
+
+            now = datetime.utcnow()
+
+            self.assertEquals(sm.time_out(def_tag, now + timedelta(minutes=59)), {'expired': 0, 'moved': 0})
+            self.assertEquals(sm.time_out(def_tag, now + timedelta(minutes=61), 1), {'expired': 1, 'moved': 1})
+
+            scheduler = DeadlineScheduler(sm, 1, server_ctx='scheduler')
+            self.assertEquals(scheduler.run(now + timedelta(minutes=61)), {def_tag: {'expired': 1, 'moved': 1}})
+            self.assertEquals(scheduler.run(now + timedelta(days=2)), {def_tag: {'expired': 1, 'moved': 1}})
+            self.assertEquals(scheduler.run(now + timedelta(days=2)), {def_tag: {'expired': 0, 'moved': 0}})
+
+            for object_tag in ('order.1', 'order.2', 'order.3'):
+                state_info = sm.get_current_state_info(object_tag, def_tag)
+                self.assertEquals(state_info['state_current'], 'timed_out')
+                self.assertIsNone(state_info['deadline_utc'])
+                self.assertTrue(state_info['is_forced'])
+
+            self.assertEquals(sm.get_current_state_info('order.2', def_tag)['state_old'], 'sent')
+            self.assertEquals(sm.get_current_state_info('order.3', def_tag)['server_ctx'], 'scheduler')
+
+    def test_time_out_transitioned(self):
+        config = self.config + """
+        timeout=submitted 1h
+        timeout_target=canceled
+        """.rstrip()
+
+        for backend in self.get_backends():
+            config_item = ConfigItem()
+            config_item.parse_config_ini(config)
+            sm = StateMachine({config_item.def_.tag: config_item}, backend)
+            def_tag = 'Orders.v1'
+
+            sm.mass_transition([('order.1', 'new', def_tag, None), ('order.1', 'submitted', def_tag, None)])
+
+            # The object is transitioned after it was found to have timed out ..
+            get_expired = backend.get_expired
+
+            def get_expired_transitioned(*args):
+                expired = get_expired(*args)
+                sm.transition('order.1', 'ready', def_tag, None)
+                return expired
+
+            backend.get_expired = get_expired_transitioned
+
+            # .. so it is not moved to the timeout target.
+            self.assertEquals(sm.time_out(def_tag, datetime.utcnow() + timedelta(minutes=61)), {'expired': 1, 'moved': 0})
+            self.assertEquals(sm.get_current_state_info('order.1', def_tag)['state_current'], 'ready')
+
+    def test_mass_transition_raise_on_error(self):
+        for backend in self.get_backends():
+            sm = self.get_state_machine(backend)
+            def_tag = 'Orders.v1'
+
+            self.assertRaises(TransitionError, sm.mass_transition, [
+                ('order.1', 'new', def_tag, None),
+                ('order.2', 'ready', def_tag, None),
+            ])
+
+            # Nothing is written if any item is invalid
+            self.assertIsNone(sm.get_current_state_info('order.1', def_tag))
+
+    def test_get_edge_args(self):
+        sm = self.get_state_machine(None)
+        config = sm.config['Orders.v1']
+
+        any_state, allow_none, state_sources = sm._get_edge_args(config, 'ready', False)
+        self.assertFalse(any_state)
+        self.assertFalse(allow_none)
+        self.assertListEqual(sorted(state_sources), ['submitted', 'updated'])
+
+        self.assertEquals(sm._get_edge_args(config, 'new', False), (False, True, ()))
+        self.assertEquals(sm._get_edge_args(config, 'ready', True), (True, True, ()))
+        self.assertEquals(sm._get_edge_args(config, 'canceled', False), (True, True, ()))
+        self.assertEquals(sm._get_edge_args(config, rand_string(), True), (False, False, ()))
+
+    def test_transition_atomic(self):
+
+        class AtomicBackend(RedisBackend):
+            """ Does in Python what the Lua script does in Redis, which fakeredis cannot run.
+            """
+            supports_atomic_transition = True
+
+            def transition_atomic(self, object_tag, def_tag, state_info, any_state, allow_none, state_sources):
+                state_current = (self.get_current_state_info(object_tag, def_tag) or {}).get('state_current')
+
+                if not any_state:
+                    if not state_current and not allow_none:
+                        return False, None
+                    if state_current and state_current not in state_sources:
+                        return False, state_current
+
+                state_info = loads(state_info)
+                state_info['state_old'] = state_current
+                self.set_current_state_info(object_tag, def_tag, dumps(state_info))
+
+                return True, state_current
+
+        conn = FakeRedis()
+        conn.flushall()
+
+        sm = self.get_state_machine(AtomicBackend(conn))
+        def_tag = 'Orders.v1'
+
+        self.assertEquals(sm.transition('order.1', 'new', def_tag, None), (True, '', None, 'new'))
+        self.assertEquals(sm.transition('order.1', 'submitted', def_tag, None), (True, '', 'new', 'submitted'))
+
+        can_transition, reason, state_current, state_new = sm.transition('order.1', 'sent', def_tag, None, None, False, False)
+        self.assertFalse(can_transition)
+        self.assertEquals(reason, 'No transition found from `submitted` to `sent` for `order.1` in `Orders.v1`')
+        self.assertEquals(state_current, 'submitted')
+        self.assertEquals(state_new, 'sent')
+
+        self.assertRaises(TransitionError, sm.transition, 'order.2', 'ready', def_tag, None)
+
+        self.assertListEqual(
+            [(elem['state_old'], elem['state_current']) for elem in sm.get_history('order.1', def_tag)],
+            [(None, 'new'), ('new', 'submitted')])
+
+# ################################################################################################################################
+
+class HistoryCompactorTestCase(TestCase):
+
+    config = """
+        [Orders]
+        objects=order
+        force_stop=canceled
+        max_history=3
+        compact_on_stop=true
+        new=submitted
+        submitted=ready
+        ready=submitted
+        """.strip()
+
+    def setUp(self):
+        self.archive_dir = mkdtemp()
+
+    def tearDown(self):
+        rmtree(self.archive_dir)
+
+    def test_compact(self):
+        conn = FakeRedis()
+        conn.flushall()
+        session, cluster_id = get_sql_session()
+
+        for backend in [RedisBackend(conn), SQLBackend(session, cluster_id)]:
+
+            config_item = ConfigItem()
+            config_item.parse_config_ini(self.config)
+            sm = StateMachine({config_item.def_.tag: config_item}, backend)
+            def_tag = config_item.def_.tag
+
+            for state in ['new', 'submitted', 'ready', 'submitted', 'ready']:
+                sm.transition('order.1', state, def_tag, None)
+                sm.transition('order.2', state, def_tag, None)
+            sm.transition('order.2', 'canceled', def_tag, None)
+
+            sm.transition('order.3', 'new', def_tag, None)
+
+            compactor = HistoryCompactor(sm.config, backend, self.archive_dir, batch_size=2, pause=0)
+            stats = compactor.run()[def_tag]
+
+            self.assertEquals(stats.objects, 3)
+            self.assertEquals(stats.trimmed, 7)
+
+            self.assertListEqual(
+                [elem['state_current'] for elem in sm.get_history('order.1', def_tag)], ['ready', 'submitted', 'ready'])
+            self.assertListEqual([elem['state_current'] for elem in sm.get_history('order.2', def_tag)], ['canceled'])
+            self.assertListEqual([elem['state_current'] for elem in sm.get_history('order.3', def_tag)], ['new'])
+
+            # Everything trimmed was archived
+            archived = [loads(line) for line in GzipFile(stats.archive).read().splitlines()]
+            self.assertEquals(len(archived), 7)
+            self.assertListEqual([elem['state_current'] for elem in archived if elem['object_tag'] == 'order.1'],
+                ['new', 'submitted'])
+            self.assertListEqual([elem['state_current'] for elem in archived if elem['object_tag'] == 'order.2'],
+                ['new', 'submitted', 'ready', 'submitted', 'ready'])
+
+            # Nothing more to do
+            self.assertEquals(compactor.run()[def_tag].trimmed, 0)
+
+    def test_no_retention(self):
+        config_item = ConfigItem()
+        config_item.parse_config_ini(StateMachineTestCase.config)
+
+        backend = RedisBackend(FakeRedis())
+        compactor = HistoryCompactor({config_item.def_.tag: config_item}, backend)
+
+        self.assertDictEqual(compactor.run(), {})
+        self.assertEquals(compactor.compact_def(config_item).trimmed, 0)
+
+# ################################################################################################################################
+
+class SnapshotTestCase(TestCase):
+
+    def setUp(self):
+        self.snapshot_dir = mkdtemp()
+
+    def tearDown(self):
+        rmtree(self.snapshot_dir)
+
+    def get_backends(self):
+        conn = FakeRedis()
+        conn.flushall()
+
+        return RedisBackend(conn), SQLBackend(*get_sql_session())
+
+    def check_export_import(self, pairs):
+        def_tag1, def_tag2 = rand_string(2)
+        start = datetime(2016, 1, 1)
+
+        for source, target in pairs:
+            path = os.path.join(self.snapshot_dir, '{}.ndjson.gz'.format(rand_string()))
+
+            for def_tag in (def_tag1, def_tag2):
+                for idx in range(5):
+                    object_tag = 'order.{}'.format(idx)
+                    source.set_current_state_info_many(def_tag, [
+                        (object_tag, get_state_info(object_tag, def_tag, None, 'new', start + timedelta(minutes=idx))),
+                        (object_tag, get_state_info(object_tag, def_tag, 'new', 'submitted', start + timedelta(minutes=idx+1))),
+                    ])
+
+            self.assertEquals(export_snapshot(source, [def_tag1, def_tag2], path, 2), 10)
+
+            items = sorted(iter_snapshot(path), key=lambda item: (item['def_tag'] != def_tag1, item['object_tag']))
+            self.assertEquals(len(items), 10)
+            self.assertEquals(items[0]['current']['state_current'], 'submitted')
+            self.assertListEqual([elem['state_current'] for elem in items[0]['history']], ['new', 'submitted'])
+
+            self.assertEquals(import_snapshot(target, path, [def_tag1], 3), 5)
+
+            for idx in range(5):
+                object_tag = 'order.{}'.format(idx)
+
+                self.assertDictEqual(
+                    target.get_current_state_info(object_tag, def_tag1), source.get_current_state_info(object_tag, def_tag1))
+                self.assertListEqual([loads(elem) for elem in target.get_history(object_tag, def_tag1)],
+                    [loads(elem) for elem in source.get_history(object_tag, def_tag1)])
+
+                self.assertIsNone(target.get_current_state_info(object_tag, def_tag2))
+
+            self.assertEquals(len(target.get_objects_in_state(def_tag1, 'submitted')[0]), 5)
+            self.assertDictEqual(target.get_state_stats(def_tag1, start)['states'], {'submitted': 5})
+
+            # Each pair of backends exchanges different objects
+            def_tag1, def_tag2 = rand_string(2)
+
+    def test_export_import(self):
+        redis_backend, sql_backend = self.get_backends()
+        self.check_export_import([(redis_backend, sql_backend), (sql_backend, redis_backend)])
+
+    def test_export_import_sql(self):
+        self.check_export_import([(SQLBackend(*get_sql_session()), SQLBackend(*get_sql_session()))])
+
+    def test_get_backend_buckets(self):
+        def_tag = rand_string()
+        start = datetime(2016, 1, 1)
+        path = os.path.join(self.snapshot_dir, 'snapshot.ndjson.gz')
+
+        conn = FakeRedis()
+        conn.flushall()
+
+        # Current states are kept in buckets ..
+        source = RedisBackend(conn, current_buckets=4)
+        for idx in range(5):
+            object_tag = 'order.{}'.format(idx)
+            source.set_current_state_info(object_tag, def_tag, get_state_info(object_tag, def_tag, None, 'new', start))
+
+        args = Bunch(backend='redis', redis_host=None, redis_port=None, redis_password=None, buckets=4, previous_buckets=None)
+
+        strict_redis = redis.StrictRedis
+        redis.StrictRedis = lambda *ignored_args, **ignored_kwargs: conn
+
+        try:
+            backend = get_backend(args)
+        finally:
+            redis.StrictRedis = strict_redis
+
+        # .. and so are they looked up in by a backend built from command line arguments.
+        self.assertEquals(backend.current_buckets, 4)
+        self.assertIsNone(backend.previous_buckets)
+        self.assertEquals(export_snapshot(backend, [def_tag], path), 5)
+
+    def test_export_legacy(self):
+        session, cluster_id = get_sql_session()
+        source = SQLBackend(session, cluster_id)
+        target = SQLBackend(*get_sql_session())
+
+        def_tag = rand_string()
+        start = datetime(2016, 1, 1)
+        path = os.path.join(self.snapshot_dir, 'snapshot.ndjson.gz')
+
+        history = [get_state_info('order.1', def_tag, None, 'new', start),
+            get_state_info('order.1', def_tag, 'new', 'submitted', start + timedelta(minutes=1))]
+
+        # The object has a current state and a legacy history only ..
+        for name_pattern, value in ((label.item.process_bst_inst_history, dumps(history)),
+                (label.item.process_bst_inst_current, history[-1])):
+            item = source._create_item(session, label.sub_group.conf.process_bst, name_pattern, def_tag, 'order.1')
+            item.value = value
+            session.add(item)
+            session.commit()
+
+        # .. and this one a current state with no history at all.
+        item = source._create_item(session, label.sub_group.conf.process_bst, label.item.process_bst_inst_current, def_tag,
+            'order.2')
+        item.value = get_state_info('order.2', def_tag, 'new', 'submitted', start)
+        session.add(item)
+        session.commit()
+
+        self.assertListEqual(list(source.iter_history_objects(def_tag)), [])
+        self.assertEquals(export_snapshot(source, [def_tag], path), 2)
+
+        items = dict((item['object_tag'], item) for item in iter_snapshot(path))
+        self.assertListEqual([elem['state_current'] for elem in items['order.1']['history']], ['new', 'submitted'])
+        self.assertListEqual(items['order.2']['history'], [])
+
+        self.assertEquals(import_snapshot(target, path), 2)
+
+        self.assertListEqual([loads(elem)['state_current'] for elem in target.get_history('order.1', def_tag)],
+            ['new', 'submitted'])
+        self.assertEquals(target.get_current_state_info('order.2', def_tag)['state_current'], 'submitted')
+        self.assertListEqual(target.get_history('order.2', def_tag), [])
+        self.assertDictEqual(target.get_state_stats(def_tag, start)['states'], {'submitted': 2})
+
+    def test_import_trimmed(self):
+        start = datetime(2016, 1, 1)
+        path = os.path.join(self.snapshot_dir, 'snapshot.ndjson.gz')
+
+        redis_backend, sql_backend = self.get_backends()
+        redis_backend.publish_events = sql_backend.publish_events = True
+
+        for target in (sql_backend, redis_backend):
+            def_tag = rand_string()
+
+            # History was trimmed so its oldest transition is not from None
+            history = [loads(get_state_info('order.1', def_tag, 'submitted', 'Sent', start)),
+                loads(get_state_info('order.1', def_tag, 'Sent', 'Done', start + timedelta(minutes=1)))]
+
+            with GzipFile(path, 'wb') as f:
+                f.write(dumps({'version': 1, 'def_tags': [def_tag]}).encode('utf-8'))
+                f.write(b'\n')
+                item = {'def_tag': def_tag, 'object_tag': 'order.1', 'current': history[-1], 'history': history}
+                f.write(dumps(item).encode('utf-8'))
+
+            self.assertEquals(import_snapshot(target, path), 1)
+
+            self.assertDictEqual(target.get_current_state_info('order.1', def_tag), history[-1])
+            self.assertListEqual([loads(elem) for elem in target.get_history('order.1', def_tag)], history)
+
+            # Objects are counted in the states they are in, not in those their transitions were made from ..
+            stats = target.get_state_stats(def_tag, start)
+            self.assertDictEqual(stats['states'], {'Done': 1})
+            self.assertListEqual(stats['transitions'], [])
+
+            self.assertListEqual(target.get_objects_in_state(def_tag, 'Done')[0], [('order.1', history[-1])])
+
+            # .. and nothing is published as they were not transitioned again.
+            if target is sql_backend:
+                self.assertListEqual(target.get_events(def_tag)[0], [])
+            else:
+                self.assertFalse(target.conn.exists(target._get_events_key(def_tag)))
+
+    def test_unsupported_version(self):
+        path = os.path.join(self.snapshot_dir, 'snapshot.ndjson.gz')
+
+        with GzipFile(path, 'wb') as f:
+            f.write(dumps({'version': 123}).encode('utf-8'))
+
+        self.assertRaises(ValueError, list, iter_snapshot(path))
+
+# ################################################################################################################################
+
+class RedisMigrationTestCase(TestCase):
+
+    def setUp(self):
+        self.checkpoint_dir = mkdtemp()
+
+        self.conn = FakeRedis()
+        self.conn.flushall()
+
+        self.session, self.cluster_id = get_sql_session()
+
+    def tearDown(self):
+        rmtree(self.checkpoint_dir)
+
+    def get_sql_history(self, def_tag, object_tag, column=BSTHistory.value):
+        query = self.session.query(column).\
+            filter(BSTHistory.def_tag==def_tag).\
+            filter(BSTHistory.object_tag==object_tag).\
+            order_by(BSTHistory.seq)
+
+        return [elem for elem, in query.all()]
+
+    def test_checkpoint(self):
+        path = os.path.join(self.checkpoint_dir, 'checkpoint')
+
+        checkpoint = Checkpoint(path)
+        checkpoint.set('current', {'key': 'abc', 'cursor': 12})
+        self.assertFalse(checkpoint.is_done('current'))
+
+        # Progress is read back by the next run ..
+        checkpoint = Checkpoint(path)
+        self.assertDictEqual(checkpoint.get('current'), {'key': 'abc', 'cursor': 12})
+
+        checkpoint.set_done('current')
+        self.assertTrue(Checkpoint(path).is_done('current'))
+
+        # .. unless there is no file to keep it in.
+        Checkpoint().set('current', 123)
+        self.assertListEqual(os.listdir(self.checkpoint_dir), ['checkpoint'])
+
+    def test_get_worker_id(self):
+        object_tags = ['order.{}'.format(idx) for idx in range(50)]
+        worker_ids = [get_worker_id(object_tag, 3) for object_tag in object_tags]
+
+        self.assertSetEqual(set(worker_ids), set([0, 1, 2]))
+
+        # Objects always go to the same workers
+        self.assertListEqual([get_worker_id(object_tag, 3) for object_tag in object_tags], worker_ids)
+        self.assertSetEqual(set(get_worker_id(object_tag, 1) for object_tag in object_tags), set([0]))
+
+    def test_add_history(self):
+        def_tag = rand_string()
+        start = datetime(2016, 1, 1)
+        migration = RedisMigration(self.session, self.cluster_id, self.conn, [])
+
+        history = [get_state_info('order.1', def_tag, None, 'new', start),
+            get_state_info('order.1', def_tag, 'new', 'submitted', start + timedelta(minutes=1))]
+
+        migration.add_history([(def_tag, 'order.1', history)])
+        self.session.commit()
+
+        # Written again, e.g. after an interruption, with transitions made since then, including one at the same time
+        history.append(get_state_info('order.1', def_tag, 'submitted', 'ready', start + timedelta(minutes=1)))
+        history.append(get_state_info('order.1', def_tag, 'ready', 'sent', start + timedelta(minutes=2)))
+
+        migration.add_history([(def_tag, 'order.1', history), (def_tag, 'order.2', history[:1])])
+        migration.add_history([(def_tag, 'order.1', history)])
+        self.session.commit()
+
+        self.assertListEqual(self.get_sql_history(def_tag, 'order.1'), history)
+        self.assertListEqual(self.get_sql_history(def_tag, 'order.2'), history[:1])
+
+        self.assertListEqual(self.get_sql_history(def_tag, 'order.1', BSTHistory.seq), [1, 2, 3, 4])
+
+    def test_run_resume(self):
+        def_tag1, def_tag2 = rand_string(2)
+        start = datetime(2016, 1, 1)
+        path = os.path.join(self.checkpoint_dir, 'checkpoint')
+
+        # Current states of one definition are kept in a single hash, those of the other in buckets ..
+        backends = {def_tag1: RedisBackend(self.conn), def_tag2: RedisBackend(self.conn, current_buckets=4)}
+
+        for def_tag, backend in backends.items():
+            for idx in range(10):
+                object_tag = 'order.{}'.format(idx)
+                backend.set_current_state_info_many(def_tag, [
+                    (object_tag, get_state_info(object_tag, def_tag, None, 'new', start + timedelta(minutes=idx))),
+                    (object_tag, get_state_info(object_tag, def_tag, 'new', 'submitted', start + timedelta(minutes=idx+1))),
+                ])
+
+        # .. and one object has its oldest transition in the legacy hash still.
+        legacy = get_state_info('order.legacy', def_tag1, None, 'new', start)
+        self.conn.hset(RedisBackend.PATTERN_STATE_HISTORY.format(def_tag1), 'order.legacy', dumps([legacy]))
+        backends[def_tag1].set_current_state_info('order.legacy', def_tag1,
+            get_state_info('order.legacy', def_tag1, 'new', 'submitted', start + timedelta(minutes=1)))
+
+        keys = get_redis_current_keys(self.conn)
+        self.assertEquals(len(keys), 5)
+
+        # Objects of the single hash are split between two workers ..
+        self.assertSetEqual(set(get_worker_id('order.{}'.format(idx), 2) for idx in range(10)), set([0, 1]))
+
+        sql_backend = SQLBackend(self.session, self.cluster_id)
+
+        # .. each of which goes through all the hashes and is interrupted after its first batch ..
+        for worker_id in range(2):
+            worker_path = '{}.{}'.format(path, worker_id)
+
+            migration = RedisMigration(self.session, self.cluster_id, self.conn, keys, Checkpoint(worker_path), 3,
+                worker_id=worker_id, workers=2)
+            migrate_batch = migration.migrate_batch
+            batches = []
+
+            def migrate_batch_interrupted(def_tag, items):
+                if batches:
+                    raise Exception('Interrupted')
+                batches.append(items)
+                migrate_batch(def_tag, items)
+
+            migration.migrate_batch = migrate_batch_interrupted
+
+            self.assertRaises(Exception, migration.run)
+            self.assertFalse(Checkpoint(worker_path).is_done(RedisMigration.STAGE))
+
+            # .. resumes where it stopped ..
+            RedisMigration(self.session, self.cluster_id, self.conn, keys, Checkpoint(worker_path), 3,
+                worker_id=worker_id, workers=2).run()
+
+            self.assertTrue(Checkpoint(worker_path).is_done(RedisMigration.STAGE))
+
+            # .. and migrates only objects of its own.
+            for def_tag in backends:
+                for idx in range(10):
+                    object_tag = 'order.{}'.format(idx)
+                    is_migrated = sql_backend.get_current_state_info(object_tag, def_tag) is not None
+                    self.assertEquals(is_migrated, get_worker_id(object_tag, 2) <= worker_id)
+
+        # Running everything once more does not change anything.
+        RedisMigration(self.session, self.cluster_id, self.conn, keys, None, 3).run()
+
+        for def_tag, backend in backends.items():
+            object_tags = ['order.{}'.format(idx) for idx in range(10)] + (['order.legacy'] if def_tag == def_tag1 else [])
+
+            for object_tag in object_tags:
+                self.assertDictEqual(sql_backend.get_current_state_info(object_tag, def_tag),
+                    backend.get_current_state_info(object_tag, def_tag))
+                self.assertListEqual(self.get_sql_history(def_tag, object_tag), backend.get_history(object_tag, def_tag))
+
+        self.assertListEqual(self.get_sql_history(def_tag1, 'order.legacy')[:1], [legacy])
+
+# ################################################################################################################################
+
+class RecordTestCase(TestCase):
+
+    def test_json(self):
+        state_info = {'state_current': 'new', 'user_ctx': {'a': [1, None]}}
+        record = encode_record(state_info)
+
+        self.assertDictEqual(loads(record), state_info)
+        self.assertDictEqual(decode_record(record), state_info)
+        self.assertDictEqual(decode_record(record.encode('utf-8')), state_info)
+
+    @skipIf(not msgpack, 'msgpack is not installed')
+    def test_msgpack(self):
+        state_info = {'state_current': 'new', 'user_ctx': {'a': [1, None]}}
+        record = encode_record(state_info, CONST.RECORD_CODEC_MSGPACK)
+
+        self.assertTrue(record.startswith(CONST.RECORD_MSGPACK_PREFIX))
+        self.assertDictEqual(decode_record(record), state_info)
+        self.assertLess(len(record), len(encode_record(state_info)))
+
+# ################################################################################################################################
+
+class IterJSONItemsTestCase(TestCase):
+
+    def test_json_array(self):
+        self.assertListEqual(list(iter_json_items(' [{"a": 1}, {"b": 2}]')), [{'a': 1}, {'b': 2}])
+
+    def test_ndjson(self):
+        items = list(iter_json_items('{"a": 1}\n\n{"b": 2}\r\n{"c"\n{"d": 4}'))
+
+        self.assertListEqual(items[:2], [{'a': 1}, {'b': 2}])
+        self.assertIsInstance(items[2], ValueError)
+        self.assertEquals(str(items[2]), 'Invalid JSON in line 4')
+        self.assertEquals(items[3], {'d': 4})
+
+    def test_json_array_invalid(self):
+        self.assertRaises(ValueError, iter_json_items, '[{"a": 1}, {"b"')
+
 # ################################################################################################################################
 
 class ParsePrettyPrintTestCase(TestCase):
@@ -401,6 +3188,11 @@ Rejected: Updated
 Updated: Ready
 Objects: Order, Priority order
 Force stop: Canceled, Interrupted
+Max history: 100
+Max history age: 30d
+Compact on stop: yes
+Timeout: Submitted 2h, Sent 3d
+Timeout target: Canceled
 """.strip()
 
         expected_after_value = """
@@ -413,6 +3205,11 @@ Rejected=Updated
 Updated=Ready
 objects=Order, Priority order
 force_stop=Canceled, Interrupted
+max_history=100
+max_history_age=30d
+compact_on_stop=yes
+timeout=Submitted 2h, Sent 3d
+timeout_target=Canceled
 """.strip()
 
         self.assertEquals(expected_after_value, parse_pretty_print(orig_value))